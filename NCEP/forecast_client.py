@@ -0,0 +1,82 @@
+'''
+Description: Client of the GraphCast forecast server (forecast_server.py), to submit forecasts and follow them
+Revision history:
+    -20261018: initial code
+'''
+import argparse
+import json
+import time
+import urllib.error
+import urllib.request
+
+
+class ForecastClient:
+    def __init__(self, server="http://127.0.0.1:8765"):
+        self.server = server.rstrip('/')
+
+    def _request(self, path, body=None):
+        data = None if body is None else json.dumps(body).encode()
+        request = urllib.request.Request(f"{self.server}{path}", data=data, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"{e.code}: {json.loads(e.read()).get('error')}") from e
+
+    def submit(self, gdas_data_path, forecast_length, output_dir=None):
+        """Queue a forecast, and return the job."""
+        return self._request("/jobs", dict(input=gdas_data_path, length=int(forecast_length), output=output_dir))
+
+    def get(self, job_id=None):
+        """Return a job, or all of them if job_id is None."""
+        return self._request("/jobs" if job_id is None else f"/jobs/{job_id}")
+
+    def wait(self, job_id, poll_interval=1.0, timeout=None):
+        """Wait until the job is done or failed, and return it."""
+        start = time.time()
+        while True:
+            job = self.get(job_id)
+            if job['status'] in ('done', 'failed'):
+                return job
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError(f"job {job_id} is still {job['status']} after {timeout} seconds")
+            time.sleep(poll_interval)
+
+
+def describe(job):
+    """One line summary of a job, with how long it was queued and how long it ran."""
+    summary = f"job {job['id']} ({job['input']}, {job['length']} steps): {job['status']}"
+    if job['started'] is not None:
+        summary += f", queued {job['started'] - job['submitted']:.1f} s"
+    if job['finished'] is not None:
+        summary += f", ran {job['finished'] - job['started']:.1f} s"
+    if job['error'] is not None:
+        summary += f", error: {job['error']}"
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Submit forecasts to the GraphCast forecast server.")
+    parser.add_argument("--server", help="address of the server", default="http://127.0.0.1:8765")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    submit_parser = subparsers.add_parser("submit", help="queue a forecast")
+    submit_parser.add_argument("-i", "--input", help="input file path (including file name), as seen by the server", required=True)
+    submit_parser.add_argument("-l", "--length", help="length of forecast (6-hourly), an integer number in range [1, 40]", required=True)
+    submit_parser.add_argument("-o", "--output", help="output directory, as seen by the server", default=None)
+    submit_parser.add_argument("--wait", help="wait until the forecast is done (yes or no)", default="no")
+
+    status_parser = subparsers.add_parser("status", help="show one job, or all of them")
+    status_parser.add_argument("job", help="job id", nargs="?", default=None)
+
+    args = parser.parse_args()
+    client = ForecastClient(args.server)
+    if args.command == "submit":
+        job = client.submit(args.input, int(args.length), args.output)
+        print(describe(job))
+        if args.wait.lower() == "yes":
+            print(describe(client.wait(job['id'])))
+    else:
+        jobs = client.get(args.job)
+        for job in jobs if args.job is None else [jobs]:
+            print(describe(job))
@@ -0,0 +1,178 @@
+'''
+Description: Long-lived GraphCast forecast server, which keeps the model weights, normalization stats, graphs and
+             compiled executables in memory, and runs the forecasts submitted over local HTTP back to back
+Revision history:
+    -20261018: initial code
+'''
+import os
+import argparse
+import itertools
+import json
+import queue
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ForecastJobs:
+    """Queue of forecast jobs, run one after the other by a single worker thread."""
+
+    def __init__(self, run_forecast):
+        # run_forecast(gdas_data_path, forecast_length, output_dir) runs a forecast, output_dir may be None
+        self.run_forecast = run_forecast
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.job_ids = itertools.count(1)
+        self.worker = threading.Thread(target=self._run_jobs, daemon=True)
+        self.worker.start()
+
+    def submit(self, gdas_data_path, forecast_length, output_dir=None):
+        """Queue a forecast, and return the job."""
+        job_id = str(next(self.job_ids))
+        with self.lock:
+            self.jobs[job_id] = dict(id=job_id, input=gdas_data_path, length=int(forecast_length), output=output_dir, status='queued',
+                                     submitted=time.time(), started=None, finished=None, error=None)
+        self.queue.put(job_id)
+        return self.get(job_id)
+
+    def get(self, job_id):
+        """Return a copy of the job, or None if there is no such job."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def list(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def close(self):
+        """Stop the worker once the queued jobs are done."""
+        self.queue.put(None)
+        self.worker.join()
+
+    def _update(self, job_id, **kwargs):
+        with self.lock:
+            self.jobs[job_id].update(kwargs)
+
+    def _run_jobs(self):
+        while True:
+            job_id = self.queue.get()
+            if job_id is None:
+                return
+            job = self.get(job_id)
+            print(f"job {job_id}: forecasting {job['input']} for {job['length']} steps")
+            self._update(job_id, status='running', started=time.time())
+            try:
+                self.run_forecast(job['input'], job['length'], job['output'])
+            except Exception as e:
+                print(f"job {job_id} failed: {str(e)}")
+                self._update(job_id, status='failed', error=str(e), finished=time.time())
+            else:
+                self._update(job_id, status='done', finished=time.time())
+                job = self.get(job_id)
+                print(f"job {job_id} done in {job['finished'] - job['started']:.1f} seconds")
+
+
+def make_server(jobs, host="127.0.0.1", port=8765):
+    """Return an HTTP server for the jobs (port 0 picks a free port).
+
+    POST /jobs with {"input": ..., "length": ..., "output": ...} queues a forecast, GET /jobs lists the jobs and
+    GET /jobs/<id> returns one, with its status and submitted/started/finished times.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/jobs':
+                return self._reply(404, dict(error=f"unknown path {self.path}"))
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                job = jobs.submit(request['input'], int(request['length']), request.get('output'))
+            except (ValueError, KeyError, TypeError) as e:
+                return self._reply(400, dict(error=f"invalid job: {str(e)}"))
+            self._reply(202, job)
+
+        def do_GET(self):
+            path = self.path.rstrip('/')
+            if path == '/jobs':
+                return self._reply(200, jobs.list())
+            job = jobs.get(path[len('/jobs/'):]) if path.startswith('/jobs/') else None
+            if job is None:
+                return self._reply(404, dict(error=f"unknown path {self.path}"))
+            self._reply(200, job)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+class WarmGraphCastRunner:
+    """Runs forecasts with a GraphCastModel which stays loaded (and compiled after the first forecast)."""
+
+    def __init__(self, pretrained_model_path, output_dir=None, num_pressure_levels=13, graph_cache_dir=None, scan_processor=False, num_writers=1, compilation_cache_dir=None):
+        from run_graphcast import GraphCastModel
+
+        self.output_root = os.getcwd() if output_dir is None else output_dir
+        self.runner = GraphCastModel(pretrained_model_path, None, output_dir, num_pressure_levels, 1, graph_cache_dir, scan_processor, num_writers, compilation_cache_dir)
+        self.runner.load_pretrained_model()
+        self.runner.load_normalization_stats()
+
+    def __call__(self, gdas_data_path, forecast_length, output_dir=None):
+        runner = self.runner
+        runner.gdas_data_path = gdas_data_path
+        runner.forecast_length = forecast_length
+        runner.load_gdas_data()
+
+        # By default, each initialization time gets its own directory, so that jobs don't overwrite each other
+        if output_dir is None:
+            output_dir = os.path.join(self.output_root, runner.dates[0][1].strftime('%Y%m%d%H'))
+        runner.output_dir = os.path.join(output_dir, f"forecasts_{str(runner.num_pressure_levels)}_levels")
+        os.makedirs(runner.output_dir, exist_ok=True)
+        runner.output_dirs = [runner.output_dir]
+
+        runner.extract_inputs_targets_forcings()
+        runner.get_predictions()
+
+    def warm_up(self, gdas_data_path):
+        """Compile the model with a one step forecast, so that the first job runs without compiling."""
+        print(f"warming up with {gdas_data_path}")
+        with tempfile.TemporaryDirectory() as output_dir:
+            self(gdas_data_path, 1, output_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a GraphCast forecast server.")
+    parser.add_argument("-w", "--weights", help="parent directory of the graphcast params and stats", required=True)
+    parser.add_argument("--port", help="local port to listen on", default=8765)
+    parser.add_argument("--warmup", help="GDAS file to compile the model with before accepting jobs", default=None)
+    parser.add_argument("-o", "--output", help="default output directory of the forecasts", default=None)
+    parser.add_argument("-p", "--pressure", help="number of pressure levels", default=13)
+    parser.add_argument("-c", "--cache", help="directory to cache the model graph structures across runs", default=None)
+    parser.add_argument("-s", "--scan", help="run the processor message passing steps in a scan to speed up compilation (yes or no)", default = "no")
+    parser.add_argument("-t", "--writers", help="number of background threads writing grib2 files while the forecast runs", default=1)
+    parser.add_argument("-j", "--jit-cache", help="directory to cache the compiled model across runs", default=None)
+
+    args = parser.parse_args()
+    runner = WarmGraphCastRunner(args.weights, args.output, int(args.pressure), args.cache, args.scan.lower() == "yes", int(args.writers), args.jit_cache)
+    if args.warmup is not None:
+        runner.warm_up(args.warmup)
+
+    jobs = ForecastJobs(runner)
+    server = make_server(jobs, port=int(args.port))
+    print(f"GraphCast forecast server listening on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,90 @@
+'''
+Description: Tests of the GraphCast forecast server and client, with a stand-in for the model
+Usage: cd NCEP && python3 -m unittest forecast_server_test
+Revision history:
+    -20261018: initial code
+'''
+import threading
+import time
+import unittest
+
+from forecast_client import ForecastClient
+from forecast_server import ForecastJobs, make_server
+
+# Run time of a forecast of the stand-in model, per step
+STEP_SECONDS = 0.02
+
+
+class StandInRunner:
+    """Stands in for WarmGraphCastRunner: it is only slow on its first forecast, like a model being compiled."""
+
+    def __init__(self, warm_up_seconds=0.0):
+        self.warm_up_seconds = warm_up_seconds
+        self.calls = []
+
+    def warm_up(self, gdas_data_path):
+        self(gdas_data_path, 1, None)
+
+    def __call__(self, gdas_data_path, forecast_length, output_dir):
+        if not self.calls:
+            time.sleep(self.warm_up_seconds)
+        self.calls.append((gdas_data_path, forecast_length, output_dir))
+        if gdas_data_path.endswith('missing.nc'):
+            raise FileNotFoundError(gdas_data_path)
+        time.sleep(STEP_SECONDS * forecast_length)
+
+
+class ForecastServerTest(unittest.TestCase):
+    def start_server(self, runner):
+        jobs = ForecastJobs(runner)
+        server = make_server(jobs, port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+            jobs.close()
+
+        self.addCleanup(stop)
+        return ForecastClient(f"http://127.0.0.1:{server.server_address[1]}")
+
+    def test_jobs_run_back_to_back_without_warm_up(self):
+        runner = StandInRunner(warm_up_seconds=1.0)
+        runner.warm_up('warmup.nc')
+        client = self.start_server(runner)
+
+        lengths = [4, 2, 8, 1]
+        submitted = [client.submit(f'gdas_{i}.nc', length, f'out_{i}') for i, length in enumerate(lengths)]
+        jobs = [client.wait(job['id'], poll_interval=0.01, timeout=10) for job in submitted]
+
+        self.assertEqual([(f'gdas_{i}.nc', length, f'out_{i}') for i, length in enumerate(lengths)], runner.calls[1:])
+        for job, length in zip(jobs, lengths):
+            self.assertEqual('done', job['status'])
+            # Each job only takes as long as its forecast steps, the warm-up was paid before the first job
+            self.assertLess(job['finished'] - job['started'], STEP_SECONDS * length + 0.5)
+        for previous, job in zip(jobs, jobs[1:]):
+            self.assertGreaterEqual(job['started'], previous['finished'])
+
+    def test_failed_job_does_not_stop_the_server(self):
+        client = self.start_server(StandInRunner())
+
+        failed = client.wait(client.submit('missing.nc', 1)['id'], poll_interval=0.01, timeout=10)
+        done = client.wait(client.submit('gdas.nc', 1)['id'], poll_interval=0.01, timeout=10)
+
+        self.assertEqual('failed', failed['status'])
+        self.assertIn('missing.nc', failed['error'])
+        self.assertEqual('done', done['status'])
+        self.assertEqual(['missing.nc', 'gdas.nc'], [job['input'] for job in client.get()])
+
+    def test_invalid_requests_are_rejected(self):
+        client = self.start_server(StandInRunner())
+
+        with self.assertRaisesRegex(RuntimeError, '400'):
+            client._request('/jobs', dict(length=1))
+        with self.assertRaisesRegex(RuntimeError, '404'):
+            client.get('12345')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+'''
+Description: Benchmark of the methods of gdas_utility.py extracting GraphCast inputs from GDAS grib2 files, on
+             cycles already downloaded (e.g. with gdas_utility.py --keep yes)
+Usage: python3 gdas_extraction_benchmark.py 2023060600 2023060606 -d /directory/to/download -m wgrib2 singlepass
+Revision history:
+    -20261018: initial code
+    -20261018: added the parallel method, the singlepass method with several processes
+'''
+import os
+import argparse
+import tempfile
+from functools import partial
+from time import time
+from datetime import datetime
+
+import numpy as np
+import xarray as xr
+
+from gdas_utility import GFSDataProcessor
+
+
+def run_method(method, start_datetime, end_datetime, num_pressure_levels, download_directory, num_processes):
+    """Extract the inputs with a method, and return the extracted dataset and the time it took."""
+    with tempfile.TemporaryDirectory() as output_directory:
+        data_processor = GFSDataProcessor(start_datetime, end_datetime, num_pressure_levels, output_directory=output_directory,
+                                          download_directory=os.path.abspath(download_directory), keep_downloaded_data=True)
+        process_data = dict(wgrib2=data_processor.process_data_with_wgrib2, pygrib=data_processor.process_data_with_pygrib,
+                            singlepass=data_processor.process_data_with_single_pass,
+                            parallel=partial(data_processor.process_data_with_single_pass, num_processes))[method]
+
+        # wgrib2 writes its intermediate netcdf files in the current directory
+        cwd = os.getcwd()
+        os.chdir(output_directory)
+        try:
+            start = time()
+            process_data()
+            seconds = time() - start
+        finally:
+            os.chdir(cwd)
+
+        output_netcdf, = [os.path.join(output_directory, f) for f in os.listdir(output_directory) if f.endswith('.nc')]
+        return xr.load_dataset(output_netcdf), seconds
+
+
+def max_difference(ds, reference):
+    """Largest absolute difference of each variable, with lat and levels in the same order."""
+    differences = {}
+    for name, reference_variable in reference.data_vars.items():
+        variable = ds[name].sortby([dim for dim in ('lat', 'level') if dim in ds[name].dims])
+        reference_variable = reference_variable.sortby([dim for dim in ('lat', 'level') if dim in reference_variable.dims])
+        differences[name] = float(np.abs(variable.transpose(*reference_variable.dims).values - reference_variable.values).max())
+    return differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the extraction of GraphCast inputs from downloaded GDAS data")
+    parser.add_argument("start_datetime", help="Start datetime in the format 'YYYYMMDDHH'")
+    parser.add_argument("end_datetime", help="End datetime in the format 'YYYYMMDDHH'")
+    parser.add_argument("-d", "--download", help="Download directory of the raw data", required=True)
+    parser.add_argument("-l", "--levels", help="number of pressure levels, options: 13, 37", default="13")
+    parser.add_argument("-m", "--methods", help="methods to compare, the first one is the reference (parallel is singlepass with several processes)",
+                        nargs="+", default=["wgrib2", "singlepass"])
+    parser.add_argument("-p", "--processes", help="number of processes of the parallel method", default=4)
+
+    args = parser.parse_args()
+    start_datetime = datetime.strptime(args.start_datetime, "%Y%m%d%H")
+    end_datetime = datetime.strptime(args.end_datetime, "%Y%m%d%H")
+
+    results = {method: run_method(method, start_datetime, end_datetime, int(args.levels), args.download, int(args.processes)) for method in args.methods}
+
+    reference_method = args.methods[0]
+    reference, reference_seconds = results[reference_method]
+    print(f"{'method':>12} {'seconds':>9} {'speedup':>8} {'max difference':>15}")
+    for method, (ds, seconds) in results.items():
+        difference = max(max_difference(ds, reference).values())
+        print(f"{method:>12} {seconds:>9.2f} {reference_seconds / seconds:>8.2f} {difference:>15.3g}")
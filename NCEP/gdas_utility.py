@@ -10,10 +10,25 @@ Revision history:
     -20240214: Linlin Cui, update pygrib method to account for 37 pressure levels
     -20240221: Sadegh Tabas, (i) updated acc precip variable IC, (ii) initialize s3 credentials for cloud machines, (iii) updated wgrib2 process, pygrib process, s3 and nomads functions
     -20240425: Sadegh Tabas, (i) update s3 bucket resource, 
+    -20261018: added a single pass method, decoding each grib2 file once into preallocated arrays
+    -20261018: added an option to only download the needed grib2 messages, with byte ranges from the .idx inventories
+    -20261018: download the files concurrently, with pooled connections, retries, resumed partial downloads and size/checksum checks
+    -20261018: find the files on NOMADS from their names, and only fall back to the directory listings (once per directory)
+    -20261018: decode the grib2 files of the single pass method in parallel processes, into shared memory
+    -20261018: only retry the downloads after transient errors, and fail fast on missing or forbidden files
+    -20261018: raise the errors of the NOMADS directory listings, rather than caching them as empty listings
+    -20261018: retry finding the files of the cycles like their downloads, skip and resume the byte range downloads
+    -20261018: cancel the decoding of the other grib2 files once one fails, rather than waiting for them
+    -20261018: match precipitation by its field in the wgrib2 method, so it also works with the byte range downloads
 '''
 import os
 import sys
-from time import time
+import bisect
+import hashlib
+import threading
+from time import time, sleep
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 import glob
 import argparse
 import subprocess
@@ -24,13 +39,100 @@ import xarray as xr
 import numpy as np
 from botocore.config import Config
 from botocore import UNSIGNED
+from botocore.exceptions import BotoCoreError, ClientError, ConnectionError as BotoConnectionError, HTTPClientError, IncompleteReadError
 import pygrib
 import requests
 from bs4 import BeautifulSoup
 
+# pygrib short names of the variables on pressure levels
+UPPER_AIR_VARIABLES = {
+    'gh': 'geopotential',
+    't': 'temperature',
+    'q': 'specific_humidity',
+    'w': 'vertical_velocity',
+    'u': 'u_component_of_wind',
+    'v': 'v_component_of_wind',
+}
+
+# Static variables, only extracted from the pgrb2 f000 file of the first cycle
+STATIC_VARIABLES = {
+    ('orog', 'surface', 0): ('geopotential_at_surface', None),
+    ('lsm', 'surface', 0): ('land_sea_mask', None),
+}
+
+# Pressure levels which are in the pgrb2b files rather than in the pgrb2 files
+PGRB2B_LEVELS = [125, 175, 225, 775, 825, 875]
+
+# Names of the variables on pressure levels in the grib2 inventories (.idx)
+UPPER_AIR_INVENTORY_VARIABLES = ['HGT', 'TMP', 'SPFH', 'VVEL', 'UGRD', 'VGRD']
+
+
+class IncompleteDownloadError(IOError):
+    """A download which is incomplete, or whose checksum does not match."""
+
+
+# Errors of downloads which may not happen again: dropped connections, timeouts, and incomplete or corrupted downloads
+TRANSIENT_DOWNLOAD_ERRORS = (IncompleteDownloadError, requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                             BotoConnectionError, HTTPClientError, IncompleteReadError)
+
+
+def is_transient_download_error(error):
+    """Whether a download may succeed when it is tried again: HTTP and S3 errors only for 5xx and 429 (throttling) responses."""
+    if isinstance(error, requests.HTTPError):
+        status = getattr(error.response, 'status_code', 0)
+    elif isinstance(error, ClientError):
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+    else:
+        return isinstance(error, TRANSIENT_DOWNLOAD_ERRORS)
+    return status >= 500 or status == 429
+
+
+def decode_grib2_file(grib2_file, messages, arrays, time_index):
+    """Decode the messages of a grib2 file into arrays, scanning the file once.
+
+    Only the headers of the other messages are read, the first message matching each key is decoded.
+    """
+    print(f"Decoding {len(messages)} messages of {grib2_file}")
+    decoded = set()
+    grbs = pygrib.open(grib2_file)
+    try:
+        for grb in grbs:
+            key = (grb.shortName, grb.typeOfLevel, grb.level)
+            if key not in messages or key in decoded:
+                continue
+            decoded.add(key)
+
+            variable, level_index = messages[key]
+            index = () if key in STATIC_VARIABLES else (time_index,)
+            if level_index is not None:
+                index += (level_index,)
+
+            values = grb.values
+            # Latitudes are ascending in the outputs
+            if grb.latitudeOfFirstGridPointInDegrees > grb.latitudeOfLastGridPointInDegrees:
+                values = values[::-1, :]
+            arrays[variable][index] = values
+    finally:
+        grbs.close()
+
+    missing = set(messages) - decoded
+    if missing:
+        raise ValueError(f"{grib2_file} has no message for {sorted(missing)}")
+
+
+def decode_grib2_file_to_shared_memory(grib2_file, messages, shared_arrays, time_index):
+    """Decode the messages of a grib2 file in a worker process, into arrays in shared memory given as name -> (block name, shape)."""
+    blocks = {variable: shared_memory.SharedMemory(name=name) for variable, (name, _) in shared_arrays.items()}
+    arrays = {variable: np.ndarray(shape, dtype=np.float32, buffer=blocks[variable].buf) for variable, (_, shape) in shared_arrays.items()}
+    # If the decoding fails, its traceback still refers to the arrays, so the blocks are left to be closed once it is freed
+    decode_grib2_file(grib2_file, messages, arrays, time_index)
+    del arrays
+    for block in blocks.values():
+        block.close()
+
 
 class GFSDataProcessor:
-    def __init__(self, start_datetime, end_datetime, num_pressure_levels=13, download_source='nomads', output_directory=None, download_directory=None, keep_downloaded_data=True, aws=None):
+    def __init__(self, start_datetime, end_datetime, num_pressure_levels=13, download_source='nomads', output_directory=None, download_directory=None, keep_downloaded_data=True, aws=None, byte_ranges=False, num_workers=4, max_retries=5):
         self.start_datetime = start_datetime
         self.end_datetime = end_datetime
         self.num_levels = num_pressure_levels
@@ -38,9 +140,28 @@ class GFSDataProcessor:
         self.output_directory = output_directory
         self.download_directory = download_directory
         self.keep_downloaded_data = keep_downloaded_data
-
+        # Only download the needed messages of each grib2 file, instead of the whole file
+        self.byte_ranges = byte_ranges
+        self.nomads_url = 'https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod'
+        # File URLs of the NOMADS directories which were listed, and sizes of the files which were found directly
+        self.nomads_listings = {}
+        self.nomads_listings_lock = threading.Lock()
+        self.nomads_file_sizes = {}
+
+        # Files are downloaded by a pool of threads, failed downloads are retried after 1, 2, 4... seconds
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self.retry_delay = 1.0
+        self.timeout = 60
+        self.chunk_size = 2**20
+
+        # Connections are pooled, and shared by the threads
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=num_workers, pool_maxsize=num_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         if self.download_source == 's3':
-            self.s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
+            self.s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED, max_pool_connections=num_workers))
     
         # Specify the S3 bucket name and root directory
         self.bucket_name = 'noaa-gfs-bdp-pds'
@@ -58,8 +179,15 @@ class GFSDataProcessor:
             self.file_formats = ['pgrb2.0p25.f000', 'pgrb2.0p25.f006'] # , '0p25.f001'
         else:
             self.file_formats = ['pgrb2.0p25.f000', 'pgrb2b.0p25.f000', 'pgrb2.0p25.f006'] # , '0p25.f001'
+
+        if self.num_levels == 13:
+            self.pressure_levels = [50, 100, 150, 200, 250, 300, 400, 500, 600, 700, 850, 925, 1000]
+        else:
+            self.pressure_levels = [1, 2, 3, 5, 7, 10, 20, 30, 50, 70, 100, 125, 150, 175, 200, 225, 250, 300, 350, 400,
+                                    450, 500, 550, 600, 650, 700, 750, 775, 800, 825, 850, 875, 900, 925, 950, 975, 1000]
     
     def s3bucket(self, date_str, time_str, local_directory):
+        """Return the files of a cycle in the S3 bucket, as (key, file format, local file path)."""
         # Construct the S3 prefix for the directory
         s3_prefix = f"{self.root_directory}.{date_str}/{time_str}/"
 
@@ -80,26 +208,25 @@ class GFSDataProcessor:
         def get_data(s3_prefix, file_format, local_directory):
             # List objects in the S3 directory
             s3_objects = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix=s3_prefix)
+            files = []
             for obj in s3_objects.get('Contents', []):
                 obj_key = obj['Key']
                 if obj_key.endswith(f'.{file_format}'):
                     # Define the local file path
                     local_file_path = os.path.join(local_directory, os.path.basename(obj_key))
+                    files.append((obj_key, file_format, local_file_path))
+            return files
 
-                    # Download the file from S3 to the local path
-                    self.s3.download_file(self.bucket_name, obj_key, local_file_path)
-                    print(f"Downloaded {obj_key} to {local_file_path}")
-
-                 
+        files = []
         for file_format in self.file_formats:
             if file_format !='pgrb2.0p25.f006':
-                get_data(s3_prefix, file_format, local_directory)
+                files += get_data(s3_prefix, file_format, local_directory)
             else:
-                get_data(s3_prefix_precip, file_format, local_directory)
+                files += get_data(s3_prefix_precip, file_format, local_directory)
+        return files
 
-        
-    
     def nomads(self, date_str, time_str, local_directory):
+        """Return the files of a cycle on NOMADS, as (url, file format, local file path)."""
 
         # Convert date_str and time_str to datetime object
         datetime_obj = datetime.strptime(date_str + time_str, "%Y%m%d%H")
@@ -113,71 +240,280 @@ class GFSDataProcessor:
         
         def get_data(date_str, time_str, file_format, local_directory):
             # Construct the URL for the data directory
-            gdas_url = f"https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod/{self.root_directory}.{date_str}/{time_str}/atmos/"
-            
-            # Get the list of files from the URL
-            response = requests.get(gdas_url)
-            if response.status_code == 200:
-                # Parse the HTML content using BeautifulSoup
-                soup = BeautifulSoup(response.content, 'html.parser')
-                
-                # Find all anchor tags (links) in the HTML
-                anchor_tags = soup.find_all('a')
-                
-                # Extract file URLs from href attributes of anchor tags
-                file_urls = [gdas_url + tag['href'] for tag in anchor_tags if tag.get('href')]
-    
-                for file_url in file_urls: 
-                    
-                    if file_url.endswith(f'.{file_format}'):
-                        
-                        # Define the local file path
-                        local_file_path = os.path.join(local_directory, os.path.basename(file_url))
-                        
-                        # Download the file from S3 to the local path
-                        try:
-                            # Run the wget command
-                            subprocess.run(['wget', file_url, '-O', local_file_path], check=True)
-                            print(f"Download completed: {file_url} => {local_file_path}")
-                        except subprocess.CalledProcessError as e:
-                            print(f"Error downloading {file_url}: {e}")
+            gdas_url = f"{self.nomads_url}/{self.root_directory}.{date_str}/{time_str}/atmos/"
+
+            # File names are known, the directory is only listed if the file is not found with its name
+            file_url = f"{gdas_url}{self.root_directory}.t{time_str}z.{file_format}"
+            response = self.session.head(file_url, timeout=self.timeout)
+            if response.status_code == 200 and 'Content-Length' in response.headers:
+                self.nomads_file_sizes[file_url] = int(response.headers['Content-Length'])
+                file_urls = [file_url]
+            else:
+                print(f"{file_url} is not found ({response.status_code}), looking for it in the listing of {gdas_url}")
+                file_urls = self.list_nomads_directory(gdas_url)
+
+            files = []
+            for file_url in file_urls:
 
+                if file_url.endswith(f'.{file_format}'):
+
+                    # Define the local file path
+                    local_file_path = os.path.join(local_directory, os.path.basename(file_url))
+                    files.append((file_url, file_format, local_file_path))
+            return files
+
+        files = []
         for file_format in self.file_formats:
             if file_format !='pgrb2.0p25.f006':
-                get_data(date_str, time_str, file_format, local_directory)
+                files += get_data(date_str, time_str, file_format, local_directory)
             else:
-                get_data(date_str_precip, time_str_precip, file_format, local_directory)
+                files += get_data(date_str_precip, time_str_precip, file_format, local_directory)
+        return files
 
+    def list_nomads_directory(self, gdas_url):
+        """Return the file URLs of a NOMADS directory, which is only listed once it is listed successfully."""
+        with self.nomads_listings_lock:
+            if gdas_url not in self.nomads_listings:
+                # Get the list of files from the URL, errors (e.g. 503 or 429 when rate limited) are raised rather than cached
+                response = self.session.get(gdas_url, timeout=self.timeout)
+                response.raise_for_status()
 
-    
-        
-    def download_data(self):
-        # Calculate the number of 6-hour intervals
-        delta = (self.end_datetime - self.start_datetime)
-        total_intervals = int(delta.total_seconds() / 3600 / 6)  # 6 hours per interval
+                # Parse the HTML content using BeautifulSoup
+                soup = BeautifulSoup(response.content, 'html.parser')
+
+                # Extract file URLs from href attributes of anchor tags
+                self.nomads_listings[gdas_url] = [gdas_url + tag['href'] for tag in soup.find_all('a') if tag.get('href')]
+            return self.nomads_listings[gdas_url]
 
-        # Loop through the 6-hour intervals
+    def get_inventory_messages(self, file_format):
+        """Return the messages needed from a file, as the (variable, level) of their lines in its .idx inventory."""
+        if file_format == 'pgrb2.0p25.f006':
+            return {('LAND', 'surface'), ('APCP', 'surface')}
+
+        if file_format == 'pgrb2b.0p25.f000':
+            levels = [level for level in self.pressure_levels if level in PGRB2B_LEVELS]
+            messages = set()
+        else:
+            levels = [level for level in self.pressure_levels if level not in PGRB2B_LEVELS]
+            messages = {('HGT', 'surface'), ('LAND', 'surface'), ('TMP', '2 m above ground'), ('PRMSL', 'mean sea level'),
+                        ('UGRD', '10 m above ground'), ('VGRD', '10 m above ground')}
+        for variable in UPPER_AIR_INVENTORY_VARIABLES:
+            messages.update((variable, f'{level} mb') for level in levels)
+        return messages
+
+    def get_byte_ranges(self, inventory, file_format):
+        """Return the byte ranges of the messages needed from a file, from its .idx inventory.
+
+        Ranges of consecutive messages are merged, and are formatted for the Range header of HTTP and S3 requests.
+        """
+        # Inventory lines are 'number:offset:d=yyyymmddhh:variable:level:forecast:', sub-messages share their offset
+        lines = [line.split(':') for line in inventory.splitlines() if line.strip()]
+        offsets = sorted({int(fields[1]) for fields in lines})
+
+        needed = self.get_inventory_messages(file_format)
+        found = set()
+        ranges = []
+        for fields in lines:
+            message = (fields[3], fields[4])
+            if message not in needed:
+                continue
+            found.add(message)
+            start = int(fields[1])
+            # The message ends where the next one starts, the last message ends with the file
+            next_offset = bisect.bisect_right(offsets, start)
+            end = offsets[next_offset] - 1 if next_offset < len(offsets) else None
+            if ranges and ranges[-1][1] is not None and ranges[-1][1] + 1 >= start:
+                ranges[-1] = (ranges[-1][0], end)
+            elif not ranges or ranges[-1] != (start, end):
+                ranges.append((start, end))
+
+        missing = needed - found
+        if missing:
+            raise ValueError(f"The {file_format} inventory has no message for {sorted(missing)}")
+        return [f"bytes={start}-{'' if end is None else end}" for start, end in ranges]
+
+    def get_remote_file(self, source):
+        """Return the size of a file (S3 key or URL), and its md5 checksum if it is known."""
+        if self.download_source == 's3':
+            head = self.s3.head_object(Bucket=self.bucket_name, Key=source)
+            # The ETag of an object is its md5 checksum, unless it was uploaded in parts
+            etag = head['ETag'].strip('"')
+            return head['ContentLength'], None if '-' in etag else etag
+        # Sizes of the files found directly are known, but are only used once, so that retries check the size again
+        if source in self.nomads_file_sizes:
+            return self.nomads_file_sizes.pop(source), None
+        response = self.session.head(source, timeout=self.timeout)
+        response.raise_for_status()
+        return int(response.headers['Content-Length']), None
+
+    def read_remote_file(self, source, byte_range=None):
+        """Yield the chunks of a file (S3 key or URL), or of a byte range of it."""
+        if self.download_source == 's3':
+            kwargs = {} if byte_range is None else dict(Range=byte_range)
+            yield from self.s3.get_object(Bucket=self.bucket_name, Key=source, **kwargs)['Body'].iter_chunks(self.chunk_size)
+            return
+        headers = {} if byte_range is None else {'Range': byte_range}
+        with self.session.get(source, headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            if byte_range is not None and response.status_code != 206:
+                raise ValueError(f"{source} does not support byte ranges")
+            yield from response.iter_content(self.chunk_size)
+
+    def download_whole_file(self, source, local_file_path):
+        """Download a file, resuming from a partial download, and verify its size and checksum. Return the number of bytes downloaded."""
+        size, md5 = self.get_remote_file(source)
+        if os.path.exists(local_file_path) and os.path.getsize(local_file_path) == size:
+            print(f"{local_file_path} is already downloaded")
+            return 0
+
+        # Files are downloaded to a .part file, which is only renamed once complete
+        part_path = f'{local_file_path}.part'
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset > size:
+            offset = 0
+        if offset < size or offset == 0:
+            if offset:
+                print(f"Resuming {source} from {offset / 2**20:.1f} MB")
+            try:
+                with open(part_path, 'ab' if offset else 'wb') as f:
+                    for chunk in self.read_remote_file(source, f'bytes={offset}-' if offset else None):
+                        f.write(chunk)
+            except ValueError:
+                os.remove(part_path)
+                raise IncompleteDownloadError(f"{source} can not be resumed, it is downloaded again")
+
+        if os.path.getsize(part_path) != size:
+            raise IncompleteDownloadError(f"{source} is {size} bytes, but {os.path.getsize(part_path)} were downloaded")
+        if md5 is not None:
+            checksum = hashlib.md5()
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**20), b''):
+                    checksum.update(chunk)
+            if checksum.hexdigest() != md5:
+                os.remove(part_path)
+                raise IncompleteDownloadError(f"The md5 checksum of {source} does not match, it is downloaded again")
+        os.replace(part_path, local_file_path)
+        return size - offset
+
+    def get_trimmed_size(self, source, byte_ranges):
+        """Return the size of the grib2 file of the byte ranges of a file, the size of the file is only needed for a last range to its end."""
+        size = 0
+        for byte_range in byte_ranges:
+            start, end = byte_range[len('bytes='):].split('-')
+            size += (int(end) if end else self.get_remote_file(source)[0] - 1) - int(start) + 1
+        return size
+
+    def download_needed_messages(self, source, file_format, local_file_path):
+        """Download the byte ranges of the needed messages of a file, one after the other, which makes a grib2 file of only these messages.
+
+        A partial download is resumed after the bytes already written. Return the number of bytes downloaded.
+        """
+        inventory = b''.join(self.read_remote_file(f'{source}.idx')).decode()
+        byte_ranges = self.get_byte_ranges(inventory, file_format)
+        if os.path.exists(local_file_path) and os.path.getsize(local_file_path) == self.get_trimmed_size(source, byte_ranges):
+            print(f"{local_file_path} is already downloaded")
+            return 0
+
+        # The ranges are written one after the other, so the bytes of a partial download are the first bytes of the ranges
+        part_path = f'{local_file_path}.part'
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset:
+            print(f"Resuming {source} from {offset / 2**20:.1f} MB of its byte ranges")
+        num_bytes = 0
+        written = 0
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for byte_range in byte_ranges:
+                start, end = byte_range[len('bytes='):].split('-')
+                size = int(end) - int(start) + 1 if end else None
+                if size is not None and written + size <= offset:
+                    written += size
+                    continue
+                skipped = max(offset - written, 0)
+                range_bytes = sum(f.write(chunk) for chunk in self.read_remote_file(source, f'bytes={int(start) + skipped}-{end}'))
+                if size is not None and skipped + range_bytes != size:
+                    if skipped + range_bytes > size:
+                        f.close()
+                        os.remove(part_path)
+                    raise IncompleteDownloadError(f"{byte_range} of {source} is {size} bytes, but {skipped + range_bytes} were downloaded")
+                written += skipped + range_bytes
+                num_bytes += range_bytes
+        os.replace(part_path, local_file_path)
+        print(f"Downloaded {num_bytes / 2**20:.1f} MB in {len(byte_ranges)} byte ranges to {local_file_path}")
+        return num_bytes
+
+    def with_retries(self, description, function, *args):
+        """Call function(*args), retrying transient errors with an exponential backoff. Return its result and the number of attempts."""
+        for attempt in range(1, self.max_retries + 2):
+            try:
+                return function(*args), attempt
+            except (IOError, BotoCoreError, ClientError) as e:
+                # Missing or forbidden files (e.g. 404, 403, NoSuchKey) are not there on the next attempt either
+                if attempt > self.max_retries or not is_transient_download_error(e):
+                    raise
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                print(f"Error {description} (attempt {attempt}): {str(e)}, retrying in {delay:.1f} seconds")
+                sleep(delay)
+
+    def download_file(self, source, file_format, local_file_path):
+        """Download a file, retrying transient errors with an exponential backoff. Return the number of bytes downloaded and the time it took."""
+        start = time()
+        if self.byte_ranges:
+            num_bytes, attempt = self.with_retries(f"downloading {source}", self.download_needed_messages, source, file_format, local_file_path)
+        else:
+            num_bytes, attempt = self.with_retries(f"downloading {source}", self.download_whole_file, source, local_file_path)
+        seconds = time() - start
+        print(f"Download completed: {source} => {local_file_path}, {num_bytes / 2**20:.1f} MB in {seconds:.1f} seconds "
+              f"({num_bytes / 2**20 / max(seconds, 1e-6):.1f} MB/s, {attempt} attempt(s))")
+        return num_bytes, seconds
+
+    def download_data(self):
+        # Find the files of each 6-hour cycle, and create their local directories
+        cycles = []
         current_datetime = self.start_datetime
         while current_datetime <= self.end_datetime:
             date_str = current_datetime.strftime("%Y%m%d")
             time_str = current_datetime.strftime("%H")
-            
+
             # Define the local directory path where the file will be saved
             local_directory = os.path.join(self.local_base_directory, date_str, time_str)
-
-            # Create the local directory if it doesn't exist
             os.makedirs(local_directory, exist_ok=True)
-            
-            if self.download_source == 's3':
-                self.s3bucket(date_str, time_str, local_directory)
-            else:
-                self.nomads(date_str, time_str, local_directory)
-                
-            
+            cycles.append((date_str, time_str, local_directory))
 
             # Move to the next 6-hour interval
             current_datetime += timedelta(hours=6)
 
+        find_files = self.s3bucket if self.download_source == 's3' else self.nomads
+
+        # Cycles are listed, and files downloaded, concurrently on a bounded pool of threads sharing their connections
+        start = time()
+        failures = []
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            # Finding the files of a cycle is retried like their downloads, a cycle whose files are not found is reported with them
+            find_futures = [(executor.submit(self.with_retries, f"finding the files of {date_str}{time_str}", find_files, date_str, time_str, local_directory),
+                             f"{date_str}{time_str}") for date_str, time_str, local_directory in cycles]
+            files = []
+            for future, cycle in find_futures:
+                try:
+                    files += future.result()[0]
+                except Exception as e:
+                    print(f"Error finding the files of {cycle}: {str(e)}")
+                    failures.append(f"the files of {cycle}")
+            futures = {executor.submit(self.download_file, *file): file for file in files}
+            num_bytes = 0
+            num_files = 0
+            for future in as_completed(futures):
+                try:
+                    num_bytes += future.result()[0]
+                    num_files += 1
+                except Exception as e:
+                    print(f"Error downloading {futures[future][0]}: {str(e)}")
+                    failures.append(futures[future][0])
+
+        seconds = time() - start
+        print(f"Downloaded {num_files} files, {num_bytes / 2**20:.1f} MB in {seconds:.1f} seconds "
+              f"({num_bytes / 2**20 / max(seconds, 1e-6):.1f} MB/s)")
+        if failures:
+            raise IOError(f"Failed to download {len(failures)} files: {', '.join(failures)}")
         print("Download completed.")
 
     def process_data_with_wgrib2(self):
@@ -209,7 +545,9 @@ class GFSDataProcessor:
                     'levels': [':surface:'],
                     'first_time_step_only': True,  # Extract only the first time step
                 },
-                '^(597):': {  # APCP
+                # Precipitation is matched by its field rather than its message number, which changes in the files of
+                # the byte range downloads. The accumulations of the f006 files are over the same 6 hours
+                ':APCP:surface:0-6 hour acc fcst:': {
                     'levels': [':surface:'],
                 },
             }
@@ -273,7 +611,7 @@ class GFSDataProcessor:
                                 # Open the extracted netcdf file as an xarray dataset
                                 ds = xr.open_dataset(output_file)
 
-                                # if variable == '^(597):':
+                                # if variable == ':APCP:surface:0-6 hour acc fcst:':
                                 #    ds['time'] = ds['time'] - np.timedelta64(6, 'h')
 
                                 # If specified, extract only the first time step
@@ -422,6 +760,10 @@ class GFSDataProcessor:
 
                     mergeDAs = []
 
+                    # pgrb2b is only opened once per cycle
+                    if self.num_levels == 37:
+                        grbs2b = pygrib.open(os.path.join(subfolder_path, f'gdas.t{hour}z{file_extension_2b}'))
+
                     for file_extension, variables in variables_to_extract.items():
                         pattern = os.path.join(subfolder_path, f'gdas.t*z{file_extension}')
                         # Use glob to search for files matching the pattern
@@ -450,8 +792,6 @@ class GFSDataProcessor:
 
                                 #extract variables from pgrb2b
                                 if (levelType == 'isobaricInhPa') & (self.num_levels == 37):
-                                    fname2b = os.path.join(subfolder_path, f'gdas.t{hour}z{file_extension_2b}')
-                                    grbs2b = pygrib.open(fname2b)
                                     da_extra = self.get_dataarray(grbs2b, var_name, levelType, extra_levels)
                                     da_combined = da.combine_first(da_extra) 
                                     mergeDAs.append(da_combined)
@@ -531,6 +871,164 @@ class GFSDataProcessor:
 
         print(f"Process completed successfully, your inputs for GraphCast model generated at:\n {output_netcdf}")
             
+    def get_messages_to_extract(self):
+        """Return the grib2 messages needed from each file, as (shortName, typeOfLevel, level) -> (variable, level index)."""
+        messages = {
+            '.pgrb2.0p25.f000': {
+                ('2t', 'heightAboveGround', 2): ('2m_temperature', None),
+                ('prmsl', 'meanSea', 0): ('mean_sea_level_pressure', None),
+                ('10u', 'heightAboveGround', 10): ('10m_u_component_of_wind', None),
+                ('10v', 'heightAboveGround', 10): ('10m_v_component_of_wind', None),
+            },
+            '.pgrb2.0p25.f006': {
+                ('tp', 'surface', 0): ('total_precipitation_6hr', None),
+            },
+        }
+        if self.num_levels == 37:
+            messages['.pgrb2b.0p25.f000'] = {}
+
+        for level_index, level in enumerate(self.pressure_levels):
+            file_extension = '.pgrb2b.0p25.f000' if level in PGRB2B_LEVELS else '.pgrb2.0p25.f000'
+            for short_name, variable in UPPER_AIR_VARIABLES.items():
+                messages[file_extension][(short_name, 'isobaricInhPa', level)] = (variable, level_index)
+        return messages
+
+    def process_data_with_single_pass(self, num_processes=1):
+        # Define the directory where your GRIB2 files are located
+        data_directory = self.local_base_directory
+
+        # Find the cycles, their valid time is the one of all their variables (precipitation is accumulated up to it)
+        cycles = []
+        date_folders = sorted(next(os.walk(data_directory))[1])
+        for date_folder in date_folders:
+            for hour in ['00', '06', '12', '18']:
+                subfolder_path = os.path.join(data_directory, date_folder, hour)
+                if os.path.exists(subfolder_path):
+                    cycles.append((datetime.strptime(date_folder + hour, "%Y%m%d%H"), subfolder_path))
+
+        messages = self.get_messages_to_extract()
+        lats, lons = self.get_grid(self.find_grib2_file(cycles[0][1], '.pgrb2.0p25.f000'))
+
+        # Shapes of the outputs, every message is decoded straight into them
+        grid_shape = (len(lats), len(lons))
+        shapes = {variable: grid_shape for variable, _ in STATIC_VARIABLES.values()}
+        for file_messages in messages.values():
+            for variable, level_index in file_messages.values():
+                if variable not in shapes:
+                    shapes[variable] = (len(cycles),) + grid_shape if level_index is None else (len(cycles), len(self.pressure_levels)) + grid_shape
+
+        # Each file is decoded on its own, the static variables from the pgrb2 file of the first cycle
+        files = []
+        for time_index, (_, subfolder_path) in enumerate(cycles):
+            for file_extension, file_messages in messages.items():
+                if time_index == 0 and file_extension == '.pgrb2.0p25.f000':
+                    file_messages = {**file_messages, **STATIC_VARIABLES}
+                files.append((self.find_grib2_file(subfolder_path, file_extension), file_messages, time_index))
+        times = [cycle_time for cycle_time, _ in cycles]
+
+        print("Start extracting variables and associated levels from grib2 files:")
+        if num_processes == 1:
+            arrays = {variable: np.empty(shape, dtype=np.float32) for variable, shape in shapes.items()}
+            for grib2_file, file_messages, time_index in files:
+                decode_grib2_file(grib2_file, file_messages, arrays, time_index)
+            return self.write_dataset(arrays, times, lats, lons)
+
+        # Files are decoded by a pool of processes, into the outputs in shared memory
+        blocks = {variable: shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 4) for variable, shape in shapes.items()}
+        try:
+            shared_arrays = {variable: (blocks[variable].name, shape) for variable, shape in shapes.items()}
+            with ProcessPoolExecutor(max_workers=num_processes) as executor:
+                futures = [executor.submit(decode_grib2_file_to_shared_memory, grib2_file, file_messages, shared_arrays, time_index)
+                           for grib2_file, file_messages, time_index in files]
+                # On the first failure, the files not yet decoded are cancelled rather than waited for
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise
+
+            # The outputs are copied out of shared memory one at a time, and each block is released right away, so no view of a
+            # block outlives it (e.g. in the traceback of an error writing the dataset)
+            arrays = {}
+            for variable, shape in shapes.items():
+                arrays[variable] = np.ndarray(shape, dtype=np.float32, buffer=blocks[variable].buf).copy()
+                block = blocks.pop(variable)
+                block.close()
+                block.unlink()
+        finally:
+            for block in blocks.values():
+                block.close()
+                block.unlink()
+        return self.write_dataset(arrays, times, lats, lons)
+
+    def find_grib2_file(self, subfolder_path, file_extension):
+        matching_files = glob.glob(os.path.join(subfolder_path, f'gdas.t*z{file_extension}'))
+        if len(matching_files) != 1:
+            raise FileNotFoundError(f"Found multiple or no gdas.t*z{file_extension} files in {subfolder_path}")
+        return matching_files[0]
+
+    def get_grid(self, grib2_file):
+        """Return the latitudes (ascending) and longitudes of the grid of a grib2 file, from its first message."""
+        grbs = pygrib.open(grib2_file)
+        try:
+            lats, lons = grbs.message(1).latlons()
+        finally:
+            grbs.close()
+        return np.sort(lats[:, 0]), lons[0, :]
+
+    def write_dataset(self, arrays, times, lats, lons):
+        """Save the extracted variables as GraphCast inputs, from arrays of float32 in (time, level, lat, lon) order."""
+        print("Processing and saving the data")
+        static_variables = [variable for variable, _ in STATIC_VARIABLES.values()]
+
+        # Update geopotential unit to m2/s2 by multiplying 9.80665
+        arrays['geopotential_at_surface'] *= 9.80665
+        arrays['geopotential'] *= 9.80665
+
+        # Update total_precipitation_6hr unit to (m) from (kg/m^2) by dividing it by 1000kg/m³
+        arrays['total_precipitation_6hr'] /= 1000
+
+        data_vars = {}
+        for variable, array in arrays.items():
+            if variable in static_variables:
+                data_vars[variable] = (['lat', 'lon'], array)
+            elif array.ndim == 3:
+                data_vars[variable] = (['batch', 'time', 'lat', 'lon'], array[np.newaxis])
+            else:
+                data_vars[variable] = (['batch', 'time', 'level', 'lat', 'lon'], array[np.newaxis])
+
+        # Time values are relative to the first time step, and datetime has the actual times
+        times = np.array(times, dtype='datetime64[ns]')
+        ds = xr.Dataset(
+            data_vars=data_vars,
+            coords={
+                'lon': lons.astype('float32'),
+                'lat': lats.astype('float32'),
+                'level': np.array(self.pressure_levels, dtype='int32'),
+                'time': times - times[0],
+                'datetime': (['batch', 'time'], times[np.newaxis]),
+            }
+        )
+
+        # Define the output NetCDF file
+        date = (self.start_datetime + timedelta(hours=6)).strftime('%Y%m%d%H')
+        steps = str(len(ds['time']))
+
+        if self.output_directory is None:
+            self.output_directory = os.getcwd()  # Use current directory if not specified
+        output_netcdf = os.path.join(self.output_directory, f"source-gdas_date-{date}_res-0.25_levels-{self.num_levels}_steps-{steps}.nc")
+
+        ds.to_netcdf(output_netcdf)
+        ds.close()
+
+        # Optionally, remove downloaded data
+        if not self.keep_downloaded_data:
+            self.remove_downloaded_data()
+
+        print(f"Process completed successfully, your inputs for GraphCast model generated at:\n {output_netcdf}")
+        return output_netcdf
+
     def remove_downloaded_data(self):
         # Remove downloaded data from the specified directory
         print("Removing downloaded grib2 data...")
@@ -605,11 +1103,15 @@ if __name__ == "__main__":
     parser.add_argument("start_datetime", help="Start datetime in the format 'YYYYMMDDHH'")
     parser.add_argument("end_datetime", help="End datetime in the format 'YYYYMMDDHH'")
     parser.add_argument("-l", "--levels", help="number of pressure levels, options: 13, 37", default="13")
-    parser.add_argument("-m", "--method", help="method to extact variables from grib2, options: wgrib2, pygrib", default="wgrib2")
+    parser.add_argument("-m", "--method", help="method to extact variables from grib2, options: wgrib2, pygrib, singlepass", default="wgrib2")
     parser.add_argument("-s", "--source", help="the source repository to download gdas grib2 data, options: nomads (up-to-date), s3", default="s3")
     parser.add_argument("-o", "--output", help="Output directory for processed data")
     parser.add_argument("-d", "--download", help="Download directory for raw data")
     parser.add_argument("-k", "--keep", help="Keep downloaded data (yes or no)", default="no")
+    parser.add_argument("-r", "--ranges", help="Only download the needed grib2 messages, with byte ranges from the .idx inventories (yes or no)", default="no")
+    parser.add_argument("-w", "--workers", help="number of files downloaded concurrently", default=4)
+    parser.add_argument("-p", "--processes", help="number of processes decoding grib2 files in parallel, with the singlepass method", default=1)
+    parser.add_argument("--retries", help="number of times a failed download is retried", default=5)
 
     args = parser.parse_args()
 
@@ -621,14 +1123,23 @@ if __name__ == "__main__":
     output_directory = args.output
     download_directory = args.download
     keep_downloaded_data = args.keep.lower() == "yes"
-
-    data_processor = GFSDataProcessor(start_datetime, end_datetime, num_pressure_levels, download_source, output_directory, download_directory, keep_downloaded_data)
+    byte_ranges = args.ranges.lower() == "yes"
+    num_processes = int(args.processes)
+    if num_processes < 1:
+        parser.error("--processes must be at least 1")
+    if num_processes > 1 and method != "singlepass":
+        parser.error(f"--processes > 1 is only supported by the singlepass method, not {method}")
+
+    data_processor = GFSDataProcessor(start_datetime, end_datetime, num_pressure_levels, download_source, output_directory, download_directory, keep_downloaded_data, byte_ranges=byte_ranges,
+                                      num_workers=int(args.workers), max_retries=int(args.retries))
     data_processor.download_data()
     
     if method == "wgrib2":
       data_processor.process_data_with_wgrib2()
     elif method == "pygrib":
       data_processor.process_data_with_pygrib()
+    elif method == "singlepass":
+      data_processor.process_data_with_single_pass(num_processes)
     else:
       raise NotImplementedError(f"Method {method} is not supported!")
 
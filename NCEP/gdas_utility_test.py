@@ -0,0 +1,649 @@
+'''
+Description: Tests of the GDAS downloads of gdas_utility.py, against a local server standing in for NOMADS and an in-memory S3 bucket,
+             and of the extraction of the GraphCast inputs, from small synthetic grib2 files
+Usage: cd NCEP && python3 -m unittest gdas_utility_test
+Revision history:
+    -20261018: initial code
+    -20261018: tests of the concurrent downloads, with retries and resumed downloads
+    -20261018: tests of finding the files on NOMADS without the directory listings
+    -20261018: tests of failing fast on missing files, and of the errors of the NOMADS directory listings
+    -20261018: tests of retrying to find the files, and of resuming and skipping the byte range downloads
+    -20261018: tests of the single pass method, against the pygrib method
+    -20261018: tests of the single pass method with several processes, against a single one
+    -20261018: test of cancelling the decoding of the other files after an error
+'''
+import glob
+import io
+import os
+import re
+import struct
+import hashlib
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import numpy as np
+import xarray as xr
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+import gdas_utility
+from gdas_utility import GFSDataProcessor, PGRB2B_LEVELS
+
+CYCLE = datetime(2023, 6, 6, 0)
+
+
+def make_grib2_file(messages):
+    """Return the bytes of a stand-in grib2 file of the messages (variable, level), and its .idx inventory."""
+    data = b''
+    inventory = ''
+    for number, (variable, level) in enumerate(messages, 1):
+        inventory += f'{number}:{len(data)}:d=2023060600:{variable}:{level}:anl:\n'
+        data += b'GRIB' + f'{variable}:{level}'.encode().ljust(60 + 7 * number, b'.') + b'7777'
+    return data, inventory
+
+
+def get_messages(data, inventory, messages):
+    """Return the bytes of the given messages of a stand-in grib2 file, in file order."""
+    offsets = [int(line.split(':')[1]) for line in inventory.splitlines()] + [len(data)]
+    selected = b''
+    for i, line in enumerate(inventory.splitlines()):
+        if tuple(line.split(':')[3:5]) in messages:
+            selected += data[offsets[i]:offsets[i + 1]]
+    return selected
+
+
+def get_remote_path(cycle, file_format):
+    """Return the path of a file on NOMADS and S3: precipitation comes from the previous cycle."""
+    if file_format == 'pgrb2.0p25.f006':
+        cycle -= timedelta(hours=6)
+    return f'gdas.{cycle:%Y%m%d}/{cycle:%H}/atmos/gdas.t{cycle:%H}z.{file_format}'
+
+
+def signed(value, num_bytes):
+    """Return the bytes of a signed integer of grib2, in sign and magnitude."""
+    return (abs(value) | (1 << (8 * num_bytes - 1) if value < 0 else 0)).to_bytes(num_bytes, 'big')
+
+
+def make_grib2_message(values, lats, lons, date, parameter, level_type, level, forecast_hours=0, accumulated=False):
+    """Return the bytes of a grib2 message of values on a regular lat/lon grid, with simple packing.
+
+    parameter is (discipline, category, number), level_type and level are those of the first fixed surface. Accumulated
+    messages are accumulated over the forecast_hours after date.
+    """
+    discipline, category, number = parameter
+    num_lats, num_lons = values.shape
+    identification = struct.pack('>IBHHBBBHBBBBBBB', 21, 1, 7, 0, 2, 1, 1, date.year, date.month, date.day, date.hour, 0, 0, 0, 1)
+
+    grid = bytes([6, 0]) + bytes(4) + bytes(1) + bytes(4) + bytes(1) + bytes(4) + struct.pack('>IIII', num_lons, num_lats, 0, 0)
+    grid += signed(round(lats[0] * 1e6), 4) + signed(round(lons[0] * 1e6), 4) + bytes([48])
+    grid += signed(round(lats[-1] * 1e6), 4) + signed(round(lons[-1] * 1e6), 4)
+    grid += struct.pack('>IIB', round(abs(lons[1] - lons[0]) * 1e6), round(abs(lats[1] - lats[0]) * 1e6), 0)
+    grid = struct.pack('>IBBIBBH', 14 + len(grid), 3, 0, values.size, 0, 0, 0) + grid
+
+    product = struct.pack('>BBBBBHBBI', category, number, 2, 0, 0, 0, 0, 1, 0 if accumulated else forecast_hours)
+    product += struct.pack('>BBIBBI', level_type, 0, level, 255, 0, 0)
+    if accumulated:
+        end = date + timedelta(hours=forecast_hours)
+        product += struct.pack('>HBBBBBBI', end.year, end.month, end.day, end.hour, 0, 0, 1, 0)
+        product += struct.pack('>BBBIBI', 1, 2, 1, forecast_hours, 1, 0)
+    product = struct.pack('>IBHH', 9 + len(product), 4, 0, 8 if accumulated else 0) + product
+
+    # 32 bit integers, in steps of 2**-6 from the minimum
+    binary_scale = -6
+    reference = np.float32(values.min())
+    packed = np.round((values.astype(np.float64) - reference) * 2.0 ** -binary_scale).astype('>u4').tobytes()
+    representation = struct.pack('>IBIHf', 21, 5, values.size, 0, reference) + signed(binary_scale, 2) + struct.pack('>hBB', 0, 32, 0)
+
+    body = (identification + grid + product + representation + struct.pack('>IBB', 6, 6, 255)
+            + struct.pack('>IB', 5 + len(packed), 7) + packed + b'7777')
+    return b'GRIB' + bytes([0, 0, discipline, 2]) + struct.pack('>Q', 16 + len(body)) + body
+
+
+# grib2 parameters (discipline, category, number) of the variables on pressure levels, in the order of UPPER_AIR_VARIABLES
+UPPER_AIR_PARAMETERS = [(0, 3, 5), (0, 0, 0), (0, 1, 0), (0, 2, 8), (0, 2, 2), (0, 2, 3)]
+
+ALL_PRESSURE_LEVELS = [1, 2, 3, 5, 7, 10, 20, 30, 50, 70, 100, 125, 150, 175, 200, 225, 250, 300, 350, 400,
+                       450, 500, 550, 600, 650, 700, 750, 775, 800, 825, 850, 875, 900, 925, 950, 975, 1000]
+
+
+def write_gdas_cycles(directory, num_cycles, skip=()):
+    """Write synthetic grib2 files of GDAS cycles from CYCLE, in the layout of the downloaded files, on a 9x16 grid.
+
+    The files have the messages of the 37 pressure levels, and messages which are not needed around them. The messages
+    of skip, as (discipline, category, number), are left out.
+    """
+    rng = np.random.default_rng(0)
+    lats = np.linspace(90, -90, 9)
+    lons = np.arange(16) * 22.5
+
+    def message(date, parameter, level_type, level, **kwargs):
+        if parameter in skip:
+            return b''
+        values = rng.normal(size=(len(lats), len(lons))) * 10 + 100
+        return make_grib2_message(values, lats, lons, date, parameter, level_type, level, **kwargs)
+
+    for i in range(num_cycles):
+        cycle = CYCLE + timedelta(hours=6 * i)
+        previous_cycle = cycle - timedelta(hours=6)
+        pgrb2 = [
+            message(cycle, (0, 19, 0), 1, 0),  # visibility, not needed
+            message(cycle, (0, 0, 0), 103, 2),
+            message(cycle, (0, 3, 1), 101, 0),
+            message(cycle, (0, 2, 2), 103, 10),
+            message(cycle, (0, 2, 3), 103, 10),
+            message(cycle, (0, 3, 5), 1, 0),
+            message(cycle, (2, 0, 0), 1, 0),
+        ]
+        pgrb2b = []
+        for parameter in UPPER_AIR_PARAMETERS:
+            for level in ALL_PRESSURE_LEVELS:
+                (pgrb2b if level in PGRB2B_LEVELS else pgrb2).append(message(cycle, parameter, 100, level * 100))
+            pgrb2.append(message(cycle, parameter, 100, 4000))  # 40 hPa, not needed
+        # The precipitation of a cycle is accumulated by the forecast of the previous cycle
+        pgrb2f006 = [message(previous_cycle, (0, 0, 0), 103, 2, forecast_hours=6),
+                     message(previous_cycle, (0, 1, 8), 1, 0, forecast_hours=6, accumulated=True)]
+
+        folder = os.path.join(directory, f'{cycle:%Y%m%d}', f'{cycle:%H}')
+        os.makedirs(folder, exist_ok=True)
+        for name, messages in [(f'gdas.t{cycle:%H}z.pgrb2.0p25.f000', pgrb2), (f'gdas.t{cycle:%H}z.pgrb2b.0p25.f000', pgrb2b),
+                               (f'gdas.t{previous_cycle:%H}z.pgrb2.0p25.f006', pgrb2f006)]:
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(b''.join(messages))
+
+
+def list_shared_memory_blocks():
+    """Return the names of the shared memory blocks of multiprocessing (on Linux)."""
+    return {name for name in os.listdir('/dev/shm') if name.startswith('psm_')}
+
+
+def list_netcdf_files(directory):
+    """Return the netcdf files of a directory."""
+    return [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.nc')]
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serves files and directory listings like NOMADS, with single byte ranges.
+
+    Files of truncate_once are cut in the middle the first time they are read (or a byte range of them), like a dropped
+    connection. Paths of fail always fail, and paths of fail_once fail the first time, with their HTTP status. HEAD
+    requests are not allowed unless allow_head.
+    """
+
+    requests = []
+    truncate_once = set()
+    fail = {}
+    fail_once = {}
+    allow_head = True
+
+    def get_failure(self):
+        if self.path in self.fail_once:
+            return self.fail_once.pop(self.path)
+        return self.fail.get(self.path)
+
+    def do_HEAD(self):
+        self.requests.append(('HEAD', self.path, None))
+        status = self.get_failure()
+        if status is not None:
+            return self.send_error(status)
+        if not self.allow_head:
+            return self.send_error(405)
+        super().do_HEAD()
+
+    def do_GET(self):
+        self.requests.append(('GET', self.path, self.headers.get('Range')))
+        status = self.get_failure()
+        if status is not None:
+            return self.send_error(status)
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        path = self.translate_path(self.path)
+        truncate = self.path in self.truncate_once
+        if not os.path.isfile(path) or (match is None and not truncate):
+            return super().do_GET()
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.truncate_once.discard(self.path)
+        if match is None:
+            start, end = 0, len(data) - 1
+            self.send_response(200)
+        else:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if truncate:
+            self.wfile.write(data[start:start + (end - start + 1) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(data[start:end + 1])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class InMemoryS3:
+    """Stands in for the S3 client, with the objects of the bucket in memory.
+
+    Objects of corrupt_once have a corrupted byte the first time they are read, and objects of missing are listed but
+    can not be read, like objects deleted after the listing.
+    """
+
+    def __init__(self, objects, corrupt_once=(), missing=()):
+        self.objects = objects
+        self.corrupt_once = set(corrupt_once)
+        self.missing = set(missing)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def list_objects_v2(self, Bucket, Prefix):
+        return {'Contents': [{'Key': key, 'Size': len(data)} for key, data in self.objects.items() if key.startswith(Prefix)]}
+
+    def check_exists(self, Key, operation_name):
+        if Key in self.missing:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'},
+                               'ResponseMetadata': {'HTTPStatusCode': 404}}, operation_name)
+
+    def head_object(self, Bucket, Key):
+        self.check_exists(Key, 'HeadObject')
+        return {'ContentLength': len(self.objects[Key]), 'ETag': f'"{hashlib.md5(self.objects[Key]).hexdigest()}"'}
+
+    def get_object(self, Bucket, Key, Range=None):
+        with self.lock:
+            self.requests.append((Key, Range))
+            corrupt = Key in self.corrupt_once
+            self.corrupt_once.discard(Key)
+        self.check_exists(Key, 'GetObject')
+        data = self.objects[Key]
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1 if end else None]
+        if corrupt:
+            data = bytes([data[0] ^ 1]) + data[1:]
+        return {'Body': StreamingBody(io.BytesIO(data), len(data)), 'ContentLength': len(data)}
+
+
+class GFSDataProcessorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def make_processor(self, num_pressure_levels=13, download_source='nomads', byte_ranges=True, num_cycles=1):
+        end_datetime = CYCLE + timedelta(hours=6 * (num_cycles - 1))
+        processor = GFSDataProcessor(CYCLE, end_datetime, num_pressure_levels, download_source, download_directory=self.directory.name,
+                                     byte_ranges=byte_ranges, num_workers=3)
+        processor.retry_delay = 0.01
+        processor.chunk_size = 1024
+        return processor
+
+    def make_files(self, processor, num_cycles=1):
+        """Return stand-in files (bytes and inventory) of each cycle and file format, with the needed messages and others around them."""
+        files = {}
+        for i in range(num_cycles):
+            for file_format in processor.file_formats:
+                needed = sorted(processor.get_inventory_messages(file_format))
+                others = [('VIS', 'surface'), ('TMP', '40 mb'), ('RH', f'{i} m above ground')]
+                # Needed messages come in runs, with other messages between the runs
+                messages = others[:1] + needed[:5] + others[1:2] + needed[5:] + others[2:]
+                files[CYCLE + timedelta(hours=6 * i), file_format] = make_grib2_file(messages)
+        return files
+
+    def serve_nomads(self, processor, files):
+        root = os.path.join(self.directory.name, 'nomads')
+        for (cycle, file_format), (data, inventory) in files.items():
+            path = os.path.join(root, get_remote_path(cycle, file_format))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+            with open(f'{path}.idx', 'w') as f:
+                f.write(inventory)
+
+        RangeRequestHandler.requests = []
+        RangeRequestHandler.truncate_once = set()
+        RangeRequestHandler.fail = {}
+        RangeRequestHandler.fail_once = {}
+        RangeRequestHandler.allow_head = True
+        server = ThreadingHTTPServer(('127.0.0.1', 0), partial(RangeRequestHandler, directory=root))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        processor.nomads_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    def make_s3(self, processor, files, corrupt_once=(), missing=()):
+        objects = {}
+        for (cycle, file_format), (data, inventory) in files.items():
+            objects[get_remote_path(cycle, file_format)] = data
+            objects[f'{get_remote_path(cycle, file_format)}.idx'] = inventory.encode()
+        processor.s3 = InMemoryS3(objects, corrupt_once, missing)
+        return processor.s3
+
+    def read_local_file(self, processor, cycle, file_format):
+        name = os.path.basename(get_remote_path(cycle, file_format))
+        with open(os.path.join(processor.local_base_directory, f'{cycle:%Y%m%d}', f'{cycle:%H}', name), 'rb') as f:
+            return f.read()
+
+    def test_byte_ranges_are_merged(self):
+        processor = self.make_processor()
+        inventory = '\n'.join([
+            '1:0:d=2023060600:VIS:surface:anl:',
+            '2:100:d=2023060600:LAND:surface:6 hour fcst:',
+            '3:250:d=2023060600:APCP:surface:0-6 hour acc fcst:',
+            '4:300:d=2023060600:UGRD:10 m above ground:6 hour fcst:',
+            '5:400:d=2023060600:APCP:surface:0-6 hour acc fcst:',
+        ])
+        self.assertEqual(['bytes=100-299', 'bytes=400-'], processor.get_byte_ranges(inventory, 'pgrb2.0p25.f006'))
+
+        # Sub-messages share the offset of their message
+        inventory = '\n'.join([
+            '1:0:d=2023060600:LAND:surface:6 hour fcst:',
+            '2.1:100:d=2023060600:APCP:surface:0-6 hour acc fcst:',
+            '2.2:100:d=2023060600:VIS:surface:anl:',
+            '3:200:d=2023060600:VIS:surface:anl:',
+        ])
+        self.assertEqual(['bytes=0-199'], processor.get_byte_ranges(inventory, 'pgrb2.0p25.f006'))
+
+        with self.assertRaisesRegex(ValueError, 'APCP'):
+            processor.get_byte_ranges('1:0:d=2023060600:LAND:surface:6 hour fcst:', 'pgrb2.0p25.f006')
+
+    def test_needed_messages(self):
+        processor = self.make_processor(num_pressure_levels=37)
+        pgrb2 = processor.get_inventory_messages('pgrb2.0p25.f000')
+        pgrb2b = processor.get_inventory_messages('pgrb2b.0p25.f000')
+        self.assertEqual(6 + 6 * 31, len(pgrb2))
+        self.assertEqual(6 * 6, len(pgrb2b))
+        self.assertIn(('SPFH', '1 mb'), pgrb2)
+        self.assertIn(('VVEL', '875 mb'), pgrb2b)
+        self.assertEqual(6 + 6 * 13, len(self.make_processor().get_inventory_messages('pgrb2.0p25.f000')))
+
+    def test_nomads_downloads_needed_messages(self):
+        processor = self.make_processor(num_pressure_levels=37)
+        files = self.make_files(processor)
+        self.serve_nomads(processor, files)
+
+        processor.download_data()
+
+        for (cycle, file_format), (data, inventory) in files.items():
+            self.assertEqual(get_messages(data, inventory, processor.get_inventory_messages(file_format)),
+                             self.read_local_file(processor, cycle, file_format))
+
+        # Each run of needed messages is read with a single range
+        range_requests = [byte_range for _, _, byte_range in RangeRequestHandler.requests if byte_range is not None]
+        byte_ranges = [processor.get_byte_ranges(inventory, file_format) for (_, file_format), (_, inventory) in files.items()]
+        self.assertEqual(sorted(sum(byte_ranges, [])), sorted(range_requests))
+        self.assertEqual([2, 2, 1], [len(ranges) for ranges in byte_ranges])
+
+    def test_nomads_finds_files_without_listing(self):
+        processor = self.make_processor(byte_ranges=False, num_cycles=2)
+        files = self.make_files(processor, num_cycles=2)
+        self.serve_nomads(processor, files)
+
+        processor.download_data()
+
+        for (cycle, file_format), (data, _) in files.items():
+            self.assertEqual(data, self.read_local_file(processor, cycle, file_format))
+        # Each file is found, and its size known, with a HEAD request, then downloaded with a GET request
+        self.assertEqual(sorted(('HEAD', '/' + get_remote_path(*file), None) for file in files),
+                         sorted(request for request in RangeRequestHandler.requests if request[0] == 'HEAD'))
+        self.assertEqual(sorted(('GET', '/' + get_remote_path(*file), None) for file in files),
+                         sorted(request for request in RangeRequestHandler.requests if request[0] == 'GET'))
+
+    def test_nomads_lists_directories_once_when_files_are_not_found(self):
+        processor = self.make_processor(num_cycles=2)
+        files = self.make_files(processor, num_cycles=2)
+        self.serve_nomads(processor, files)
+        RangeRequestHandler.allow_head = False
+
+        processor.download_data()
+
+        for (cycle, file_format), (data, inventory) in files.items():
+            self.assertEqual(get_messages(data, inventory, processor.get_inventory_messages(file_format)),
+                             self.read_local_file(processor, cycle, file_format))
+        # The cycles need 3 directories: the cycle before the first one has the precipitation of the first one
+        listings = [path for method, path, _ in RangeRequestHandler.requests if method == 'GET' and path.endswith('/')]
+        self.assertEqual(['/gdas.20230605/18/atmos/', '/gdas.20230606/00/atmos/', '/gdas.20230606/06/atmos/'], sorted(listings))
+
+    def test_nomads_listing_errors_are_retried_and_reported(self):
+        processor = self.make_processor()
+        processor.max_retries = 2
+        files = self.make_files(processor)
+        self.serve_nomads(processor, files)
+        RangeRequestHandler.allow_head = False
+        listing = '/gdas.20230606/00/atmos/'
+        RangeRequestHandler.fail = {listing: 503}
+
+        # The failed listing is not cached as an empty one, which would find no file in the directory
+        with self.assertRaisesRegex(IOError, 'Failed to download 1 files: the files of 2023060600'):
+            processor.download_data()
+        self.assertEqual(3, len([path for method, path, _ in RangeRequestHandler.requests if method == 'GET' and path == listing]))
+        self.assertNotIn(f'{processor.nomads_url}{listing}', processor.nomads_listings)
+
+        # Once the listing succeeds, the files of the cycle are found and downloaded
+        RangeRequestHandler.fail = {}
+        RangeRequestHandler.fail_once = {listing: 429}
+        processor.download_data()
+        for (cycle, file_format), (data, inventory) in files.items():
+            self.assertEqual(get_messages(data, inventory, processor.get_inventory_messages(file_format)),
+                             self.read_local_file(processor, cycle, file_format))
+
+    def test_nomads_resumes_and_skips_byte_range_downloads(self):
+        processor = self.make_processor(num_cycles=2)
+        # Small chunks, so that a part of the cut byte range is written before the connection drops
+        processor.chunk_size = 8
+        files = self.make_files(processor, num_cycles=2)
+        self.serve_nomads(processor, files)
+        interrupted = '/' + get_remote_path(CYCLE + timedelta(hours=6), 'pgrb2.0p25.f000')
+        RangeRequestHandler.truncate_once = {interrupted}
+
+        processor.download_data()
+
+        for (cycle, file_format), (data, inventory) in files.items():
+            self.assertEqual(get_messages(data, inventory, processor.get_inventory_messages(file_format)),
+                             self.read_local_file(processor, cycle, file_format))
+        # The first range is cut in the middle, and resumed from the bytes which were received
+        (first, first_end), (second, second_end) = [re.fullmatch(r'bytes=(\d+)-(\d*)', byte_range).groups() for method, path, byte_range
+                                                    in RangeRequestHandler.requests if method == 'GET' and path == interrupted][:2]
+        self.assertEqual(first_end, second_end)
+        self.assertGreater(int(second), int(first))
+
+        # Files which are already downloaded are not downloaded again
+        RangeRequestHandler.requests = []
+        processor.download_data()
+        self.assertEqual([], [path for method, path, _ in RangeRequestHandler.requests if method == 'GET' and path.endswith(('f000', 'f006'))])
+
+    def test_s3_downloads_needed_messages(self):
+        processor = self.make_processor(download_source='s3')
+        files = self.make_files(processor)
+        s3 = self.make_s3(processor, files)
+
+        processor.download_data()
+
+        for (cycle, file_format), (data, inventory) in files.items():
+            self.assertEqual(get_messages(data, inventory, processor.get_inventory_messages(file_format)),
+                             self.read_local_file(processor, cycle, file_format))
+        # An inventory and 2, 1 byte ranges
+        self.assertEqual(2 * 1 + 2 + 1, len(s3.requests))
+
+    def test_nomads_resumes_interrupted_downloads(self):
+        processor = self.make_processor(byte_ranges=False, num_cycles=2)
+        files = self.make_files(processor, num_cycles=2)
+        self.serve_nomads(processor, files)
+        interrupted = '/' + get_remote_path(CYCLE + timedelta(hours=6), 'pgrb2.0p25.f000')
+        RangeRequestHandler.truncate_once = {interrupted}
+
+        processor.download_data()
+
+        for (cycle, file_format), (data, _) in files.items():
+            self.assertEqual(data, self.read_local_file(processor, cycle, file_format))
+        # The download is resumed from the chunks which were received
+        data = files[CYCLE + timedelta(hours=6), 'pgrb2.0p25.f000'][0]
+        first, second = [byte_range for method, path, byte_range in RangeRequestHandler.requests if method == 'GET' and path == interrupted]
+        self.assertIsNone(first)
+        self.assertGreater(int(re.fullmatch(r'bytes=(\d+)-', second).group(1)), len(data) // 4)
+        self.assertEqual([], [name for name in os.listdir(os.path.join(processor.local_base_directory, '20230606', '06')) if name.endswith('.part')])
+
+        # Files which are already downloaded are not downloaded again
+        RangeRequestHandler.requests = []
+        processor.download_data()
+        self.assertEqual([], [path for method, path, _ in RangeRequestHandler.requests if method == 'GET' and path.endswith(('f000', 'f006'))])
+
+    def test_s3_downloads_again_on_checksum_mismatch(self):
+        processor = self.make_processor(download_source='s3', byte_ranges=False, num_cycles=2)
+        files = self.make_files(processor, num_cycles=2)
+        corrupted = get_remote_path(CYCLE, 'pgrb2.0p25.f000')
+        s3 = self.make_s3(processor, files, corrupt_once=[corrupted])
+
+        processor.download_data()
+
+        for (cycle, file_format), (data, _) in files.items():
+            self.assertEqual(data, self.read_local_file(processor, cycle, file_format))
+        self.assertEqual([(corrupted, None), (corrupted, None)], [request for request in s3.requests if request[0] == corrupted])
+
+    def test_failed_downloads_are_retried_and_reported(self):
+        # Server errors and throttling are retried, missing and forbidden files are not
+        for status, num_attempts in [(503, 3), (429, 3), (404, 1), (403, 1)]:
+            with self.subTest(status=status):
+                processor = self.make_processor(byte_ranges=False)
+                processor.max_retries = 2
+                files = self.make_files(processor)
+                self.serve_nomads(processor, files)
+                failing = '/' + get_remote_path(CYCLE, 'pgrb2.0p25.f006')
+                RangeRequestHandler.fail = {failing: status}
+
+                with self.assertRaisesRegex(IOError, 'Failed to download 1 files'):
+                    processor.download_data()
+                # The file is looked for once, then its download is tried
+                self.assertEqual(1 + num_attempts, len([path for _, path, _ in RangeRequestHandler.requests if path == failing]))
+                self.assertEqual(files[CYCLE, 'pgrb2.0p25.f000'][0], self.read_local_file(processor, CYCLE, 'pgrb2.0p25.f000'))
+
+    def test_s3_missing_files_are_not_retried(self):
+        processor = self.make_processor(download_source='s3')
+        files = self.make_files(processor)
+        missing = get_remote_path(CYCLE, 'pgrb2.0p25.f006')
+        s3 = self.make_s3(processor, files, missing=[missing, f'{missing}.idx'])
+
+        with self.assertRaisesRegex(IOError, 'Failed to download 1 files'):
+            processor.download_data()
+        self.assertEqual([(f'{missing}.idx', None)], [request for request in s3.requests if request[0].startswith(missing)])
+
+
+class SinglePassTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def make_processor(self, num_pressure_levels, num_cycles=2, skip=()):
+        output_directory = tempfile.mkdtemp(dir=self.directory.name)
+        # The cycles are written once, and shared by the processors with the same messages
+        download_directory = os.path.join(self.directory.name, 'incomplete' if skip else 'complete')
+        processor = GFSDataProcessor(CYCLE, CYCLE + timedelta(hours=6 * (num_cycles - 1)), num_pressure_levels,
+                                     output_directory=output_directory, download_directory=download_directory)
+        if not os.path.exists(processor.local_base_directory):
+            write_gdas_cycles(processor.local_base_directory, num_cycles, skip)
+        return processor
+
+    def assert_same_inputs(self, ds, reference):
+        self.assertEqual(set(reference.data_vars), set(ds.data_vars))
+        np.testing.assert_array_equal(reference.datetime.values, ds.datetime.values)
+        np.testing.assert_array_equal(reference.time.values, ds.time.values)
+        for name, reference_variable in reference.data_vars.items():
+            sort_dims = [dim for dim in ('lat', 'level') if dim in reference_variable.dims]
+            variable = ds[name].sortby(sort_dims).transpose(*reference_variable.dims)
+            reference_variable = reference_variable.sortby(sort_dims)
+            np.testing.assert_array_equal(reference_variable.lat.values, variable.lat.values)
+            np.testing.assert_allclose(reference_variable.values, variable.values, rtol=1e-6, err_msg=name)
+
+    def test_matches_pygrib(self):
+        for num_pressure_levels in [13, 37]:
+            with self.subTest(num_pressure_levels=num_pressure_levels):
+                processor = self.make_processor(num_pressure_levels)
+                processor.process_data_with_pygrib()
+                reference_netcdf, = list_netcdf_files(processor.output_directory)
+
+                processor = self.make_processor(num_pressure_levels)
+                output_netcdf = processor.process_data_with_single_pass()
+
+                self.assertEqual(os.path.basename(reference_netcdf), os.path.basename(output_netcdf))
+                with xr.open_dataset(output_netcdf) as ds, xr.open_dataset(reference_netcdf) as reference:
+                    self.assertEqual(num_pressure_levels, ds.sizes['level'])
+                    self.assertEqual(2, ds.sizes['time'])
+                    self.assertTrue(np.all(np.diff(ds.lat.values) > 0))
+                    self.assert_same_inputs(ds, reference)
+
+    def test_messages_to_extract(self):
+        processor = self.make_processor(37, num_cycles=1)
+        messages = processor.get_messages_to_extract()
+        self.assertEqual(['.pgrb2.0p25.f000', '.pgrb2.0p25.f006', '.pgrb2b.0p25.f000'], sorted(messages))
+        self.assertEqual(4 + 6 * 31, len(messages['.pgrb2.0p25.f000']))
+        self.assertEqual(6 * 6, len(messages['.pgrb2b.0p25.f000']))
+        self.assertEqual(('temperature', processor.pressure_levels.index(875)), messages['.pgrb2b.0p25.f000'][('t', 'isobaricInhPa', 875)])
+        self.assertEqual({('tp', 'surface', 0): ('total_precipitation_6hr', None)}, messages['.pgrb2.0p25.f006'])
+
+    def test_missing_messages_are_reported(self):
+        # No specific humidity on any pressure level
+        processor = self.make_processor(13, num_cycles=1, skip=[(0, 1, 0)])
+        with self.assertRaisesRegex(ValueError, r"pgrb2\.0p25\.f000 has no message for \[\('q', 'isobaricInhPa', 50\)"):
+            processor.process_data_with_single_pass()
+        self.assertEqual([], list_netcdf_files(processor.output_directory))
+
+    @unittest.skipUnless(os.path.isdir('/dev/shm'), 'the shared memory blocks are only listed on Linux')
+    def test_processes_match_a_single_process(self):
+        processor = self.make_processor(37)
+        with xr.open_dataset(processor.process_data_with_single_pass()) as expected:
+            blocks = list_shared_memory_blocks()
+            processor = self.make_processor(37)
+            with xr.open_dataset(processor.process_data_with_single_pass(num_processes=2)) as ds:
+                xr.testing.assert_identical(expected, ds)
+        self.assertEqual(blocks, list_shared_memory_blocks())
+
+    @unittest.skipUnless(os.path.isdir('/dev/shm'), 'the shared memory blocks are only listed on Linux')
+    def test_processes_raise_errors_and_release_shared_memory(self):
+        blocks = list_shared_memory_blocks()
+        processor = self.make_processor(13, num_cycles=1, skip=[(0, 1, 0)])
+        with self.assertRaisesRegex(ValueError, "has no message for"):
+            processor.process_data_with_single_pass(num_processes=2)
+        self.assertEqual(blocks, list_shared_memory_blocks())
+
+        written_arrays = []
+
+        def write_dataset(arrays, times, lats, lons):
+            written_arrays.extend(arrays.values())
+            raise OSError('No space left on device')
+
+        # The dataset is written from copies of the shared memory, which is released whatever happens to them, and errors
+        # writing it are not hidden by the release of the shared memory
+        processor = self.make_processor(13, num_cycles=1)
+        processor.write_dataset = write_dataset
+        with self.assertRaisesRegex(OSError, 'No space left on device'):
+            processor.process_data_with_single_pass(num_processes=2)
+        self.assertTrue(all(array.flags.owndata for array in written_arrays))
+        self.assertEqual(blocks, list_shared_memory_blocks())
+
+    def test_processes_cancel_the_other_files_after_an_error(self):
+        decoded_files = []
+
+        def decode_grib2_file_to_shared_memory(grib2_file, messages, shared_arrays, time_index):
+            decoded_files.append(grib2_file)
+            if len(decoded_files) == 1:
+                raise ValueError(f"{grib2_file} is corrupted")
+
+        # The files are decoded one at a time by threads standing in for the processes, so the files left once the first
+        # one fails are still pending
+        processor = self.make_processor(13)
+        with mock.patch.object(gdas_utility, 'decode_grib2_file_to_shared_memory', decode_grib2_file_to_shared_memory), \
+                mock.patch.object(gdas_utility, 'ProcessPoolExecutor', lambda max_workers: ThreadPoolExecutor(max_workers=1)):
+            with self.assertRaisesRegex(ValueError, 'is corrupted'):
+                processor.process_data_with_single_pass(num_processes=2)
+        # At most the file taken by the thread before the pool is shut down is decoded after the error
+        self.assertLessEqual(len(decoded_files), 2)
+        self.assertLess(len(decoded_files), len(glob.glob(os.path.join(processor.local_base_directory, '*', '*', '*'))))
+
+
+if __name__ == "__main__":
+    unittest.main()
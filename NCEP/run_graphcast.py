@@ -8,15 +8,25 @@ Revision history:
     -20240205: Sadegh Tabas, made the code clearer, added 37 pressure level option, updated upload to s3
     -20240731: Sadegh Tabas, added grib2 file for F000
     -20240815: Sadegh Tabas, update the directory of fine tuned model parameters
+    -20261018: added an optional on-disk cache for the model graph structures
+    -20261018: added an option to run the processor message passing steps in a scan
+    -20261018: compute the static edge embeddings once, rather than at every forecast step
+    -20261018: use the device resident rollout, which keeps the model inputs on the device
+    -20261018: write grib2 files in background threads as the forecast steps are computed
+    -20261018: compute the forcings of each forecast step as it runs, rather than padding the batch to the forecast length
+    -20261018: load the model only once, and save several initial conditions stacked along batch to their own directories
+    -20261018: added an optional persistent compilation cache, removed an unused jit of the model init
 '''
 import os
 import argparse
 from datetime import timedelta
 import dataclasses
 import functools
+import itertools
 import re
 import haiku as hk
 import jax
+import jax.numpy as jnp
 import numpy as np
 import xarray
 import boto3
@@ -33,17 +43,24 @@ from graphcast import rollout
 from utils.nc2grib import Netcdf2Grib
 
 class GraphCastModel:
-    def __init__(self, pretrained_model_path, gdas_data_path, output_dir=None, num_pressure_levels=13, forecast_length=40):
+    def __init__(self, pretrained_model_path, gdas_data_path, output_dir=None, num_pressure_levels=13, forecast_length=40, graph_cache_dir=None, scan_processor=False, num_writers=1, compilation_cache_dir=None):
         self.pretrained_model_path = pretrained_model_path
         self.gdas_data_path = gdas_data_path
         self.forecast_length = forecast_length
         self.num_pressure_levels = num_pressure_levels
+        self.graph_cache_dir = graph_cache_dir
+        self.scan_processor = scan_processor
+        self.num_writers = num_writers
+        self.compilation_cache_dir = compilation_cache_dir
+        self.enable_compilation_cache()
         
         if output_dir is None:
             self.output_dir = os.path.join(os.getcwd(), f"forecasts_{str(self.num_pressure_levels)}_levels")  # Use current directory if not specified
         else:
             self.output_dir = os.path.join(output_dir, f"forecasts_{str(self.num_pressure_levels)}_levels")
         os.makedirs(self.output_dir, exist_ok=True)
+        # One output directory per initial condition in the batch
+        self.output_dirs = [self.output_dir]
         
         self.params = None
         self.state = {}
@@ -58,8 +75,19 @@ class GraphCastModel:
         self.forcings = None
         self.s3_bucket_name = "noaa-nws-graphcastgfs-pds"
         self.dates = None
+        self.model = None
         
 
+    def enable_compilation_cache(self):
+        """Use a persistent compilation cache, so that runs after the first one load the compiled model instead of compiling it."""
+        if self.compilation_cache_dir is None:
+            return
+        os.makedirs(self.compilation_cache_dir, exist_ok=True)
+        jax.config.update("jax_compilation_cache_dir", self.compilation_cache_dir)
+        # Cache every program, the small ones too (e.g. the rollout helpers)
+        jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+        print(f"Using the compilation cache in {self.compilation_cache_dir}")
+
     def load_pretrained_model(self):
         """Load pre-trained GraphCast model."""
         if self.num_pressure_levels==13:
@@ -79,31 +107,17 @@ class GraphCastModel:
         #with open(gdas_data_path, "rb") as f:
         #    self.current_batch = xarray.load_dataset(f).compute()
         self.current_batch = xarray.load_dataset(self.gdas_data_path).compute()
-        self.dates =  pd.to_datetime(self.current_batch.datetime.values)
-        
-        if (self.forecast_length + 2) > len(self.current_batch['time']):
-            print('Updating batch dataset to account for forecast length')
-            
-            diff = int(self.forecast_length + 2 - len(self.current_batch['time']))
-            ds = self.current_batch
-
-            # time and datetime update
-            curr_time_range = ds['time'].values.astype('timedelta64[ns]')
-            new_time_range = (np.arange(len(curr_time_range) + diff) * np.timedelta64(6, 'h')).astype('timedelta64[ns]')
-            ds = ds.reindex(time = new_time_range)
-            curr_datetime_range = ds['datetime'][0].values.astype('datetime64[ns]')
-            new_datetime_range = curr_datetime_range[0] + np.arange(len(curr_time_range) + diff) * np.timedelta64(6, 'h')
-            ds['datetime'][0]= new_datetime_range
-
-            self.current_batch = ds
-            print('batch dataset updated')
+        self.dates = [pd.to_datetime(dates) for dates in self.current_batch.datetime.values]
             
         
     def extract_inputs_targets_forcings(self):
-        """Extract inputs, targets, and forcings from the loaded data."""
-        self.inputs, self.targets, self.forcings = data_utils.extract_inputs_targets_forcings(
-            self.current_batch, target_lead_times=slice("6h", f"{self.forecast_length*6}h"), **dataclasses.asdict(self.task_config)
+        """Extract inputs and targets from the loaded data, the forcings are computed for each forecast step as it runs."""
+        # GraphCast is initialized from the first states of the file (two 6-hourly states for a 12h input duration), it may hold more for evaluation
+        num_input_states = pd.Timedelta(self.task_config.input_duration) // pd.Timedelta("6h")
+        self.inputs, self.targets = data_utils.extract_inputs_and_targets_template(
+            self.current_batch.isel(time=slice(0, num_input_states)), target_lead_times=slice("6h", f"{self.forecast_length*6}h"), **dataclasses.asdict(self.task_config)
         )
+        self.forcings = functools.partial(data_utils.get_forcings, forcing_variables=self.task_config.forcing_variables)
 
     def load_normalization_stats(self):
         """Load normalization stats."""
@@ -136,10 +150,14 @@ class GraphCastModel:
         return lambda **kw: fn(**kw)[0]
 
     def load_model(self):
-        def construct_wrapped_graphcast(model_config, task_config):
+        # The model is only compiled once, and reused for every forecast run by this process
+        if self.model is not None:
+            return
+
+        def construct_wrapped_graphcast(model_config, task_config, static_edge_embeddings=None):
             """Constructs and wraps the GraphCast Predictor."""
             # Deeper one-step predictor.
-            predictor = graphcast.GraphCast(model_config, task_config)
+            predictor = graphcast.GraphCast(model_config, task_config, graph_cache_dir=self.graph_cache_dir, scan_message_passing_steps=self.scan_processor, static_edge_embeddings=static_edge_embeddings)
 
             # Modify inputs/outputs to `graphcast.GraphCast` to handle conversion to
             # from/to float32 to/from BFloat16.
@@ -154,36 +172,61 @@ class GraphCastModel:
             return predictor
 
         @hk.transform_with_state
-        def run_forward(model_config, task_config, inputs, targets_template, forcings,):
-            predictor = construct_wrapped_graphcast(model_config, task_config)
+        def run_forward(model_config, task_config, inputs, targets_template, forcings, static_edge_embeddings=None):
+            predictor = construct_wrapped_graphcast(model_config, task_config, static_edge_embeddings)
             return predictor(inputs, targets_template=targets_template, forcings=forcings,)
-        
-        jax.jit(self._with_configs(run_forward.init))
-        self.model = self._drop_state(self._with_params(jax.jit(self._with_configs(run_forward.apply))))
+
+        @hk.transform_with_state
+        def embed_static_edge_features(model_config, task_config, inputs):
+            # Same parameter view and dtype as inside of `casting.Bfloat16Cast`.
+            predictor = graphcast.GraphCast(model_config, task_config, graph_cache_dir=self.graph_cache_dir)
+            with casting.bfloat16_variable_view():
+                return predictor.embed_static_edge_features(inputs, dtype=jnp.bfloat16)
+
+        # The edge embeddings only depend on the params and the grid, so compute them once
+        # here and reuse them for every forecast step and rollout chunk.
+        static_edge_embeddings = self._drop_state(self._with_params(jax.jit(self._with_configs(embed_static_edge_features.apply))))(rng=None, inputs=self.inputs)
+        self.model = functools.partial(
+            self._drop_state(self._with_params(jax.jit(self._with_configs(run_forward.apply)))),
+            static_edge_embeddings=static_edge_embeddings)
     
  
     def get_predictions(self):
-        """Run GraphCast and save forecasts to a NetCDF file."""
+        """Run GraphCast and save forecasts to grib2 files, one per lead time."""
 
         print (f"start running GraphCast for {self.forecast_length} steps --> {self.forecast_length*6} hours.")
         self.load_model()
            
-        # output = self.model(self.model ,rng=jax.random.PRNGKey(0), inputs=self.inputs, targets_template=self.targets * np.nan, forcings=self.forcings,)
-        forecasts = rollout.chunked_prediction(self.model, rng=jax.random.PRNGKey(0), inputs=self.inputs, targets_template=self.targets * np.nan, forcings=self.forcings,)
-        
-        # filename = f"forecasts_levels-{self.num_pressure_levels}_steps-{self.forecast_length}.nc"
-        # output_netcdf = os.path.join(self.output_dir, filename)
-        
-        # save forecasts
-        # forecasts.to_netcdf(output_netcdf)
-        # print (f"GraphCast run completed successfully, you can find the GraphCast forecasts in the following directory:\n {output_netcdf}")
-
-        self.save_grib2(forecasts)
+        # Each step is yielded as soon as the next one is dispatched to the device
+        forecasts = rollout.chunked_prediction_generator(self.model, rng=jax.random.PRNGKey(0), inputs=self.inputs, targets_template=self.targets, forcings=None, forcings_fn=self.forcings, device_resident=True,)
 
-    def save_grib2(self, forecasts):
+        # Save f000 first, then each forecast step in background threads while the next steps run
         converter = Netcdf2Grib()
+        rollout.write_chunks_async(
+            itertools.chain([(self.get_f000(), None)], self._with_precipitation_offset(forecasts)),
+            lambda item: self._save_grib2(converter, *item),
+            num_writers=self.num_writers,
+        )
+        print (f"GraphCast run completed successfully, you can find the GraphCast forecasts in the following directories:\n {', '.join(self.output_dirs)}")
+
+    def _save_grib2(self, converter, forecast, precipitation_offset):
+        """Save a forecast chunk to grib2, splitting the initial conditions of the batch into their own directories."""
+        for i, output_dir in enumerate(self.output_dirs):
+            offset = None if precipitation_offset is None else precipitation_offset.isel(batch=[i])
+            converter.save_grib2(self.dates[i:i + 1], forecast.isel(batch=[i]), output_dir, precipitation_offset=offset)
 
-        # Call and save f000 in grib2
+    @staticmethod
+    def _with_precipitation_offset(forecasts):
+        """Pair each forecast step with the precipitation accumulated before it (computed on the device)."""
+        offset = None
+        for forecast in forecasts:
+            yield forecast, offset
+            if 'total_precipitation_6hr' in forecast:
+                precipitation = forecast['total_precipitation_6hr'].sum('time')
+                offset = precipitation if offset is None else offset + precipitation
+
+    def get_f000(self):
+        """Return the analysis at the initial time, to save as f000."""
         ds = self.current_batch
         ds = ds.drop_vars(['geopotential_at_surface','land_sea_mask', 'total_precipitation_6hr'])
         for var in ds.data_vars:
@@ -191,11 +234,7 @@ class GraphCastModel:
                 del ds[var].attrs['long_name']
         ds = ds.isel(time=slice(1, 2))
         ds['time'] = ds['time'] - pd.Timedelta(hours=6)
-
-        converter.save_grib2(self.dates, ds, self.output_dir)
-        
-        # Call and save forecasts in grib2
-        converter.save_grib2(self.dates, forecasts, self.output_dir)
+        return ds
         
     
     def upload_to_s3(self, keep_data):
@@ -259,9 +298,13 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--pressure", help="number of pressure levels", default=13)
     parser.add_argument("-u", "--upload", help="upload input data as well as forecasts to noaa s3 bucket (yes or no)", default = "no")
     parser.add_argument("-k", "--keep", help="keep input and output after uploading to noaa s3 bucket (yes or no)", default = "no")
+    parser.add_argument("-c", "--cache", help="directory to cache the model graph structures across runs", default=None)
+    parser.add_argument("-s", "--scan", help="run the processor message passing steps in a scan to speed up compilation (yes or no)", default = "no")
+    parser.add_argument("-t", "--writers", help="number of background threads writing grib2 files while the forecast runs", default=1)
+    parser.add_argument("-j", "--jit-cache", help="directory to cache the compiled model across runs", default=None)
     
     args = parser.parse_args()
-    runner = GraphCastModel(args.weights, args.input, args.output, int(args.pressure), int(args.length))
+    runner = GraphCastModel(args.weights, args.input, args.output, int(args.pressure), int(args.length), args.cache, args.scan.lower() == "yes", int(args.writers), args.jit_cache)
     
     runner.load_pretrained_model()
     runner.load_gdas_data()
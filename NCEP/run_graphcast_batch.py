@@ -0,0 +1,107 @@
+'''
+Description: Script to call the graphcast model for many GDAS initial conditions (e.g. reforecasts and hindcasts)
+             in one process, with the initial conditions stacked along the batch dimension
+Revision history:
+    -20261018: initial code
+    -20261018: added an optional persistent compilation cache
+    -20261018: load the micro-batches with load_gdas_micro_batch, so that load_gdas_data keeps the signature of GraphCastModel, and upload each initial condition to s3
+'''
+import os
+import argparse
+import glob
+
+import pandas as pd
+import xarray
+
+from run_graphcast import GraphCastModel
+
+class GraphCastBatchModel(GraphCastModel):
+    def __init__(self, pretrained_model_path, gdas_data_paths, output_dir=None, num_pressure_levels=13, forecast_length=40, batch_size=1, graph_cache_dir=None, scan_processor=False, num_writers=1, compilation_cache_dir=None):
+        super().__init__(pretrained_model_path, None, output_dir, num_pressure_levels, forecast_length, graph_cache_dir, scan_processor, num_writers, compilation_cache_dir)
+        self.gdas_data_paths = gdas_data_paths
+        self.batch_size = batch_size
+        self.root_output_dir = os.getcwd() if output_dir is None else output_dir
+        # Output directory of each initial condition forecast so far
+        self.output_dirs_by_path = {}
+
+    def load_gdas_micro_batch(self, gdas_data_paths):
+        """Load GDAS data of several initial conditions, stacked along batch."""
+        datasets = [xarray.load_dataset(path) for path in gdas_data_paths]
+
+        # The last micro-batch is padded with its last initial condition, so every micro-batch runs the same compiled program
+        num_padding = self.batch_size - len(datasets)
+        datasets += [datasets[-1]] * num_padding
+
+        # Static variables have no batch dimension, they are the same for all the initial conditions
+        self.current_batch = xarray.concat(datasets, dim='batch', data_vars='minimal', coords='minimal', compat='override')
+        self.dates = [pd.to_datetime(dates) for dates in self.current_batch.datetime.values]
+
+        # Forecasts of each initial condition are saved to their own directory, named after the initialization time
+        self.output_dirs = []
+        for gdas_data_path, dates in zip(gdas_data_paths, self.dates):
+            output_dir = os.path.join(self.root_output_dir, dates[1].strftime('%Y%m%d%H'), f"forecasts_{str(self.num_pressure_levels)}_levels")
+            os.makedirs(output_dir, exist_ok=True)
+            self.output_dirs.append(output_dir)
+            self.output_dirs_by_path[gdas_data_path] = output_dir
+
+    def get_all_predictions(self):
+        """Run GraphCast for all the initial conditions, one micro-batch at a time."""
+        num_micro_batches = -(-len(self.gdas_data_paths) // self.batch_size)
+        for i in range(0, len(self.gdas_data_paths), self.batch_size):
+            gdas_data_paths = self.gdas_data_paths[i:i + self.batch_size]
+            print(f"micro-batch {i // self.batch_size + 1}/{num_micro_batches}: {', '.join(os.path.basename(path) for path in gdas_data_paths)}")
+
+            # Inputs are only loaded for the micro-batch being run
+            self.load_gdas_micro_batch(gdas_data_paths)
+            self.extract_inputs_targets_forcings()
+            self.get_predictions()
+
+    def upload_to_s3(self, keep_data):
+        """Upload the input and forecasts of each initial condition forecast so far to the s3 bucket, as GraphCastModel does for one."""
+        for gdas_data_path, output_dir in self.output_dirs_by_path.items():
+            self.gdas_data_path = gdas_data_path
+            self.output_dir = output_dir
+            super().upload_to_s3(keep_data)
+
+
+def find_gdas_data_paths(input_dir, dates=None):
+    """Return the GDAS files of input_dir, or only those of the given dates (yyyymmddhh)."""
+    paths = sorted(glob.glob(os.path.join(input_dir, "*.nc")))
+    if dates is None:
+        return paths
+
+    selected_paths = []
+    for date in dates:
+        matches = [path for path in paths if f"date-{date}_" in os.path.basename(path)]
+        if not matches:
+            raise FileNotFoundError(f"No GDAS file for {date} in {input_dir}")
+        selected_paths.append(matches[0])
+    return selected_paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run GraphCast model for many initial conditions.")
+    parser.add_argument("-i", "--input", help="input directory of the GDAS netcdf files", required=True)
+    parser.add_argument("-d", "--dates", help="initialization dates to forecast (yyyymmddhh), all the files of the input directory by default", nargs="+", default=None)
+    parser.add_argument("-w", "--weights", help="parent directory of the graphcast params and stats", required=True)
+    parser.add_argument("-l", "--length", help="length of forecast (6-hourly), an integer number in range [1, 40]", required=True)
+    parser.add_argument("-b", "--batch", help="number of initial conditions forecast together (micro-batch size)", default=1)
+    parser.add_argument("-o", "--output", help="output directory", default=None)
+    parser.add_argument("-p", "--pressure", help="number of pressure levels", default=13)
+    parser.add_argument("-u", "--upload", help="upload the input data as well as the forecasts of each initial condition to noaa s3 bucket (yes or no)", default = "no")
+    parser.add_argument("-k", "--keep", help="keep inputs and outputs after uploading to noaa s3 bucket (yes or no)", default = "no")
+    parser.add_argument("-c", "--cache", help="directory to cache the model graph structures across runs", default=None)
+    parser.add_argument("-s", "--scan", help="run the processor message passing steps in a scan to speed up compilation (yes or no)", default = "no")
+    parser.add_argument("-t", "--writers", help="number of background threads writing grib2 files while the forecast runs", default=1)
+    parser.add_argument("-j", "--jit-cache", help="directory to cache the compiled model across runs", default=None)
+
+    args = parser.parse_args()
+    gdas_data_paths = find_gdas_data_paths(args.input, args.dates)
+    runner = GraphCastBatchModel(args.weights, gdas_data_paths, args.output, int(args.pressure), int(args.length), int(args.batch), args.cache, args.scan.lower() == "yes", int(args.writers), args.jit_cache)
+
+    runner.load_pretrained_model()
+    runner.load_normalization_stats()
+    runner.get_all_predictions()
+
+    if args.upload.lower() == "yes":
+        runner.upload_to_s3(args.keep.lower() == "yes")
@@ -5,12 +5,15 @@
         02/05/2024: Sadegh Tabas update the utility to a object-oriented format
         04/25/2024: Sadegh Tabas, generate grib2 index files
         07/03/2024: Sadegh Tabas, sorted grib2 variables
+        10/18/2026: unique intermediate nc file and accumulated precipitation offset, to save forecasts chunk by chunk
 """
 
 import os
 from datetime import datetime, timedelta
 import glob
 import subprocess
+import tempfile
+import numpy as np
 import cf_units
 import iris
 import iris_grib
@@ -53,13 +56,15 @@ class Netcdf2Grib:
                 eccodes.codes_set(grib_message, 'typeOfFirstFixedSurface', 101)
         yield grib_message
 
-    def save_grib2(self, dates, forecasts, outdir):
+    def save_grib2(self, dates, forecasts, outdir, precipitation_offset=None):
         """
         Convert netCDF file to GRIB2 format file.
             Args:
               dates: array of datetime object, from the source file
               forecasts: xarray forecasts dataset
               outdir: output directory
+              precipitation_offset: total_precipitation_6hr (m) accumulated before
+                the first time of forecasts, when saving a forecast chunk by chunk
         
             Returns:
               No return values, will save to grib2 file
@@ -78,8 +83,18 @@ class Netcdf2Grib:
         if 'total_precipitation_6hr' in forecasts:
             forecasts['total_precipitation_6hr'] = forecasts['total_precipitation_6hr'] * 1000
             forecasts['total_precipitation_cumsum'] = forecasts['total_precipitation_6hr'].cumsum(axis=0)
-
-        filename = os.path.join(outdir, "forecast_to_grib2.nc")
+            if precipitation_offset is not None:
+                if 'batch' in precipitation_offset.dims:
+                    precipitation_offset = precipitation_offset.squeeze(dim='batch')
+                forecasts['total_precipitation_cumsum'] = forecasts['total_precipitation_cumsum'] + precipitation_offset * 1000
+
+        # Lead times are read back below as a number of hours
+        if np.issubdtype(forecasts['time'].dtype, np.timedelta64):
+            forecasts['time'].encoding['units'] = 'hours'
+
+        # Unique name, so that several forecast chunks can be converted at the same time
+        fd, filename = tempfile.mkstemp(prefix="forecast_to_grib2_", suffix=".nc", dir=outdir)
+        os.close(fd)
         forecasts.to_netcdf(filename)
 
         # Load cubes from netCDF file
@@ -0,0 +1,123 @@
+# Copyright 2024 DeepMind Technologies Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark for unrolled vs scanned message passing in DeepTypedGraphNet.
+
+Runs a processor like the GraphCast mesh GNN on a multi-mesh and reports the
+compilation time, the memory XLA plans for the compiled program, and the time
+per forward pass, with the message passing steps unrolled and in a scan.
+
+Usage:
+  python benchmarks/deep_typed_graph_net_benchmark.py --mesh_size=5
+"""
+
+import time
+
+from absl import app
+from absl import flags
+from graphcast import deep_typed_graph_net
+from graphcast import icosahedral_mesh
+from graphcast import typed_graph
+import haiku as hk
+import jax
+import numpy as np
+
+_MESH_SIZE = flags.DEFINE_integer(
+    "mesh_size", 4, "Number of refinements of the multi-mesh.")
+_LATENT_SIZE = flags.DEFINE_integer(
+    "latent_size", 128, "Size of the latent features and MLP hidden layers.")
+_NUM_STEPS = flags.DEFINE_integer(
+    "num_message_passing_steps", 16, "Number of message passing steps.")
+_GRADIENTS = flags.DEFINE_bool(
+    "gradients", False, "Also differentiate through the processor, as in "
+    "training.")
+_REPEATS = flags.DEFINE_integer(
+    "repeats", 3, "Number of timed runs, the best one is reported.")
+
+
+def _get_mesh_graph(mesh_size, latent_size):
+  mesh = icosahedral_mesh.merge_meshes(
+      icosahedral_mesh.get_hierarchy_of_triangular_meshes_for_sphere(
+          splits=mesh_size))
+  senders, receivers = icosahedral_mesh.faces_to_edges(mesh.faces)
+  num_nodes = mesh.vertices.shape[0]
+  num_edges = senders.shape[0]
+  rng = np.random.default_rng(0)
+  return typed_graph.TypedGraph(
+      context=typed_graph.Context(n_graph=np.array([1]), features=()),
+      nodes=dict(mesh_nodes=typed_graph.NodeSet(
+          n_node=np.array([num_nodes]),
+          features=rng.normal(
+              size=[num_nodes, latent_size]).astype(np.float32))),
+      edges={
+          typed_graph.EdgeSetKey("mesh", ("mesh_nodes", "mesh_nodes")):
+              typed_graph.EdgeSet(
+                  n_edge=np.array([num_edges]),
+                  indices=typed_graph.EdgesIndices(
+                      senders=senders, receivers=receivers),
+                  features=rng.normal(size=[num_edges, 4]).astype(np.float32))
+      })
+
+
+def main(argv):
+  del argv
+  graph = _get_mesh_graph(_MESH_SIZE.value, _LATENT_SIZE.value)
+  print(f"mesh nodes: {graph.nodes['mesh_nodes'].features.shape[0]}, "
+        f"mesh edges: {graph.edges[list(graph.edges)[0]].features.shape[0]}")
+
+  def get_model(scan_message_passing_steps):
+    def forward(graph):
+      return deep_typed_graph_net.DeepTypedGraphNet(
+          embed_nodes=False,
+          embed_edges=True,
+          node_latent_size=dict(mesh_nodes=_LATENT_SIZE.value),
+          edge_latent_size=dict(mesh=_LATENT_SIZE.value),
+          mlp_hidden_size=_LATENT_SIZE.value,
+          mlp_num_hidden_layers=1,
+          num_message_passing_steps=_NUM_STEPS.value,
+          activation="swish",
+          scan_message_passing_steps=scan_message_passing_steps,
+          name="mesh_gnn",
+      )(graph).nodes["mesh_nodes"].features
+    return hk.transform(forward)
+
+  params = get_model(False).init(jax.random.PRNGKey(0), graph)
+
+  print(f"{'mode':>9} {'compile (s)':>12} {'temp memory (MiB)':>18} "
+        f"{'best run (s)':>13}")
+  for scan in (False, True):
+    model = get_model(scan)
+    if _GRADIENTS.value:
+      fn = jax.grad(lambda p, g: model.apply(p, None, g).sum())  # pylint: disable=cell-var-from-loop
+    else:
+      fn = lambda p, g: model.apply(p, None, g)  # pylint: disable=cell-var-from-loop
+
+    start = time.perf_counter()
+    compiled = jax.jit(fn).lower(params, graph).compile()
+    compile_time = time.perf_counter() - start
+    memory = compiled.memory_analysis()
+    temp_memory = (
+        memory.temp_size_in_bytes / 2**20 if memory is not None else np.nan)
+
+    times = []
+    for _ in range(_REPEATS.value):
+      start = time.perf_counter()
+      jax.block_until_ready(compiled(params, graph))
+      times.append(time.perf_counter() - start)
+
+    print(f"{'scan' if scan else 'unrolled':>9} {compile_time:>12.2f} "
+          f"{temp_memory:>18.1f} {min(times):>13.3f}")
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,175 @@
+# Copyright 2024 DeepMind Technologies Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark for aggregating the edges of the GraphCast graphs for receivers.
+
+Builds the grid2mesh, mesh and mesh2grid graphs of GraphCast for a grid, and
+times the aggregation of random edge latents into the receiver nodes, as done
+once per message passing step, with the edges in the order the graph builders
+produce them and with the edges in an arbitrary order. For edge sets with a
+constant in-degree (mesh2grid) the dense reduction is timed as well, together
+with a full step of the mesh2grid decoder with and without the dense path.
+
+Usage:
+  python benchmarks/edge_aggregation_benchmark.py --resolution=1 --mesh_size=5
+"""
+
+import time
+
+from absl import app
+from absl import flags
+from graphcast import deep_typed_graph_net
+from graphcast import graphcast
+from graphcast import typed_graph
+import haiku as hk
+import jax
+import jax.numpy as jnp
+import numpy as np
+import xarray
+
+_RESOLUTION = flags.DEFINE_float("resolution", 1., "Grid resolution, degrees.")
+_MESH_SIZE = flags.DEFINE_integer(
+    "mesh_size", 5, "Number of refinements of the multi-mesh.")
+_LATENT_SIZE = flags.DEFINE_integer(
+    "latent_size", 512, "Size of the edge latents.")
+_REPEATS = flags.DEFINE_integer(
+    "repeats", 5, "Number of timed runs, the best one is reported.")
+
+
+def _get_graphs():
+  """Returns the graph structures GraphCast builds for the grid."""
+  model_config = graphcast.ModelConfig(
+      resolution=_RESOLUTION.value,
+      mesh_size=_MESH_SIZE.value,
+      latent_size=4,
+      gnn_msg_steps=1,
+      hidden_layers=1,
+      radius_query_fraction_edge_length=0.6)
+  task_config = graphcast.TaskConfig(
+      input_variables=(),
+      target_variables=("2m_temperature",),
+      forcing_variables=(),
+      pressure_levels=(),
+      input_duration="12h")
+  sample_inputs = xarray.Dataset(coords=dict(
+      lat=np.arange(-90., 90. + _RESOLUTION.value / 2, _RESOLUTION.value),
+      lon=np.arange(0., 360., _RESOLUTION.value)))
+
+  def build():
+    model = graphcast.GraphCast(model_config, task_config)
+    model._maybe_init(sample_inputs)  # pylint: disable=protected-access
+    return dict(
+        grid2mesh=model._grid2mesh_graph_structure,  # pylint: disable=protected-access
+        mesh=model._mesh_graph_structure,  # pylint: disable=protected-access
+        mesh2grid=model._mesh2grid_graph_structure)  # pylint: disable=protected-access
+
+  return hk.transform(build).apply({}, None)
+
+
+def _shuffle_edges(edge_set: typed_graph.EdgeSet) -> typed_graph.EdgeSet:
+  order = np.random.default_rng(0).permutation(
+      edge_set.indices.receivers.shape[0])
+  return typed_graph.EdgeSet(
+      n_edge=edge_set.n_edge,
+      indices=typed_graph.EdgesIndices(
+          senders=edge_set.indices.senders[order],
+          receivers=edge_set.indices.receivers[order]),
+      features=edge_set.features[order])
+
+
+def _time(fn, *args):
+  fn = jax.jit(fn)
+  jax.block_until_ready(fn(*args))
+  times = []
+  for _ in range(_REPEATS.value):
+    start = time.perf_counter()
+    jax.block_until_ready(fn(*args))
+    times.append(time.perf_counter() - start)
+  return min(times)
+
+
+def _time_aggregation(edge_set, num_receivers, dense=False):
+  receivers = edge_set.indices.receivers
+
+  def aggregate(latents):
+    if dense:
+      return latents.reshape(
+          (num_receivers, edge_set.constant_in_degree, -1)).sum(axis=1)
+    return jax.ops.segment_sum(
+        latents, receivers, num_receivers,
+        indices_are_sorted=edge_set.indices_are_sorted,
+        unique_indices=edge_set.unique_indices)
+
+  latents = jnp.ones([receivers.shape[0], _LATENT_SIZE.value], jnp.float32)
+  return _time(aggregate, latents)
+
+
+def _time_mesh2grid_decoder(graph):
+  """Times a forward pass of a decoder like the GraphCast one."""
+  rng = np.random.default_rng(0)
+  graph = graph._replace(nodes={
+      name: node_set._replace(features=rng.normal(
+          size=[node_set.n_node[0], _LATENT_SIZE.value]).astype(np.float32))
+      for name, node_set in graph.nodes.items()})
+
+  def forward(graph):
+    return deep_typed_graph_net.DeepTypedGraphNet(
+        node_output_size=dict(grid_nodes=83),
+        embed_nodes=False,
+        embed_edges=True,
+        edge_latent_size=dict(mesh2grid=_LATENT_SIZE.value),
+        node_latent_size=dict(
+            mesh_nodes=_LATENT_SIZE.value, grid_nodes=_LATENT_SIZE.value),
+        mlp_hidden_size=_LATENT_SIZE.value,
+        mlp_num_hidden_layers=1,
+        num_message_passing_steps=1,
+        activation="swish",
+        name="mesh2grid_gnn",
+    )(graph).nodes["grid_nodes"].features
+
+  model = hk.transform(forward)
+  params = model.init(jax.random.PRNGKey(0), graph)
+  return _time(lambda p: model.apply(p, None, graph), params)
+
+
+def main(argv):
+  del argv
+  graphs = _get_graphs()
+  print(f"{'graph':>10} {'edges':>10} {'receivers':>10} "
+        f"{'shuffled (s)':>13} {'builder order (s)':>18} {'dense (s)':>10}")
+  for name, graph in graphs.items():
+    edge_set = graph.edge_by_name(name)
+    receiver_node_set = graph.edge_key_by_name(name).node_sets[1]
+    num_receivers = int(graph.nodes[receiver_node_set].n_node[0])
+    shuffled_time = _time_aggregation(_shuffle_edges(edge_set), num_receivers)
+    builder_time = _time_aggregation(edge_set, num_receivers)
+    if edge_set.constant_in_degree is not None:
+      dense_time = _time_aggregation(edge_set, num_receivers, dense=True)
+    else:
+      dense_time = np.nan
+    print(f"{name:>10} {edge_set.indices.receivers.shape[0]:>10} "
+          f"{num_receivers:>10} {shuffled_time:>13.4f} {builder_time:>18.4f} "
+          f"{dense_time:>10.4f}")
+
+  mesh2grid_graph = graphs["mesh2grid"]
+  edge_key = mesh2grid_graph.edge_key_by_name("mesh2grid")
+  sparse_graph = mesh2grid_graph._replace(edges={
+      edge_key: mesh2grid_graph.edges[edge_key]._replace(
+          constant_in_degree=None)})
+  print("mesh2grid decoder step (s): "
+        f"segment_sum {_time_mesh2grid_decoder(sparse_graph):.4f}, "
+        f"dense {_time_mesh2grid_decoder(mesh2grid_graph):.4f}")
+
+
+if __name__ == "__main__":
+  app.run(main)
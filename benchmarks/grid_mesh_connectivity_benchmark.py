@@ -0,0 +1,96 @@
+# Copyright 2024 DeepMind Technologies Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark for the grid to mesh connectivity queries.
+
+Times, for regular lat/lon grids at several resolutions:
+* the grid2mesh radius query (`radius_query_indices`),
+* the mesh2grid triangle locators (`in_mesh_triangle_indices`, based on
+  trimesh, and `in_mesh_triangle_indices_hierarchical`).
+
+Usage:
+  python benchmarks/grid_mesh_connectivity_benchmark.py \
+      --resolutions=1,0.25,0.1 --mesh_size=6
+"""
+
+import time
+
+from absl import app
+from absl import flags
+from graphcast import grid_mesh_connectivity
+from graphcast import icosahedral_mesh
+import numpy as np
+
+_RESOLUTIONS = flags.DEFINE_list(
+    "resolutions", ["1", "0.25", "0.1"], "Grid resolutions, in degrees.")
+_MESH_SIZE = flags.DEFINE_integer(
+    "mesh_size", 6, "Number of refinements of the icosahedral mesh.")
+_RADIUS_QUERY_FRACTION_EDGE_LENGTH = flags.DEFINE_float(
+    "radius_query_fraction_edge_length", 0.6,
+    "Radius of the grid2mesh query, relative to the longest mesh edge.")
+_WORKERS = flags.DEFINE_integer(
+    "workers", -1, "Number of threads for the radius query.")
+_SKIP_TRIMESH = flags.DEFINE_bool(
+    "skip_trimesh", False, "Whether to skip the (slow) trimesh locator.")
+
+
+def _timed(fn, **kwargs):
+  start = time.perf_counter()
+  result = fn(**kwargs)
+  return result, time.perf_counter() - start
+
+
+def main(argv):
+  del argv
+  meshes = icosahedral_mesh.get_hierarchy_of_triangular_meshes_for_sphere(
+      splits=_MESH_SIZE.value)
+  senders, receivers = icosahedral_mesh.faces_to_edges(meshes[-1].faces)
+  max_edge_length = np.linalg.norm(
+      meshes[-1].vertices[senders] - meshes[-1].vertices[receivers],
+      axis=-1).max()
+  radius = max_edge_length * _RADIUS_QUERY_FRACTION_EDGE_LENGTH.value
+
+  for resolution in map(float, _RESOLUTIONS.value):
+    grid_kwargs = dict(
+        grid_latitude=np.linspace(-90., 90., int(round(180 / resolution)) + 1),
+        grid_longitude=np.arange(int(round(360 / resolution))) * resolution)
+    num_grid_points = (grid_kwargs["grid_latitude"].shape[0] *
+                       grid_kwargs["grid_longitude"].shape[0])
+    print(f"Resolution {resolution} deg ({num_grid_points} grid points), "
+          f"mesh size {_MESH_SIZE.value}:")
+
+    (grid_indices, _), elapsed = _timed(
+        grid_mesh_connectivity.radius_query_indices,
+        mesh=meshes[-1], radius=radius, workers=_WORKERS.value, **grid_kwargs)
+    print(f"  radius_query_indices: {elapsed:.2f} s "
+          f"({grid_indices.shape[0]} edges)")
+
+    (_, mesh_indices), elapsed = _timed(
+        grid_mesh_connectivity.in_mesh_triangle_indices_hierarchical,
+        meshes=meshes, **grid_kwargs)
+    print(f"  in_mesh_triangle_indices_hierarchical: {elapsed:.2f} s")
+
+    if not _SKIP_TRIMESH.value:
+      (_, expected_mesh_indices), elapsed = _timed(
+          grid_mesh_connectivity.in_mesh_triangle_indices,
+          mesh=meshes[-1], **grid_kwargs)
+      num_mismatches = np.any(
+          mesh_indices.reshape([-1, 3]) !=
+          expected_mesh_indices.reshape([-1, 3]), axis=-1).sum()
+      print(f"  in_mesh_triangle_indices (trimesh): {elapsed:.2f} s "
+            f"({num_mismatches} grid points located in a different, "
+            "adjacent face)")
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,60 @@
+# Copyright 2024 DeepMind Technologies Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark for building the hierarchy of icosahedral meshes.
+
+Usage:
+  python benchmarks/icosahedral_mesh_benchmark.py --max_splits=7
+"""
+
+import time
+import tracemalloc
+
+from absl import app
+from absl import flags
+from graphcast import icosahedral_mesh
+
+_MIN_SPLITS = flags.DEFINE_integer(
+    "min_splits", 0, "Smallest number of splits to benchmark.")
+_MAX_SPLITS = flags.DEFINE_integer(
+    "max_splits", 7, "Largest number of splits to benchmark.")
+_REPEATS = flags.DEFINE_integer(
+    "repeats", 3, "Number of timed repetitions, the best one is reported.")
+
+
+def main(argv):
+  del argv
+  print(f"{'splits':>6} {'vertices':>10} {'faces':>10} "
+        f"{'best time (s)':>14} {'peak alloc (MiB)':>17}")
+  for splits in range(_MIN_SPLITS.value, _MAX_SPLITS.value + 1):
+    times = []
+    for _ in range(_REPEATS.value):
+      start = time.perf_counter()
+      meshes = icosahedral_mesh.get_hierarchy_of_triangular_meshes_for_sphere(
+          splits=splits)
+      times.append(time.perf_counter() - start)
+
+    # Measured separately, since tracing allocations slows everything down.
+    tracemalloc.start()
+    icosahedral_mesh.get_hierarchy_of_triangular_meshes_for_sphere(
+        splits=splits)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{splits:>6} {meshes[-1].vertices.shape[0]:>10} "
+          f"{meshes[-1].faces.shape[0]:>10} {min(times):>14.4f} "
+          f"{peak / 2**20:>17.1f}")
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,148 @@
+# Copyright 2024 DeepMind Technologies Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark for the overhead of the chunked rollout.
+
+Runs `rollout.chunked_prediction` with the default (xarray, host) rollout and
+with the device resident rollout, on random data with the variables of the
+NCEP GraphCast runs. The predictor is a cheap jitted function, so the timings
+are dominated by the rollout itself rather than by the model. Reports the wall
+time per step of `chunked_prediction`, and the peak host memory traced by
+`tracemalloc` (which includes numpy arrays, but not the buffers of jax arrays)
+while only iterating over the chunks of the rollout.
+
+Usage:
+  python benchmarks/rollout_benchmark.py --resolution=1 --num_steps=40
+"""
+
+import time
+import tracemalloc
+
+from absl import app
+from absl import flags
+from graphcast import graphcast
+from graphcast import rollout
+import jax
+import numpy as np
+import xarray
+
+_RESOLUTION = flags.DEFINE_float("resolution", 1., "Grid resolution, degrees.")
+_NUM_STEPS = flags.DEFINE_integer("num_steps", 40, "Number of 6h steps.")
+_NUM_STEPS_PER_CHUNK = flags.DEFINE_integer(
+    "num_steps_per_chunk", 1, "Number of steps per call of the predictor.")
+_REPEATS = flags.DEFINE_integer(
+    "repeats", 3, "Number of timed runs, the best one is reported.")
+
+
+def _get_data():
+  """Returns random inputs, targets template and forcings."""
+  task_config = graphcast.TASK_13
+  lat = np.arange(-90., 90. + _RESOLUTION.value / 2, _RESOLUTION.value)
+  lon = np.arange(0., 360., _RESOLUTION.value)
+  level = np.array(task_config.pressure_levels)
+  input_time = np.array([-6, 0], dtype="timedelta64[h]")
+  target_time = (
+      np.arange(1, _NUM_STEPS.value + 1) * np.timedelta64(6, "h"))
+  rng = np.random.default_rng(0)
+
+  def dataset(variables, time):
+    data_vars = {}
+    for name in variables:
+      if name in graphcast.STATIC_VARS:
+        dims = ("lat", "lon")
+      elif name in ("year_progress_sin", "year_progress_cos"):
+        dims = ("batch", "time")
+      elif name in ("day_progress_sin", "day_progress_cos"):
+        dims = ("batch", "time", "lon")
+      elif name in graphcast.ALL_ATMOSPHERIC_VARS:
+        dims = ("batch", "time", "lat", "lon", "level")
+      else:
+        dims = ("batch", "time", "lat", "lon")
+      sizes = dict(batch=1, time=len(time), lat=len(lat), lon=len(lon),
+                   level=len(level))
+      data_vars[name] = (
+          dims, rng.normal(size=[sizes[d] for d in dims]).astype(np.float32))
+    return xarray.Dataset(
+        data_vars, coords=dict(time=time, lat=lat, lon=lon, level=level))
+
+  inputs = dataset(task_config.input_variables, input_time)
+  targets_template = dataset(task_config.target_variables, target_time)
+  forcings = dataset(task_config.forcing_variables, target_time)
+  return inputs, targets_template, forcings
+
+
+@jax.jit
+def _predictor_fn(rng, inputs, targets_template, forcings):
+  """Persistence, plus something that depends on the forcings."""
+  del rng
+  last_inputs = inputs.isel(time=-1, drop=True)
+  toa = forcings.toa_incident_solar_radiation
+  predictions = {}
+  for name, template in targets_template.data_vars.items():
+    predictions[name] = (last_inputs[name] + 1e-3 * toa).transpose(
+        *template.dims)
+  return xarray.Dataset(predictions)
+
+
+def _run(inputs, targets_template, forcings, device_resident):
+  return rollout.chunked_prediction(
+      _predictor_fn,
+      rng=jax.random.PRNGKey(0),
+      inputs=inputs,
+      targets_template=targets_template,
+      forcings=forcings,
+      num_steps_per_chunk=_NUM_STEPS_PER_CHUNK.value,
+      device_resident=device_resident)
+
+
+def main(argv):
+  del argv
+  inputs, targets_template, forcings = _get_data()
+  print(f"{'rollout':>16} {'time/step (ms)':>15} "
+        f"{'peak traced host MB':>20}")
+  results = {}
+  for device_resident in (False, True):
+    # Compiles everything.
+    results[device_resident] = _run(
+        inputs, targets_template, forcings, device_resident)
+
+    times = []
+    for _ in range(_REPEATS.value):
+      start = time.perf_counter()
+      _run(inputs, targets_template, forcings, device_resident)
+      times.append(time.perf_counter() - start)
+
+    # Only the rollout: each chunk is copied to host and dropped.
+    tracemalloc.start()
+    for chunk in rollout.chunked_prediction_generator(
+        _predictor_fn,
+        rng=jax.random.PRNGKey(0),
+        inputs=inputs,
+        targets_template=targets_template,
+        forcings=forcings,
+        num_steps_per_chunk=_NUM_STEPS_PER_CHUNK.value,
+        device_resident=device_resident):
+      jax.device_get(chunk)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    name = "device resident" if device_resident else "default"
+    print(f"{name:>16} {min(times) / _NUM_STEPS.value * 1e3:>15.2f} "
+          f"{peak / 2**20:>20.2f}")
+
+  # Both rollouts make the same predictions.
+  xarray.testing.assert_allclose(results[False], results[True])
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,159 @@
+# Copyright 2024 DeepMind Technologies Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark for the multi-device ensemble rollouts.
+
+Runs `rollout.chunked_prediction_generator_multiple_runs` with the samples
+pmapped over the devices, and with the samples sharded over a mesh of the same
+devices, on random data with the variables of the NCEP GraphCast runs. The
+predictor is a cheap function, so the timings are dominated by the rollout
+itself rather than by the model. Reports the number of sample steps per second,
+and the peak memory held by live jax arrays on any single device, sampled after
+every chunk.
+
+Usage:
+  XLA_FLAGS=--xla_force_host_platform_device_count=4 \
+    python benchmarks/sharded_rollout_benchmark.py --resolution=2
+"""
+
+import collections
+import time
+
+from absl import app
+from absl import flags
+from graphcast import graphcast
+from graphcast import rollout
+from graphcast import xarray_jax
+import jax
+import numpy as np
+import xarray
+
+_RESOLUTION = flags.DEFINE_float("resolution", 2., "Grid resolution, degrees.")
+_NUM_STEPS = flags.DEFINE_integer("num_steps", 20, "Number of 6h steps.")
+_SAMPLES_PER_DEVICE = flags.DEFINE_integer(
+    "samples_per_device", 2, "Number of samples per device.")
+
+
+def _get_data():
+  """Returns random inputs, targets template and forcings."""
+  task_config = graphcast.TASK_13
+  lat = np.arange(-90., 90. + _RESOLUTION.value / 2, _RESOLUTION.value)
+  lon = np.arange(0., 360., _RESOLUTION.value)
+  level = np.array(task_config.pressure_levels)
+  input_time = np.array([-6, 0], dtype="timedelta64[h]")
+  target_time = (
+      np.arange(1, _NUM_STEPS.value + 1) * np.timedelta64(6, "h"))
+  rng = np.random.default_rng(0)
+
+  def dataset(variables, time):
+    data_vars = {}
+    for name in variables:
+      if name in graphcast.STATIC_VARS:
+        dims = ("lat", "lon")
+      elif name in ("year_progress_sin", "year_progress_cos"):
+        dims = ("batch", "time")
+      elif name in ("day_progress_sin", "day_progress_cos"):
+        dims = ("batch", "time", "lon")
+      elif name in graphcast.ALL_ATMOSPHERIC_VARS:
+        dims = ("batch", "time", "lat", "lon", "level")
+      else:
+        dims = ("batch", "time", "lat", "lon")
+      sizes = dict(batch=1, time=len(time), lat=len(lat), lon=len(lon),
+                   level=len(level))
+      data_vars[name] = (
+          dims, rng.normal(size=[sizes[d] for d in dims]).astype(np.float32))
+    return xarray.Dataset(
+        data_vars, coords=dict(time=time, lat=lat, lon=lon, level=level))
+
+  inputs = dataset(task_config.input_variables, input_time)
+  targets_template = dataset(task_config.target_variables, target_time)
+  forcings = dataset(task_config.forcing_variables, target_time)
+  return inputs, targets_template, forcings
+
+
+@jax.jit
+def _predictor_fn(rng, inputs, targets_template, forcings):
+  """Persistence, plus noise and something that depends on the forcings."""
+  noise = xarray_jax.DataArray(jax.random.normal(rng, ()), dims=())
+  last_inputs = inputs.isel(time=-1, drop=True)
+  toa = forcings.toa_incident_solar_radiation
+  predictions = {}
+  for name, template in targets_template.data_vars.items():
+    predictions[name] = (last_inputs[name] + 1e-3 * toa + noise).transpose(
+        *template.dims)
+  return xarray.Dataset(predictions)
+
+
+def _max_device_bytes():
+  """Bytes held by live jax arrays on the most loaded device."""
+  # The shards of an array are arrays too, so buffers are counted only once.
+  buffers = {}
+  for array in jax.live_arrays():
+    for shard in array.addressable_shards:
+      buffers[(shard.device, shard.data.unsafe_buffer_pointer())] = (
+          shard.data.nbytes)
+  device_bytes = collections.Counter()
+  for (device, _), nbytes in buffers.items():
+    device_bytes[device] += nbytes
+  return max(device_bytes.values(), default=0)
+
+
+def _run(inputs, targets_template, forcings, **kwargs):
+  """Returns the time taken by the rollout, and the peak device bytes."""
+  num_samples = _SAMPLES_PER_DEVICE.value * jax.device_count()
+  peak_bytes = 0
+  start = time.perf_counter()
+  for chunk in rollout.chunked_prediction_generator_multiple_runs(
+      rngs=jax.random.split(jax.random.PRNGKey(0), num_samples),
+      inputs=inputs,
+      targets_template=targets_template,
+      forcings=forcings,
+      num_samples=num_samples,
+      **kwargs):
+    jax.block_until_ready(chunk)
+    peak_bytes = max(peak_bytes, _max_device_bytes())
+    jax.device_get(chunk)
+    del chunk
+  return time.perf_counter() - start, peak_bytes
+
+
+def main(argv):
+  del argv
+  inputs, targets_template, forcings = _get_data()
+  devices = jax.devices()
+  pmapped_predictor_fn = xarray_jax.pmap(
+      _predictor_fn, dim="sample", devices=devices)
+
+  def pmap_predictor_fn(rng, inputs, targets_template, forcings):
+    return pmapped_predictor_fn(rng, inputs, targets_template, forcings)
+
+  runs = {
+      "pmap": dict(predictor_fn=pmap_predictor_fn, pmap_devices=devices),
+      "sharded": dict(predictor_fn=_predictor_fn,
+                      mesh=jax.sharding.Mesh(np.array(devices), ("sample",))),
+  }
+  num_sample_steps = (
+      _SAMPLES_PER_DEVICE.value * len(devices) * _NUM_STEPS.value)
+  print(f"{len(devices)} devices, {_SAMPLES_PER_DEVICE.value} samples per "
+        f"device, {_NUM_STEPS.value} steps")
+  print(f"{'rollout':>8} {'sample steps/s':>15} {'peak MB per device':>19}")
+  for name, kwargs in runs.items():
+    # Compiles everything.
+    _run(inputs, targets_template, forcings, **kwargs)
+    seconds, peak_bytes = _run(inputs, targets_template, forcings, **kwargs)
+    print(f"{name:>8} {num_sample_steps / seconds:>15.1f} "
+          f"{peak_bytes / 2**20:>19.1f}")
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -142,6 +142,9 @@ class Predictor(predictor_base.Predictor):
         The number of time frames is used to set the number of unroll of the AR
         predictor (e.g. multiple unroll of the inner predictor for one time step
         in the targets is not supported yet).
+        Only its structure is used, so its data can be lazy or zero-strided
+        (e.g. `np.broadcast_to`). Arguments of `jax.jit` are copied to the
+        device though, so `rollout` only passes one chunk of it at a time.
       forcings: Variables that will be fed to the model. The variables
         should not overlap with the target ones. The time coordinates of the
         forcing variables should match the target ones.
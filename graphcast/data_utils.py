@@ -209,6 +209,56 @@ def add_tisr_var(data: xarray.Dataset) -> None:
   data.update({TISR: tisr})
 
 
+def get_forcings(
+    data: xarray.Dataset, forcing_variables: Tuple[str, ...]
+) -> xarray.Dataset:
+  """Computes the forcing variables for the times of `data`.
+
+  Only the `datetime`, `lat` and `lon` coordinates of `data` are used, so this
+  can be called with the targets template of a single chunk of a rollout (see
+  the `forcings_fn` argument of `rollout.chunked_prediction_generator`) to
+  compute the forcings of that chunk only, rather than for the whole forecast
+  up front.
+
+  Args:
+    data: Xarray dataset with the coordinates to compute the forcings for.
+    forcing_variables: Names of the forcing variables to compute.
+
+  Returns:
+    Dataset with the `forcing_variables`, and the coordinates of `data`.
+
+  Raises:
+    ValueError if some of the `forcing_variables` can't be computed from the
+    coordinates.
+  """
+  not_computed = set(forcing_variables) - _DERIVED_VARS - {TISR}
+  if not_computed:
+    raise ValueError(
+        f"Forcing variables {sorted(not_computed)} can't be computed from the "
+        "coordinates.")
+
+  datetime = data.coords["datetime"]
+  if "batch" in datetime.dims and datetime.sizes["batch"] > 1:
+    # The TISR can only be computed for one batch element at a time.
+    return xarray.concat(
+        [get_forcings(data.isel(batch=[i]), forcing_variables)
+         for i in range(datetime.sizes["batch"])],
+        dim="batch")
+
+  forcings = xarray.Dataset(coords=data.coords)
+  if set(forcing_variables) & _DERIVED_VARS:
+    add_derived_vars(forcings)
+  if set(forcing_variables) & {TISR}:
+    add_tisr_var(forcings)
+  forcings = forcings[list(forcing_variables)]
+
+  # A `batch` dimension without coordinates is not seen above, but the forcings
+  # are the same for all the batch elements then.
+  if "batch" in data.dims and "batch" not in forcings.dims:
+    forcings = forcings.expand_dims(batch=data.sizes["batch"], axis=0)
+  return forcings
+
+
 def extract_input_target_times(
     dataset: xarray.Dataset,
     input_duration: TimedeltaLike,
@@ -357,3 +407,108 @@ def extract_inputs_targets_forcings(
   targets = targets[list(target_variables)]
 
   return inputs, targets, forcings
+
+
+def extract_inputs_and_targets_template(
+    dataset: xarray.Dataset,
+    *,
+    input_variables: Tuple[str, ...],
+    target_variables: Tuple[str, ...],
+    forcing_variables: Tuple[str, ...],
+    pressure_levels: Tuple[int, ...],
+    input_duration: TimedeltaLike,
+    target_lead_times: TargetLeadTimes,
+    ) -> Tuple[xarray.Dataset, xarray.Dataset]:
+  """Extracts inputs and a targets template, for targets past the dataset.
+
+  Unlike `extract_inputs_targets_forcings`, `dataset` only needs to hold the
+  inputs, and its last time is the forecast reference time (lead time 0). No
+  forcings are returned: the targets template has the `datetime` coordinates of
+  the target lead times, from which `get_forcings` computes the forcings of
+  each chunk of a rollout.
+
+  The data of the targets template are read-only, zero-strided arrays of NaNs
+  (see `np.broadcast_to`), so it takes O(1) memory in the number of lead times.
+  It can be used as is with `rollout` and `autoregressive.Predictor`, which only
+  use the structure of the template, and never copy more than a chunk of it.
+
+  Args:
+    dataset: An xarray.Dataset with a 'time' dimension of evenly spaced
+      timedeltas, and a `datetime` coordinate.
+    input_variables: Names of the input variables.
+    target_variables: Names of the target variables.
+    forcing_variables: Names of the forcing variables.
+    pressure_levels: Pressure levels to select.
+    input_duration: pandas.Timedelta or something convertible to it.
+    target_lead_times: Either a single lead time, a slice of lead times or a
+      sequence of lead times, as in `extract_input_target_times`. The lead times
+      of a slice are spaced by its step, or by the time resolution of `dataset`
+      if it has none.
+
+  Returns:
+    inputs: The inputs, with lead times ending at 0.
+    targets_template: Zero-strided NaNs with the shape of the targets, for the
+      lead times.
+  """
+  if set(forcing_variables) & set(target_variables):
+    raise ValueError(
+        f"Forcing variables {forcing_variables} should not "
+        f"overlap with target variables {target_variables}."
+    )
+
+  dataset = dataset.sel(level=list(pressure_levels))
+  time = dataset.coords["time"]
+  dataset = dataset.assign_coords(time=time - time[-1])
+
+  input_duration = pd.Timedelta(input_duration)
+  zero = pd.Timedelta(0)
+  epsilon = pd.Timedelta(1, "ns")
+  inputs = dataset.sel({"time": slice(-input_duration + epsilon, zero)})
+  # Forcings which are also inputs are computed for the input times only.
+  input_forcings = [k for k in forcing_variables
+                    if k in input_variables and k not in inputs]
+  if input_forcings:
+    inputs = inputs.assign({
+        k: v.variable for k, v in get_forcings(
+            inputs, tuple(input_forcings)).data_vars.items()})
+  inputs = inputs[list(input_variables)].drop_vars("datetime")
+
+  if isinstance(target_lead_times, slice):
+    if target_lead_times.step is not None:
+      step = pd.Timedelta(target_lead_times.step)
+    else:
+      time_steps = np.unique(np.diff(time.data))
+      if len(time_steps) != 1:
+        raise ValueError(
+            "A step is needed for the target lead times, as the dataset has no "
+            "single time resolution.")
+      step = pd.Timedelta(time_steps[0])
+    start = (step if target_lead_times.start is None
+             else pd.Timedelta(target_lead_times.start))
+    lead_times = pd.timedelta_range(
+        start, pd.Timedelta(target_lead_times.stop), freq=step)
+  else:
+    lead_times, _ = _process_target_lead_times_and_get_duration(
+        target_lead_times)
+  lead_times = np.array(lead_times, dtype="timedelta64[ns]")
+
+  # Only the structure of the template is used, so all its elements share a
+  # single NaN, and it takes O(1) memory whatever the number of lead times.
+  data_vars = {}
+  for name in target_variables:
+    variable = dataset[name].variable
+    sizes = dict(variable.sizes, time=len(lead_times))
+    data_vars[name] = (
+        variable.dims,
+        np.broadcast_to(np.array(np.nan, dtype=variable.dtype),
+                        [sizes[d] for d in variable.dims]),
+        variable.attrs)
+  coords = {k: v.variable for k, v in dataset.coords.items()
+            if "time" not in v.dims}
+  reference_datetime = dataset.coords["datetime"].isel(time=-1, drop=True)
+  coords.update(
+      time=lead_times,
+      datetime=(reference_datetime
+                + xarray.DataArray(lead_times, dims="time")).variable)
+  targets_template = xarray.Dataset(data_vars, coords=coords)
+  return inputs, targets_template
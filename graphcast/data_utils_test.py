@@ -13,10 +13,12 @@
 # limitations under the License.
 """Tests for `data_utils.py`."""
 
+import dataclasses
 import datetime
 from absl.testing import absltest
 from absl.testing import parameterized
 from graphcast import data_utils
+from graphcast import graphcast
 import numpy as np
 import xarray as xa
 
@@ -305,6 +307,101 @@ class DataUtilsTest(parameterized.TestCase):
     with self.assertRaisesRegex(ValueError, r"cannot select a dimension"):
       data_utils.add_tisr_var(data)
 
+  def test_get_forcings_matches_extract_inputs_targets_forcings(self):
+    task_config = graphcast.TASK_13
+    time = np.arange(6) * np.timedelta64(6, "h")
+    shapes = {
+        "atmospheric": (["batch", "time", "level", "lat", "lon"],
+                        (1, 6, len(task_config.pressure_levels), 3, 4)),
+        "surface": (["batch", "time", "lat", "lon"], (1, 6, 3, 4)),
+        "static": (["lat", "lon"], (3, 4)),
+    }
+    def kind(name):
+      if name in graphcast.TARGET_ATMOSPHERIC_VARS:
+        return "atmospheric"
+      return "static" if name in graphcast.STATIC_VARS else "surface"
+    # The dataset holds every variable of the task except its forcings.
+    variables = (set(task_config.input_variables)
+                 | set(task_config.target_variables)
+                 ) - set(task_config.forcing_variables)
+    dataset = xa.Dataset(
+        data_vars={
+            name: (shapes[kind(name)][0],
+                   np.random.normal(size=shapes[kind(name)][1]))
+            for name in sorted(variables)
+        },
+        coords={
+            "lat": np.array([-45.0, 0.0, 45.0]),
+            "lon": np.array([0.0, 90.0, 180.0, 270.0]),
+            "level": np.array(task_config.pressure_levels),
+            "time": time,
+            "datetime": xa.Variable(
+                ("batch", "time"),
+                np.datetime64("2024-03-01T00") + time[None],
+            ),
+        },
+    )
+    forcing_variables = task_config.forcing_variables
+    task_kwargs = dataclasses.asdict(task_config)
+    expected_inputs, expected_targets, expected_forcings = (
+        data_utils.extract_inputs_targets_forcings(
+            dataset, target_lead_times=slice("6h", "24h"), **task_kwargs))
+
+    # Only the inputs are needed, the targets are past the dataset.
+    inputs, targets_template = data_utils.extract_inputs_and_targets_template(
+        dataset.isel(time=slice(0, 2)), target_lead_times=slice("6h", "24h"),
+        **task_kwargs)
+    xa.testing.assert_allclose(expected_inputs, inputs)
+    self.assertEqual(dict(expected_targets.sizes), dict(targets_template.sizes))
+    np.testing.assert_array_equal(
+        expected_targets.time.data, targets_template.time.data)
+    for variable in targets_template.data_vars.values():
+      self.assertTrue(np.isnan(variable.data).all())
+      # The template takes O(1) memory in the number of lead times.
+      self.assertEqual(variable.data.strides, (0,) * variable.ndim)
+
+    forcings = data_utils.get_forcings(targets_template, forcing_variables)
+    xa.testing.assert_allclose(
+        expected_forcings, forcings.drop_vars("datetime"))
+
+  def test_get_forcings_computes_each_batch_element(self):
+    time = np.array([6, 12], dtype="timedelta64[h]")
+    datetime = np.array(
+        ["2024-01-01T00", "2024-07-01T06"], dtype="datetime64[ns]")
+    data = xa.Dataset(
+        coords={
+            "lat": np.array([-45.0, 0.0, 45.0]),
+            "lon": np.array([0.0, 90.0, 180.0, 270.0]),
+            "time": time,
+            "datetime": xa.Variable(
+                ("batch", "time"), datetime[:, None] + time[None]),
+        },
+    )
+    forcing_variables = (data_utils.TISR, "year_progress_sin")
+
+    forcings = data_utils.get_forcings(data, forcing_variables)
+
+    self.assertEqual(forcings.sizes["batch"], 2)
+    for i in range(2):
+      xa.testing.assert_allclose(
+          data_utils.get_forcings(data.isel(batch=[i]), forcing_variables),
+          forcings.isel(batch=[i]))
+
+  def test_get_forcings_fails_with_forcings_not_computed(self):
+    data = xa.Dataset(
+        coords={
+            "lat": np.array([2.0, 1.0]),
+            "lon": np.array([0.0, 0.5]),
+            "time": np.array([100, 200], dtype="timedelta64[s]"),
+            "datetime": xa.Variable(
+                "time", np.array([10, 20], dtype="datetime64[D]")
+            ),
+        },
+    )
+
+    with self.assertRaisesRegex(ValueError, "sea_surface_temperature"):
+      data_utils.get_forcings(data, ("sea_surface_temperature",))
+
 
 if __name__ == "__main__":
   absltest.main()
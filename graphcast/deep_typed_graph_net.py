@@ -35,6 +35,7 @@ Generalization to TypedGraphs of the deep Graph Neural Network from:
 """
 
 import functools
+import re
 from typing import Callable, List, Mapping, Optional, Tuple
 
 import chex
@@ -61,6 +62,10 @@ class DeepTypedGraphNet(hk.Module):
 
   If embed_{nodes,edges} is specified the node/edge features will be embedded
   into a fixed dimensionality before running the first step of message passing.
+  Node and edge features that are the same for all the elements of a batch,
+  e.g. structural features, can be passed with size 1 batch axes (the axes
+  between the leading node/edge axis and the feature axis), so they are
+  embedded only once. They are broadcast to the full batch shape afterwards.
 
   If {node,edge}_output_size the final node/edge features will be embedded into
   the specified output size.
@@ -77,6 +82,21 @@ class DeepTypedGraphNet(hk.Module):
     such that the weights used at each iteration are:
     [W_1, W_2, ... , W_N] * M
 
+  By default the N unshared message passing steps are unrolled in Python, so
+  the compiled program contains N copies of the processor. With
+  `scan_message_passing_steps=True` the parameters of the N steps are instead
+  stacked along a leading axis and the steps are run with `hk.layer_stack`
+  (i.e. a `jax.lax.scan`), which makes compilation time and the size of the
+  compiled program independent of N. The computation is the same, and
+  `_ProcessorStepsTransparencyMap` keeps the parameter tree identical to the
+  unrolled one, so the same checkpoints can be used with either mode.
+
+  The edge embeddings of edge sets whose features don't change from call to
+  call (e.g. the structural features of a fixed graph) can be computed once
+  with `embed_edges` and passed to `__call__` as `edge_embeddings`, which then
+  skips the edge embedder MLPs for those edge sets. If norm conditioning is
+  used, it is still applied to the precomputed embeddings at every call.
+
   """
 
   def __init__(self,
@@ -98,6 +118,7 @@ class DeepTypedGraphNet(hk.Module):
                f32_aggregation: bool = False,
                aggregate_edges_for_nodes_fn: str = "segment_sum",
                aggregate_normalization: Optional[float] = None,
+               scan_message_passing_steps: bool = False,
                name: str = "DeepTypedGraphNet"):
     """Inits the model.
 
@@ -143,6 +164,9 @@ class DeepTypedGraphNet(hk.Module):
         increase the number of edges connected to a node. In particular, this is
         useful when using segment_sum, but should not be combined with
         segment_mean.
+      scan_message_passing_steps: If True, the unshared message passing steps
+        are run with `hk.layer_stack` over stacked parameters, rather than
+        unrolled. See the class docstring.
       name: Name of the model.
     """
 
@@ -171,7 +195,10 @@ class DeepTypedGraphNet(hk.Module):
     self._f32_aggregation = f32_aggregation
     self._aggregate_edges_for_nodes_fn = _get_aggregate_edges_for_nodes_fn(
         aggregate_edges_for_nodes_fn)
+    self._dense_aggregate_edges_for_nodes_fn = _DENSE_AGGREGATE_FNS.get(
+        aggregate_edges_for_nodes_fn)
     self._aggregate_normalization = aggregate_normalization
+    self._scan_message_passing_steps = scan_message_passing_steps
 
     if aggregate_normalization:
       # using aggregate_normalization only makes sense with segment_sum.
@@ -179,11 +206,35 @@ class DeepTypedGraphNet(hk.Module):
 
   def __call__(self,
                input_graph: typed_graph.TypedGraph,
-               global_norm_conditioning: Optional[chex.Array] = None
+               global_norm_conditioning: Optional[chex.Array] = None,
+               edge_embeddings: Optional[Mapping[str, chex.Array]] = None,
                ) -> typed_graph.TypedGraph:
-    """Forward pass of the learnable dynamics model."""
+    """Forward pass of the learnable dynamics model.
+
+    Args:
+      input_graph: Input graph.
+      global_norm_conditioning: Conditioning for the normalization of all the
+        MLPs, required iff `use_norm_conditioning` is True.
+      edge_embeddings: Optional precomputed embeddings, as returned by
+        `embed_edges`, keyed by edge set name. They are used instead of running
+        the edge embedder on the features of those edge sets, which are
+        ignored.
+
+    Returns:
+      The output graph.
+    """
+    if self._use_norm_conditioning and global_norm_conditioning is None:
+      raise ValueError(
+          "When using norm conditioning, `global_norm_conditioning` must"
+          "be passed to the call method.")
+    if not self._use_norm_conditioning and global_norm_conditioning is not None:
+      raise ValueError(
+          "`globa_norm_conditioning` was passed, but `norm_conditioning`"
+          " is not enabled.")
+
     embedder_network, processor_networks, decoder_network = (
-        self._networks_builder(input_graph, global_norm_conditioning)
+        self._networks_builder(
+            input_graph, global_norm_conditioning, edge_embeddings)
     )
 
     # Embed input features (if applicable).
@@ -195,10 +246,37 @@ class DeepTypedGraphNet(hk.Module):
     # Compute outputs from the last latent graph (if applicable).
     return self._output(latent_graph_m, decoder_network)
 
+  def embed_edges(
+      self, input_graph: typed_graph.TypedGraph) -> Mapping[str, chex.Array]:
+    """Embeds the features of all the edge sets of `input_graph`.
+
+    The embeddings do not include the norm conditioning (if any), which
+    `__call__` applies on top of them, so they only depend on the parameters
+    and on the edge features.
+
+    Args:
+      input_graph: Graph whose edge features to embed. Its node features are
+        not used.
+
+    Returns:
+      The embedded edge features, keyed by edge set name, to be passed to
+      `__call__` as `edge_embeddings`.
+    """
+    if not self._embed_edges:
+      raise ValueError("`embed_edges` requires the edge embedder.")
+    # Built without norm conditioning, so the embedder network only runs the
+    # MLPs (and layer norms) that `__call__` would run on the same features.
+    embedder_network, _, _ = self._networks_builder(
+        input_graph._replace(nodes={}))
+    latent_graph = embedder_network(input_graph._replace(nodes={}))
+    return {edge_set_key.name: edge_set.features
+            for edge_set_key, edge_set in latent_graph.edges.items()}
+
   def _networks_builder(
       self,
       graph_template: typed_graph.TypedGraph,
       global_norm_conditioning: Optional[chex.Array] = None,
+      edge_embeddings: Optional[Mapping[str, chex.Array]] = None,
   ) -> Tuple[
       GraphToGraphNetwork, List[GraphToGraphNetwork], GraphToGraphNetwork
   ]:
@@ -209,24 +287,27 @@ class DeepTypedGraphNet(hk.Module):
               output_size], name=name + "_mlp", activation=self._activation)
       return jraph.concatenated_args(mlp)
 
+    def build_maybe_norm_conditioning(name):
+      # `global_norm_conditioning` is only missing with norm conditioning
+      # enabled when building the edge embedder for `embed_edges`.
+      if global_norm_conditioning is None:
+        return []
+      norm_conditioning_layer = mlp_builder.LinearNormConditioning(
+          name=name + "_norm_conditioning")
+      norm_conditioning_layer = functools.partial(
+          norm_conditioning_layer,
+          # Broadcast to the node/edge axis.
+          norm_conditioning=global_norm_conditioning[None],
+      )
+      return [norm_conditioning_layer]
+
     def build_mlp_with_maybe_layer_norm(name, output_size):
       network = build_mlp(name, output_size)
       stages = [network]
-      if self._use_norm_conditioning:
-        if global_norm_conditioning is None:
-          raise ValueError(
-              "When using norm conditioning, `global_norm_conditioning` must"
-              "be passed to the call method.")
-        # If using norm conditioning, it is no longer the responsibility of the
-        # LayerNorm module itself to learn its scale and offset. These will be
-        # learned for the module by the norm conditioning layer instead.
-        create_scale = create_offset = False
-      else:
-        if global_norm_conditioning is not None:
-          raise ValueError(
-              "`globa_norm_conditioning` was passed, but `norm_conditioning`"
-              " is not enabled.")
-        create_scale = create_offset = True
+      # If using norm conditioning, it is no longer the responsibility of the
+      # LayerNorm module itself to learn its scale and offset. These will be
+      # learned for the module by the norm conditioning layer instead.
+      create_scale = create_offset = not self._use_norm_conditioning
 
       if self._use_layer_norm:
         layer_norm = hk.LayerNorm(
@@ -234,26 +315,32 @@ class DeepTypedGraphNet(hk.Module):
             name=name + "_layer_norm")
         stages.append(layer_norm)
 
-      if self._use_norm_conditioning:
-        norm_conditioning_layer = mlp_builder.LinearNormConditioning(
-            name=name + "_norm_conditioning")
-        norm_conditioning_layer = functools.partial(
-            norm_conditioning_layer,
-            # Broadcast to the node/edge axis.
-            norm_conditioning=global_norm_conditioning[None],
-        )
-        stages.append(norm_conditioning_layer)
+      stages.extend(build_maybe_norm_conditioning(name))
 
       network = hk.Sequential(stages)
       return jraph.concatenated_args(network)
 
+    def build_precomputed_embedder(name, embeddings):
+      # Ignores the features, the MLP and layer norm have already been applied.
+      stages = [lambda unused_features: embeddings]
+      stages.extend(build_maybe_norm_conditioning(name))
+      return hk.Sequential(stages)
+
     # The embedder graph network independently embeds edge and node features.
     if self._embed_edges:
+      edge_embeddings = edge_embeddings or {}
       embed_edge_fn = _build_update_fns_for_edge_types(
           build_mlp_with_maybe_layer_norm,
-          graph_template,
+          graph_template._replace(edges={
+              k: v for k, v in graph_template.edges.items()
+              if k.name not in edge_embeddings}),
           "encoder_edges_",
           output_sizes=self._edge_latent_size)
+      for edge_set_name, embeddings in edge_embeddings.items():
+        embed_edge_fn[edge_set_name] = build_precomputed_embedder(
+            f"encoder_edges_{edge_set_name}", embeddings)
+    elif edge_embeddings:
+      raise ValueError("`edge_embeddings` requires the edge embedder.")
     else:
       embed_edge_fn = None
     if self._embed_nodes:
@@ -271,45 +358,65 @@ class DeepTypedGraphNet(hk.Module):
     embedder_network = typed_graph_net.GraphMapFeatures(
         **embedder_kwargs)
 
-    if self._f32_aggregation:
-      def aggregate_fn(data, *args, **kwargs):
-        dtype = data.dtype
-        data = data.astype(jnp.float32)
-        output = self._aggregate_edges_for_nodes_fn(data, *args, **kwargs)
-        if self._aggregate_normalization:
-          output = output / self._aggregate_normalization
-        output = output.astype(dtype)
-        return output
+    def wrap_aggregation_fn(aggregation_fn):
+      if self._f32_aggregation:
+        def aggregate_fn(data, *args, **kwargs):
+          dtype = data.dtype
+          data = data.astype(jnp.float32)
+          output = aggregation_fn(data, *args, **kwargs)
+          if self._aggregate_normalization:
+            output = output / self._aggregate_normalization
+          output = output.astype(dtype)
+          return output
 
+      else:
+        def aggregate_fn(data, *args, **kwargs):
+          output = aggregation_fn(data, *args, **kwargs)
+          if self._aggregate_normalization:
+            output = output / self._aggregate_normalization
+          return output
+      return aggregate_fn
+
+    aggregate_fn = wrap_aggregation_fn(self._aggregate_edges_for_nodes_fn)
+    # Used for edge sets with a constant in-degree, e.g. mesh2grid.
+    if self._dense_aggregate_edges_for_nodes_fn is not None:
+      dense_aggregate_fn = wrap_aggregation_fn(
+          self._dense_aggregate_edges_for_nodes_fn)
     else:
-      def aggregate_fn(data, *args, **kwargs):
-        output = self._aggregate_edges_for_nodes_fn(data, *args, **kwargs)
-        if self._aggregate_normalization:
-          output = output / self._aggregate_normalization
-        return output
+      dense_aggregate_fn = None
 
     # Create `num_message_passing_steps` graph networks with unshared parameters
     # that update the node and edge latent features.
     # Note that we can use `modules.InteractionNetwork` because
     # it also outputs the messages as updated edge latent features.
-    processor_networks = []
-    for step_i in range(self._num_message_passing_steps):
-      processor_networks.append(
-          typed_graph_net.InteractionNetwork(
-              update_edge_fn=_build_update_fns_for_edge_types(
-                  build_mlp_with_maybe_layer_norm,
-                  graph_template,
-                  f"processor_edges_{step_i}_",
-                  output_sizes=self._edge_latent_size),
-              update_node_fn=_build_update_fns_for_node_types(
-                  build_mlp_with_maybe_layer_norm,
-                  graph_template,
-                  f"processor_nodes_{step_i}_",
-                  output_sizes=self._node_latent_size),
-              aggregate_edges_for_nodes_fn=aggregate_fn,
-              include_sent_messages_in_node_update=(
-                  self._include_sent_messages_in_node_update),
-              ))
+    def build_processor_network(prefix_suffix):
+      return typed_graph_net.InteractionNetwork(
+          update_edge_fn=_build_update_fns_for_edge_types(
+              build_mlp_with_maybe_layer_norm,
+              graph_template,
+              f"processor_edges_{prefix_suffix}",
+              output_sizes=self._edge_latent_size),
+          update_node_fn=_build_update_fns_for_node_types(
+              build_mlp_with_maybe_layer_norm,
+              graph_template,
+              f"processor_nodes_{prefix_suffix}",
+              output_sizes=self._node_latent_size),
+          aggregate_edges_for_nodes_fn=aggregate_fn,
+          aggregate_edges_for_nodes_dense_fn=dense_aggregate_fn,
+          include_sent_messages_in_node_update=(
+              self._include_sent_messages_in_node_update),
+          )
+
+    if self._scan_message_passing_steps:
+      # A single network, whose modules are only created when it is called,
+      # i.e. inside of the `hk.layer_stack` in `_process`, so that their
+      # parameters are stacked across the message passing steps.
+      processor_networks = [
+          lambda graph: build_processor_network("")(graph)]
+    else:
+      processor_networks = [
+          build_processor_network(f"{step_i}_")
+          for step_i in range(self._num_message_passing_steps)]
 
     # The output MLPs converts edge/node latent features into the output sizes.
     output_kwargs = dict(
@@ -351,8 +458,13 @@ class DeepTypedGraphNet(hk.Module):
 
     # Embeds the node and edge features.
     latent_graph_0 = embedder_network(input_graph)
-    return latent_graph_0
 
+    # Features shared across the batch (e.g. structural features) may be
+    # passed with size 1 batch axes, so they are only embedded once. The
+    # message passing needs them at the full batch size.
+    return _broadcast_batch_axes(latent_graph_0)
+
+  @hk.transparent
   def _process(
       self,
       latent_graph_0: typed_graph.TypedGraph,
@@ -364,14 +476,42 @@ class DeepTypedGraphNet(hk.Module):
     # with unshared weights, and repeat that `self._num_processor_repetitions`
     # times.
     latent_graph = latent_graph_0
+    if self._scan_message_passing_steps:
+      # A single processor network is applied `num_message_passing_steps` times
+      # in a scan with a different slice of the stacked parameters each time.
+      # The stacking is transparent, so the parameters keep the same names and
+      # shapes as in the unrolled case.
+      # Only the features are carried through the scan, the rest of the graph
+      # (indices and their static metadata) is the same for all steps.
+      processor_network, = processor_networks
+
+      def process_step(node_features, edge_features):
+        latent_graph_k = self._process_step(
+            processor_network,
+            _replace_features(latent_graph, node_features, edge_features))
+        return _get_features(latent_graph_k)
+
+      process_steps = hk.layer_stack(
+          self._num_message_passing_steps,
+          transparent=True,
+          transparency_map=_ProcessorStepsTransparencyMap(),
+          name="processor")(process_step)
+      features = _get_features(latent_graph)
+      for unused_repetition_i in range(self._num_processor_repetitions):
+        features = process_steps(*features)
+      return _replace_features(latent_graph, *features)
+
     for unused_repetition_i in range(self._num_processor_repetitions):
       for processor_network in processor_networks:
         latent_graph = self._process_step(processor_network, latent_graph)
 
     return latent_graph
 
+  # Static, so that it does not add a name scope to the modules that the
+  # scanned processor network creates when it is called.
+  @staticmethod
   def _process_step(
-      self, processor_network_k,
+      processor_network_k,
       latent_graph_prev_k: typed_graph.TypedGraph) -> typed_graph.TypedGraph:
     """Single step of message passing with node/edge residual connections."""
 
@@ -402,6 +542,78 @@ class DeepTypedGraphNet(hk.Module):
     return output_network(latent_graph)
 
 
+def _broadcast_batch_axes(
+    graph: typed_graph.TypedGraph) -> typed_graph.TypedGraph:
+  """Broadcasts the batch axes of all the node and edge features together.
+
+  The batch axes are all the axes between the leading node/edge axis and the
+  trailing feature axis.
+
+  Args:
+    graph: Graph with a single feature array per node and edge set.
+
+  Returns:
+    The graph with all the node and edge features broadcast to the same batch
+    shape.
+  """
+  features = [v.features for v in graph.nodes.values()]
+  features += [v.features for v in graph.edges.values()]
+  batch_shape = jnp.broadcast_shapes(*[x.shape[1:-1] for x in features])
+
+  def broadcast(x):
+    return jnp.broadcast_to(x, x.shape[:1] + batch_shape + x.shape[-1:])
+
+  return graph._replace(
+      nodes={k: v._replace(features=broadcast(v.features))
+             for k, v in graph.nodes.items()},
+      edges={k: v._replace(features=broadcast(v.features))
+             for k, v in graph.edges.items()})
+
+
+def _get_features(graph: typed_graph.TypedGraph):
+  """Returns the node features and the edge features of a graph."""
+  node_features = {k: v.features for k, v in graph.nodes.items()}
+  edge_features = {k: v.features for k, v in graph.edges.items()}
+  return node_features, edge_features
+
+
+def _replace_features(graph: typed_graph.TypedGraph, node_features,
+                      edge_features) -> typed_graph.TypedGraph:
+  """Returns a copy of the graph with the given node and edge features."""
+  return graph._replace(
+      nodes={k: v._replace(features=node_features[k])
+             for k, v in graph.nodes.items()},
+      edges={k: v._replace(features=edge_features[k])
+             for k, v in graph.edges.items()})
+
+
+class _ProcessorStepsTransparencyMap(hk.LayerStackTransparencyMapping):
+  """Maps the scanned processor modules to the unrolled module names.
+
+  E.g. "processor_edges_mesh_mlp/~/linear_0" at scan index 3 maps to
+  "~_networks_builder/processor_edges_3_mesh_mlp/~/linear_0", which is the name
+  (relative to the `DeepTypedGraphNet`) that the same module has when the
+  message passing steps are unrolled.
+  """
+
+  _STACKED_PATTERN = re.compile(r"^processor_(edges|nodes)_")
+  _FLAT_PATTERN = re.compile(
+      r"^~_networks_builder/processor_(edges|nodes)_(\d+)_")
+
+  def stacked_to_flat(self, stacked_module_name: str, scan_idx: int) -> str:
+    return self._STACKED_PATTERN.sub(
+        rf"~_networks_builder/processor_\1_{scan_idx}_", stacked_module_name)
+
+  def flat_to_stacked(
+      self, unstacked_module_name: str) -> Optional[Tuple[str, int]]:
+    match = self._FLAT_PATTERN.match(unstacked_module_name)
+    if match is None:
+      return None
+    stacked_module_name = (f"processor_{match.group(1)}_" +
+                           unstacked_module_name[match.end():])
+    return stacked_module_name, int(match.group(2))
+
+
 def _build_update_fns_for_node_types(
     builder_fn, graph_template, prefix, output_sizes=None):
   """Builds an update function for all node types or a subset of them."""
@@ -453,6 +665,16 @@ def _get_activation_fn(name):
   raise ValueError(f"Unknown activation function {name} specified.")
 
 
+# Dense equivalents of the segment operations, for edge sets with a constant
+# in-degree, reducing [num_nodes, degree, ...] messages along the degree axis.
+_DENSE_AGGREGATE_FNS = {
+    "segment_sum": functools.partial(jnp.sum, axis=1),
+    "segment_mean": functools.partial(jnp.mean, axis=1),
+    "segment_max": functools.partial(jnp.max, axis=1),
+    "segment_min": functools.partial(jnp.min, axis=1),
+}
+
+
 def _get_aggregate_edges_for_nodes_fn(name):
   """Return aggregate_edges_for_nodes_fn corresponding to function_name."""
   if hasattr(jraph, name):
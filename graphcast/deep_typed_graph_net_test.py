@@ -0,0 +1,241 @@
+# Copyright 2024 DeepMind Technologies Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for deep_typed_graph_net.py."""
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from graphcast import deep_typed_graph_net
+from graphcast import typed_graph
+import haiku as hk
+import jax
+import numpy as np
+
+
+def _get_graph(num_nodes=20, num_edges=60, sort_edges_by_receiver=False):
+  rng = np.random.default_rng(0)
+  senders = rng.integers(0, num_nodes, num_edges)
+  receivers = rng.integers(0, num_nodes, num_edges)
+  edge_features = rng.normal(size=[num_edges, 2]).astype(np.float32)
+  if sort_edges_by_receiver:
+    order = np.argsort(receivers, kind="stable")
+    senders, receivers, edge_features = (
+        senders[order], receivers[order], edge_features[order])
+  return typed_graph.TypedGraph(
+      context=typed_graph.Context(n_graph=np.array([1]), features=()),
+      nodes=dict(mesh_nodes=typed_graph.NodeSet(
+          n_node=np.array([num_nodes]),
+          features=rng.normal(size=[num_nodes, 3]).astype(np.float32))),
+      edges={
+          typed_graph.EdgeSetKey("mesh", ("mesh_nodes", "mesh_nodes")):
+              typed_graph.EdgeSet(
+                  n_edge=np.array([num_edges]),
+                  indices=typed_graph.EdgesIndices(
+                      senders=senders, receivers=receivers),
+                  features=edge_features,
+                  indices_are_sorted=sort_edges_by_receiver)})
+
+
+def _build_model(**kwargs):
+  return deep_typed_graph_net.DeepTypedGraphNet(
+      node_latent_size=dict(mesh_nodes=8),
+      edge_latent_size=dict(mesh=8),
+      mlp_hidden_size=8,
+      mlp_num_hidden_layers=1,
+      node_output_size=dict(mesh_nodes=4),
+      activation="swish",
+      name="mesh_gnn",
+      **kwargs,
+  )
+
+
+def _get_model(**kwargs):
+  def fn(graph, norm_conditioning=None, edge_embeddings=None):
+    return _build_model(**kwargs)(graph, norm_conditioning, edge_embeddings)
+  return hk.transform(fn)
+
+
+class DeepTypedGraphNetTest(parameterized.TestCase):
+
+  @parameterized.named_parameters(
+      dict(testcase_name="unshared", num_steps=3, num_repetitions=1,
+           use_norm_conditioning=False),
+      dict(testcase_name="shared_and_unshared", num_steps=3, num_repetitions=2,
+           use_norm_conditioning=False),
+      dict(testcase_name="norm_conditioning", num_steps=2, num_repetitions=1,
+           use_norm_conditioning=True),
+  )
+  def test_scan_matches_unrolled(
+      self, num_steps, num_repetitions, use_norm_conditioning):
+    graph = _get_graph(sort_edges_by_receiver=True)
+    norm_conditioning = (
+        np.ones([5], np.float32) if use_norm_conditioning else None)
+
+    def forward(scan_message_passing_steps):
+      return _get_model(
+          num_message_passing_steps=num_steps,
+          num_processor_repetitions=num_repetitions,
+          use_norm_conditioning=use_norm_conditioning,
+          scan_message_passing_steps=scan_message_passing_steps)
+
+    unrolled = forward(scan_message_passing_steps=False)
+    scanned = forward(scan_message_passing_steps=True)
+    params = unrolled.init(jax.random.PRNGKey(0), graph, norm_conditioning)
+
+    # Both modes create the same parameters, so they are interchangeable.
+    scanned_params = scanned.init(
+        jax.random.PRNGKey(0), graph, norm_conditioning)
+    self.assertEqual(
+        jax.tree_util.tree_map(np.shape, params),
+        jax.tree_util.tree_map(np.shape, scanned_params))
+
+    expected = unrolled.apply(params, None, graph, norm_conditioning)
+    actual = scanned.apply(params, None, graph, norm_conditioning)
+    np.testing.assert_allclose(
+        actual.nodes["mesh_nodes"].features,
+        expected.nodes["mesh_nodes"].features, rtol=1e-5, atol=1e-5)
+
+  def test_sorted_receivers_match_unsorted(self):
+    model = _get_model(num_message_passing_steps=2)
+    unsorted_graph = _get_graph()
+    sorted_graph = _get_graph(sort_edges_by_receiver=True)
+    params = model.init(jax.random.PRNGKey(0), unsorted_graph)
+    expected = model.apply(params, None, unsorted_graph)
+    actual = model.apply(params, None, sorted_graph)
+    np.testing.assert_allclose(
+        actual.nodes["mesh_nodes"].features,
+        expected.nodes["mesh_nodes"].features, rtol=1e-5, atol=1e-5)
+
+  def test_batch_shared_edge_features_match_broadcast(self):
+    model = _get_model(num_message_passing_steps=2)
+    batch_size = 3
+    graph = _get_graph(sort_edges_by_receiver=True)
+    node_features = np.random.default_rng(1).normal(
+        size=graph.nodes["mesh_nodes"].features.shape[:1] + (batch_size, 3)
+    ).astype(np.float32)
+    graph = graph._replace(nodes=dict(
+        mesh_nodes=graph.nodes["mesh_nodes"]._replace(features=node_features)))
+    edges_key, = graph.edges
+    edge_features = graph.edges[edges_key].features
+
+    def with_edge_features(features):
+      return graph._replace(edges={
+          edges_key: graph.edges[edges_key]._replace(features=features)})
+
+    broadcast_graph = with_edge_features(np.broadcast_to(
+        edge_features[:, None],
+        edge_features.shape[:1] + (batch_size,) + edge_features.shape[1:]))
+    shared_graph = with_edge_features(edge_features[:, None])
+
+    params = model.init(jax.random.PRNGKey(0), broadcast_graph)
+    expected = model.apply(params, None, broadcast_graph)
+    actual = model.apply(params, None, shared_graph)
+    self.assertEqual(actual.edges[edges_key].features.shape,
+                     expected.edges[edges_key].features.shape)
+    np.testing.assert_allclose(
+        actual.nodes["mesh_nodes"].features,
+        expected.nodes["mesh_nodes"].features, rtol=1e-5, atol=1e-5)
+
+  @parameterized.parameters(True, False)
+  def test_precomputed_edge_embeddings_match_embedder(
+      self, use_norm_conditioning):
+    kwargs = dict(num_message_passing_steps=2,
+                  use_norm_conditioning=use_norm_conditioning)
+    model = _get_model(**kwargs)
+    embed_edges = hk.transform(
+        lambda graph: _build_model(**kwargs).embed_edges(graph))
+    graph = _get_graph()
+    norm_conditioning = (
+        np.ones([5], np.float32) if use_norm_conditioning else None)
+    params = model.init(jax.random.PRNGKey(0), graph, norm_conditioning)
+    expected = model.apply(params, None, graph, norm_conditioning)
+
+    # The embeddings are computed in a separate function, as they would be at
+    # inference, and the original edge features are not used any more.
+    edge_embeddings = embed_edges.apply(params, None, graph)
+    self.assertEqual(list(edge_embeddings), ["mesh"])
+    edges_key, = graph.edges
+    graph = graph._replace(edges={
+        edges_key: graph.edges[edges_key]._replace(
+            features=np.full_like(graph.edges[edges_key].features, np.nan))})
+    actual = model.apply(
+        params, None, graph, norm_conditioning, edge_embeddings)
+    np.testing.assert_allclose(
+        actual.nodes["mesh_nodes"].features,
+        expected.nodes["mesh_nodes"].features, rtol=1e-5, atol=1e-5)
+
+  @parameterized.parameters(
+      dict(aggregate_edges_for_nodes_fn="segment_sum", f32_aggregation=True),
+      dict(aggregate_edges_for_nodes_fn="segment_sum", f32_aggregation=False),
+      dict(aggregate_edges_for_nodes_fn="segment_mean", f32_aggregation=False),
+      dict(aggregate_edges_for_nodes_fn="segment_max", f32_aggregation=False),
+  )
+  def test_constant_in_degree_matches_segment_aggregation(
+      self, aggregate_edges_for_nodes_fn, f32_aggregation):
+    rng = np.random.default_rng(0)
+    num_mesh_nodes, num_grid_nodes, degree = 12, 30, 3
+
+    senders = rng.integers(0, num_mesh_nodes, num_grid_nodes * degree)
+    receivers = np.repeat(np.arange(num_grid_nodes), degree)
+    edge_features = rng.normal(
+        size=[num_grid_nodes * degree, 2]).astype(np.float32)
+    mesh_features = rng.normal(size=[num_mesh_nodes, 3]).astype(np.float32)
+    grid_features = rng.normal(size=[num_grid_nodes, 3]).astype(np.float32)
+
+    def get_mesh2grid_graph(constant_in_degree):
+      return typed_graph.TypedGraph(
+          context=typed_graph.Context(n_graph=np.array([1]), features=()),
+          nodes=dict(
+              mesh_nodes=typed_graph.NodeSet(
+                  n_node=np.array([num_mesh_nodes]), features=mesh_features),
+              grid_nodes=typed_graph.NodeSet(
+                  n_node=np.array([num_grid_nodes]), features=grid_features)),
+          edges={
+              typed_graph.EdgeSetKey(
+                  "mesh2grid", ("mesh_nodes", "grid_nodes")):
+                  typed_graph.EdgeSet(
+                      n_edge=np.array([num_grid_nodes * degree]),
+                      indices=typed_graph.EdgesIndices(
+                          senders=senders, receivers=receivers),
+                      features=edge_features,
+                      indices_are_sorted=True,
+                      constant_in_degree=constant_in_degree)})
+
+    sparse_graph = get_mesh2grid_graph(constant_in_degree=None)
+    dense_graph = get_mesh2grid_graph(constant_in_degree=degree)
+
+    def fn(graph):
+      return deep_typed_graph_net.DeepTypedGraphNet(
+          node_latent_size=dict(mesh_nodes=8, grid_nodes=8),
+          edge_latent_size=dict(mesh2grid=8),
+          mlp_hidden_size=8,
+          mlp_num_hidden_layers=1,
+          num_message_passing_steps=1,
+          node_output_size=dict(grid_nodes=4),
+          activation="swish",
+          f32_aggregation=f32_aggregation,
+          aggregate_edges_for_nodes_fn=aggregate_edges_for_nodes_fn,
+          name="mesh2grid_gnn",
+      )(graph)
+
+    model = hk.transform(fn)
+    params = model.init(jax.random.PRNGKey(0), sparse_graph)
+    expected = model.apply(params, None, sparse_graph)
+    actual = model.apply(params, None, dense_graph)
+    np.testing.assert_allclose(
+        actual.nodes["grid_nodes"].features,
+        expected.nodes["grid_nodes"].features, rtol=1e-5, atol=1e-5)
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -20,7 +20,7 @@ Throughout we will refer to notation and equations from [1].
   https://arxiv.org/abs/2206.00364
 """
 
-from typing import Any, Optional, Tuple
+from typing import Any, Mapping, Optional, Tuple
 
 import chex
 from graphcast import casting
@@ -33,6 +33,7 @@ from graphcast import samplers_utils
 from graphcast import xarray_jax
 import haiku as hk
 import jax
+import numpy as np
 import xarray
 
 
@@ -149,8 +150,20 @@ class GenCast(predictor_base.Predictor):
       sampler_config: Optional[SamplerConfig] = None,
       noise_config: Optional[NoiseConfig] = None,
       noise_encoder_config: Optional[denoiser.NoiseEncoderConfig] = None,
+      static_edge_embeddings: Optional[Mapping[str, chex.Array]] = None,
   ):
-    """Constructs GenCast."""
+    """Constructs GenCast.
+
+    Args:
+      task_config: Task configuration.
+      denoiser_architecture_config: Architecture of the denoiser.
+      sampler_config: Optional configuration of the sampler.
+      noise_config: Optional configuration of the training noise.
+      noise_encoder_config: Optional configuration of the noise level encoder.
+      static_edge_embeddings: Optional precomputed edge embeddings of the
+        denoiser, as returned by `embed_static_edge_features`. At inference,
+        this avoids recomputing them for every denoiser call of the sampler.
+    """
     # Output size depends on number of variables being predicted.
     num_surface_vars = len(
         set(task_config.target_variables)
@@ -168,12 +181,21 @@ class GenCast(predictor_base.Predictor):
     self._denoiser = denoiser.Denoiser(
         noise_encoder_config,
         denoiser_architecture_config,
+        static_edge_embeddings=static_edge_embeddings,
     )
     self._sampler_config = sampler_config
     # Singleton to avoid re-initializing the sampler for each inference call.
     self._sampler = None
     self._noise_config = noise_config
 
+  def embed_static_edge_features(
+      self,
+      sample_inputs: xarray.Dataset,
+      dtype: np.dtype = np.float32,
+      ) -> Mapping[str, chex.Array]:
+    """See `denoiser.Denoiser.embed_static_edge_features`."""
+    return self._denoiser.embed_static_edge_features(sample_inputs, dtype)
+
   def _c_in(self, noise_scale: xarray.DataArray) -> xarray.DataArray:
     """Scaling applied to the noisy targets input to the underlying network."""
     return (noise_scale**2 + 1)**-0.5
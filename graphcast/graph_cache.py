@@ -0,0 +1,219 @@
+# Copyright 2024 DeepMind Technologies Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Persistent on-disk cache for the static graph structures of the models.
+
+Building the grid2mesh, mesh and mesh2grid graphs (mesh refinement, radius and
+containment queries, and the structural spatial features) is a fixed cost paid
+the first time a model sees a grid. This module stores the resulting
+`typed_graph.TypedGraph`s on disk as one `.npy` file per array, keyed by a hash
+of everything the graphs depend on, so that later processes only need to
+memory-map them back in.
+
+Each cache entry is a directory containing a `manifest.json` describing the
+structure of the graphs and the `.npy` files it refers to. Entries are written
+to a temporary directory first and renamed into place, so concurrent writers
+and readers never observe a partially written entry.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Any, Callable, Mapping, Optional
+
+from absl import logging
+from graphcast import typed_graph
+import numpy as np
+
+# Bump this whenever the way graphs are built or serialized changes in a way
+# that would make previously cached entries stale.
+FORMAT_VERSION = 4
+
+_MANIFEST = "manifest.json"
+
+Graphs = Mapping[str, typed_graph.TypedGraph]
+
+
+def get_cache_key(*,
+                  grid_lat: np.ndarray,
+                  grid_lon: np.ndarray,
+                  mesh_vertices: np.ndarray,
+                  mesh_faces: np.ndarray,
+                  **config: Any) -> str:
+  """Returns a content hash identifying a set of graph structures.
+
+  Args:
+    grid_lat: Latitudes of the grid, [num_lat_points].
+    grid_lon: Longitudes of the grid, [num_lon_points].
+    mesh_vertices: Vertices of the finest mesh, [num_mesh_nodes, 3].
+    mesh_faces: Faces of the finest mesh, [num_faces, 3].
+    **config: Any other JSON-serializable values the graphs depend on, e.g.
+      mesh_size, radius_query_fraction_edge_length and the spatial feature
+      options.
+
+  Returns:
+    A hex digest to use as the name of the cache entry.
+  """
+  hasher = hashlib.sha256()
+  hasher.update(json.dumps(
+      dict(config, format_version=FORMAT_VERSION),
+      sort_keys=True).encode("utf-8"))
+  for array, dtype in ((grid_lat, np.float32), (grid_lon, np.float32),
+                       (mesh_vertices, np.float32), (mesh_faces, np.int64)):
+    array = np.ascontiguousarray(np.asarray(array, dtype=dtype))
+    hasher.update(str(array.shape).encode("utf-8"))
+    hasher.update(array.tobytes())
+  return hasher.hexdigest()
+
+
+def load_or_build(cache_dir: Optional[str],
+                  key: str,
+                  build_fn: Callable[[], Graphs]) -> Graphs:
+  """Loads graphs from the cache, building and storing them on a miss.
+
+  Args:
+    cache_dir: Directory holding the cache entries. If None, `build_fn` is
+      simply called and nothing is cached.
+    key: Cache key, as returned by `get_cache_key`.
+    build_fn: Function building the graphs, keyed by name.
+
+  Returns:
+    The graphs, keyed by name. On a cache hit all the arrays are read-only
+    memory maps.
+  """
+  if cache_dir is None:
+    return build_fn()
+
+  entry_dir = os.path.join(cache_dir, key)
+  if os.path.exists(os.path.join(entry_dir, _MANIFEST)):
+    logging.info("Loading graph structures from %s", entry_dir)
+    return load(entry_dir)
+
+  logging.info("Building graph structures and caching them in %s", entry_dir)
+  graphs = build_fn()
+  save(entry_dir, graphs)
+  return graphs
+
+
+def save(entry_dir: str, graphs: Graphs) -> None:
+  """Atomically writes `graphs` into the directory `entry_dir`."""
+  parent_dir = os.path.dirname(os.path.abspath(entry_dir))
+  os.makedirs(parent_dir, exist_ok=True)
+  tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix=".tmp_graphs_")
+  try:
+    arrays = {}
+    manifest = {name: _graph_to_manifest(name, graph, arrays)
+                for name, graph in graphs.items()}
+    for filename, array in arrays.items():
+      np.save(os.path.join(tmp_dir, filename), np.asarray(array))
+    with open(os.path.join(tmp_dir, _MANIFEST), "w") as f:
+      json.dump({"format_version": FORMAT_VERSION, "graphs": manifest}, f)
+    try:
+      os.rename(tmp_dir, entry_dir)
+    except OSError:
+      # Another process completed the same entry first. Entries with the same
+      # key are interchangeable, so keep theirs.
+      if not os.path.exists(os.path.join(entry_dir, _MANIFEST)):
+        raise
+  finally:
+    if os.path.exists(tmp_dir):
+      shutil.rmtree(tmp_dir)
+
+
+def load(entry_dir: str) -> Graphs:
+  """Loads the graphs stored in `entry_dir` as read-only memory maps."""
+  with open(os.path.join(entry_dir, _MANIFEST)) as f:
+    manifest = json.load(f)
+  if manifest["format_version"] != FORMAT_VERSION:
+    raise ValueError(
+        f"Graph cache entry {entry_dir} has format version "
+        f"{manifest['format_version']}, expected {FORMAT_VERSION}.")
+
+  def load_array(filename):
+    return np.load(os.path.join(entry_dir, filename), mmap_mode="r")
+
+  return {name: _graph_from_manifest(graph_manifest, load_array)
+          for name, graph_manifest in manifest["graphs"].items()}
+
+
+def _graph_to_manifest(name: str, graph: typed_graph.TypedGraph,
+                       arrays: dict[str, np.ndarray]) -> dict[str, Any]:
+  """Describes `graph` as JSON, adding its arrays to `arrays` by filename."""
+
+  def add_array(array_name, array):
+    if not isinstance(array, np.ndarray):
+      raise TypeError(
+          f"Only numpy arrays can be cached, got {type(array)} for "
+          f"{array_name}.")
+    filename = f"{name}.{array_name}.npy"
+    arrays[filename] = array
+    return filename
+
+  if graph.context.features != ():  # pylint: disable=g-explicit-bool-comparison
+    raise ValueError("Graphs with context features can't be cached.")
+
+  nodes = {}
+  for set_name, node_set in graph.nodes.items():
+    nodes[set_name] = dict(
+        n_node=add_array(f"nodes.{set_name}.n_node", node_set.n_node),
+        features=add_array(f"nodes.{set_name}.features", node_set.features))
+
+  edges = []
+  for key, edge_set in graph.edges.items():
+    prefix = f"edges.{key.name}"
+    edge_manifest = dict(
+        name=key.name,
+        node_sets=list(key.node_sets),
+        n_edge=add_array(f"{prefix}.n_edge", edge_set.n_edge),
+        senders=add_array(f"{prefix}.senders", edge_set.indices.senders),
+        receivers=add_array(f"{prefix}.receivers", edge_set.indices.receivers),
+        features=add_array(f"{prefix}.features", edge_set.features))
+    # Any other (static, non-array) fields of the edge set are kept as is.
+    edge_manifest["metadata"] = {
+        field: getattr(edge_set, field) for field in edge_set._fields
+        if field not in ("n_edge", "indices", "features")}
+    edges.append(edge_manifest)
+
+  return dict(
+      n_graph=add_array("context.n_graph", graph.context.n_graph),
+      nodes=nodes,
+      edges=edges)
+
+
+def _graph_from_manifest(
+    manifest: Mapping[str, Any],
+    load_array: Callable[[str], np.ndarray]) -> typed_graph.TypedGraph:
+  """Inverse of `_graph_to_manifest`."""
+  nodes = {
+      set_name: typed_graph.NodeSet(
+          n_node=load_array(node_manifest["n_node"]),
+          features=load_array(node_manifest["features"]))
+      for set_name, node_manifest in manifest["nodes"].items()}
+  edges = {}
+  for edge_manifest in manifest["edges"]:
+    key = typed_graph.EdgeSetKey(
+        edge_manifest["name"], tuple(edge_manifest["node_sets"]))
+    edges[key] = typed_graph.EdgeSet(
+        n_edge=load_array(edge_manifest["n_edge"]),
+        indices=typed_graph.EdgesIndices(
+            senders=load_array(edge_manifest["senders"]),
+            receivers=load_array(edge_manifest["receivers"])),
+        features=load_array(edge_manifest["features"]),
+        **edge_manifest["metadata"])
+  return typed_graph.TypedGraph(
+      context=typed_graph.Context(
+          n_graph=load_array(manifest["n_graph"]), features=()),
+      nodes=nodes,
+      edges=edges)
@@ -0,0 +1,124 @@
+# Copyright 2024 DeepMind Technologies Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for graph_cache.py."""
+
+import os
+import tempfile
+
+from absl.testing import absltest
+from graphcast import graph_cache
+from graphcast import graphcast
+import haiku as hk
+import jax
+import numpy as np
+import xarray
+
+
+def _get_graphs(graph_cache_dir, grid_lat, grid_lon):
+  """Returns the graph structures GraphCast builds for a grid."""
+  model_config = graphcast.ModelConfig(
+      resolution=0.,
+      mesh_size=2,
+      latent_size=4,
+      gnn_msg_steps=1,
+      hidden_layers=1,
+      radius_query_fraction_edge_length=0.6)
+  task_config = graphcast.TaskConfig(
+      input_variables=(),
+      target_variables=("2m_temperature",),
+      forcing_variables=(),
+      pressure_levels=(),
+      input_duration="12h")
+  sample_inputs = xarray.Dataset(coords=dict(lat=grid_lat, lon=grid_lon))
+
+  def build():
+    model = graphcast.GraphCast(
+        model_config, task_config, graph_cache_dir=graph_cache_dir)
+    model._maybe_init(sample_inputs)  # pylint: disable=protected-access
+    return dict(
+        grid2mesh=model._grid2mesh_graph_structure,  # pylint: disable=protected-access
+        mesh=model._mesh_graph_structure,  # pylint: disable=protected-access
+        mesh2grid=model._mesh2grid_graph_structure)  # pylint: disable=protected-access
+
+  return hk.transform(build).apply({}, None)
+
+
+class GraphCacheTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self._grid_lat = np.linspace(-90., 90., 19)
+    self._grid_lon = np.linspace(0., 350., 36)
+
+  def _assert_graphs_equal(self, expected, actual):
+    self.assertEqual(
+        jax.tree_util.tree_structure(expected),
+        jax.tree_util.tree_structure(actual))
+    for x, y in zip(jax.tree_util.tree_leaves(expected),
+                    jax.tree_util.tree_leaves(actual)):
+      self.assertEqual(np.asarray(x).dtype, np.asarray(y).dtype)
+      np.testing.assert_array_equal(x, y)
+
+  def test_cached_graphs_match_built_graphs(self):
+    cache_dir = self.enter_context(tempfile.TemporaryDirectory())
+    expected = _get_graphs(None, self._grid_lat, self._grid_lon)
+
+    # First call builds and stores the graphs.
+    first = _get_graphs(cache_dir, self._grid_lat, self._grid_lon)
+    self._assert_graphs_equal(expected, first)
+    self.assertLen(os.listdir(cache_dir), 1)
+
+    # Second call loads them back as memory maps.
+    second = _get_graphs(cache_dir, self._grid_lat, self._grid_lon)
+    self._assert_graphs_equal(expected, second)
+    self.assertIsInstance(
+        second["mesh2grid"].edge_by_name("mesh2grid").features, np.memmap)
+
+    # A different grid gets its own entry.
+    _get_graphs(cache_dir, self._grid_lat[1:-1], self._grid_lon)
+    self.assertLen(os.listdir(cache_dir), 2)
+
+  def test_load_or_build_only_builds_on_miss(self):
+    cache_dir = self.enter_context(tempfile.TemporaryDirectory())
+    graphs = _get_graphs(None, self._grid_lat, self._grid_lon)
+    num_builds = 0
+
+    def build_fn():
+      nonlocal num_builds
+      num_builds += 1
+      return graphs
+
+    for _ in range(3):
+      loaded = graph_cache.load_or_build(cache_dir, "key", build_fn)
+      self._assert_graphs_equal(graphs, loaded)
+    self.assertEqual(num_builds, 1)
+
+  def test_cache_key_depends_on_grid_and_config(self):
+    kwargs = dict(
+        grid_lat=self._grid_lat,
+        grid_lon=self._grid_lon,
+        mesh_vertices=np.zeros([12, 3], np.float32),
+        mesh_faces=np.zeros([20, 3], np.int32),
+        mesh_size=2)
+    key = graph_cache.get_cache_key(**kwargs)
+    self.assertEqual(key, graph_cache.get_cache_key(**kwargs))
+    self.assertNotEqual(
+        key, graph_cache.get_cache_key(**dict(kwargs, mesh_size=3)))
+    self.assertNotEqual(
+        key, graph_cache.get_cache_key(
+            **dict(kwargs, grid_lat=self._grid_lat + 0.25)))
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -29,6 +29,7 @@ from typing import Any, Callable, Mapping, Optional
 
 import chex
 from graphcast import deep_typed_graph_net
+from graphcast import graph_cache
 from graphcast import grid_mesh_connectivity
 from graphcast import icosahedral_mesh
 from graphcast import losses
@@ -240,8 +241,30 @@ class GraphCast(predictor_base.Predictor):
 
   """
 
-  def __init__(self, model_config: ModelConfig, task_config: TaskConfig):
-    """Initializes the predictor."""
+  def __init__(self,
+               model_config: ModelConfig,
+               task_config: TaskConfig,
+               graph_cache_dir: Optional[str] = None,
+               scan_message_passing_steps: bool = False,
+               static_edge_embeddings: Optional[
+                   Mapping[str, chex.Array]] = None):
+    """Initializes the predictor.
+
+    Args:
+      model_config: Model configuration.
+      task_config: Task configuration.
+      graph_cache_dir: Optional directory used to cache the graph structures
+        on disk (see `graph_cache`). When set, the graphs for a given grid and
+        model configuration are only built once and memory-mapped afterwards.
+      scan_message_passing_steps: Whether to run the message passing steps of
+        the processor in a scan, rather than unrolled, which makes compilation
+        much faster. The parameters are the same either way.
+      static_edge_embeddings: Optional embeddings of the structural edge
+        features, as returned by `embed_static_edge_features` for the same
+        parameters and grid. When set, the edge embedders of the GNNs are not
+        run. At inference, this allows computing the embeddings once and
+        reusing them for every autoregressive step and rollout chunk.
+    """
     self._spatial_features_kwargs = dict(
         add_node_positions=False,
         add_node_latitude=True,
@@ -289,6 +312,7 @@ class GraphCast(predictor_base.Predictor):
         include_sent_messages_in_node_update=False,
         activation="swish",
         f32_aggregation=False,
+        scan_message_passing_steps=scan_message_passing_steps,
         name="mesh_gnn",
     )
 
@@ -327,6 +351,11 @@ class GraphCast(predictor_base.Predictor):
     self._mesh2grid_edge_normalization_factor = (
         model_config.mesh2grid_edge_normalization_factor
     )
+    self._mesh_size = model_config.mesh_size
+    self._radius_query_fraction_edge_length = (
+        model_config.radius_query_fraction_edge_length)
+    self._graph_cache_dir = graph_cache_dir
+    self._static_edge_embeddings = static_edge_embeddings
 
     # Other initialization is delayed until the first call (`_maybe_init`)
     # when we get some sample data so we know the lat/lon values.
@@ -387,6 +416,45 @@ class GraphCast(predictor_base.Predictor):
     return self._grid_node_outputs_to_prediction(
         output_grid_nodes, targets_template)
 
+  def embed_static_edge_features(
+      self,
+      sample_inputs: xarray.Dataset,
+      dtype: np.dtype = np.float32,
+      ) -> Mapping[str, chex.Array]:
+    """Embeds the structural features of the edges of all the graphs.
+
+    The edge embedders of the GNNs only see the structural edge features, so
+    their outputs only depend on the parameters and on the grid. This computes
+    them, to be passed back as `static_edge_embeddings` when constructing the
+    model, e.g. for inference:
+
+      embeddings = hk.transform(lambda inputs: GraphCast(
+          model_config, task_config).embed_static_edge_features(inputs)
+          ).apply(params, None, inputs)
+      predictor = GraphCast(
+          model_config, task_config, static_edge_embeddings=embeddings)
+
+    Args:
+      sample_inputs: Inputs, only used for their lat/lon coordinates.
+      dtype: Dtype of the inputs of the model, e.g. bfloat16 if wrapped in
+        `casting.Bfloat16Cast`, in which case this should be called within
+        `casting.bfloat16_variable_view`.
+
+    Returns:
+      The embedded edge features, [num_edges, latent_size], keyed by edge set
+      name.
+    """
+    self._maybe_init(sample_inputs)
+    embeddings = {}
+    for gnn, graph in ((self._grid2mesh_gnn, self._grid2mesh_graph_structure),
+                       (self._mesh_gnn, self._mesh_graph_structure),
+                       (self._mesh2grid_gnn, self._mesh2grid_graph_structure)):
+      assert graph is not None
+      embeddings.update(gnn.embed_edges(graph._replace(edges={
+          key: edges._replace(features=edges.features.astype(dtype))
+          for key, edges in graph.edges.items()})))
+    return embeddings
+
   def loss_and_predictions(  # pytype: disable=signature-mismatch  # jax-ndarray
       self,
       inputs: xarray.Dataset,
@@ -430,12 +498,35 @@ class GraphCast(predictor_base.Predictor):
       self._init_mesh_properties()
       self._init_grid_properties(
           grid_lat=sample_inputs.lat, grid_lon=sample_inputs.lon)
-      self._grid2mesh_graph_structure = self._init_grid2mesh_graph()
-      self._mesh_graph_structure = self._init_mesh_graph()
-      self._mesh2grid_graph_structure = self._init_mesh2grid_graph()
+      graphs = graph_cache.load_or_build(
+          self._graph_cache_dir,
+          key=self._graph_cache_key(),
+          build_fn=lambda: dict(
+              grid2mesh=self._init_grid2mesh_graph(),
+              mesh=self._init_mesh_graph(),
+              mesh2grid=self._init_mesh2grid_graph()))
+      self._grid2mesh_graph_structure = graphs["grid2mesh"]
+      self._mesh_graph_structure = graphs["mesh"]
+      self._mesh2grid_graph_structure = graphs["mesh2grid"]
 
       self._initialized = True
 
+  def _graph_cache_key(self) -> str:
+    """Key identifying the graph structures for the current grid."""
+    return graph_cache.get_cache_key(
+        grid_lat=self._grid_lat,
+        grid_lon=self._grid_lon,
+        mesh_vertices=self._finest_mesh.vertices,
+        mesh_faces=self._finest_mesh.faces,
+        model="graphcast",
+        mesh_size=self._mesh_size,
+        radius_query_fraction_edge_length=(
+            self._radius_query_fraction_edge_length),
+        mesh2grid_edge_normalization_factor=(
+            self._mesh2grid_edge_normalization_factor),
+        spatial_features_kwargs=self._spatial_features_kwargs,
+    )
+
   def _init_mesh_properties(self):
     """Inits static properties that have to do with mesh nodes."""
     self._num_mesh_nodes = self._finest_mesh.vertices.shape[0]
@@ -473,11 +564,13 @@ class GraphCast(predictor_base.Predictor):
         grid_latitude=self._grid_lat,
         grid_longitude=self._grid_lon,
         mesh=self._finest_mesh,
-        radius=self._query_radius)
+        radius=self._query_radius,
+        # Use all the available CPUs, this does not change the result.
+        workers=-1)
 
-    # Edges sending info from grid to mesh.
-    senders = grid_indices
-    receivers = mesh_indices
+    # Edges sending info from grid to mesh, sorted by receiver.
+    senders, receivers = model_utils.sort_edges_by_receiver(
+        grid_indices, mesh_indices)
 
     # Precompute structural node and edge features according to config options.
     # Structural features are those that depend on the fixed values of the
@@ -491,12 +584,13 @@ class GraphCast(predictor_base.Predictor):
          senders=senders,
          receivers=receivers,
          edge_normalization_factor=None,
+         edge_chunk_size=model_utils.DEFAULT_EDGE_CHUNK_SIZE,
          **self._spatial_features_kwargs,
      )
 
     n_grid_node = np.array([self._num_grid_nodes])
     n_mesh_node = np.array([self._num_mesh_nodes])
-    n_edge = np.array([mesh_indices.shape[0]])
+    n_edge = np.array([senders.shape[0]])
     grid_node_set = typed_graph.NodeSet(
         n_node=n_grid_node, features=senders_node_features)
     mesh_node_set = typed_graph.NodeSet(
@@ -504,7 +598,8 @@ class GraphCast(predictor_base.Predictor):
     edge_set = typed_graph.EdgeSet(
         n_edge=n_edge,
         indices=typed_graph.EdgesIndices(senders=senders, receivers=receivers),
-        features=edge_features)
+        features=edge_features,
+        indices_are_sorted=True)
     nodes = {"grid_nodes": grid_node_set, "mesh_nodes": mesh_node_set}
     edges = {
         typed_graph.EdgeSetKey("grid2mesh", ("grid_nodes", "mesh_nodes")):
@@ -520,8 +615,9 @@ class GraphCast(predictor_base.Predictor):
     """Build Mesh graph."""
     merged_mesh = icosahedral_mesh.merge_meshes(self._meshes)
 
-    # Work simply on the mesh edges.
-    senders, receivers = icosahedral_mesh.faces_to_edges(merged_mesh.faces)
+    # Work simply on the mesh edges, sorted by receiver.
+    senders, receivers = model_utils.sort_edges_by_receiver(
+        *icosahedral_mesh.faces_to_edges(merged_mesh.faces))
 
     # Precompute structural node and edge features according to config options.
     # Structural features are those that depend on the fixed values of the
@@ -543,7 +639,8 @@ class GraphCast(predictor_base.Predictor):
     edge_set = typed_graph.EdgeSet(
         n_edge=n_edge,
         indices=typed_graph.EdgesIndices(senders=senders, receivers=receivers),
-        features=edge_features)
+        features=edge_features,
+        indices_are_sorted=True)
     nodes = {"mesh_nodes": mesh_node_set}
     edges = {
         typed_graph.EdgeSetKey("mesh", ("mesh_nodes", "mesh_nodes")): edge_set
@@ -566,9 +663,9 @@ class GraphCast(predictor_base.Predictor):
          grid_longitude=self._grid_lon,
          mesh=self._finest_mesh)
 
-    # Edges sending info from mesh to grid.
-    senders = mesh_indices
-    receivers = grid_indices
+    # Edges sending info from mesh to grid, sorted by receiver.
+    senders, receivers = model_utils.sort_edges_by_receiver(
+        mesh_indices, grid_indices)
 
     # Precompute structural node and edge features according to config options.
     assert self._mesh_nodes_lat is not None and self._mesh_nodes_lon is not None
@@ -581,6 +678,7 @@ class GraphCast(predictor_base.Predictor):
          senders=senders,
          receivers=receivers,
          edge_normalization_factor=self._mesh2grid_edge_normalization_factor,
+         edge_chunk_size=model_utils.DEFAULT_EDGE_CHUNK_SIZE,
          **self._spatial_features_kwargs,
      )
 
@@ -594,7 +692,12 @@ class GraphCast(predictor_base.Predictor):
     edge_set = typed_graph.EdgeSet(
         n_edge=n_edge,
         indices=typed_graph.EdgesIndices(senders=senders, receivers=receivers),
-        features=edge_features)
+        features=edge_features,
+        indices_are_sorted=True,
+        # Every grid node receives one edge from each vertex of its containing
+        # mesh triangle.
+        constant_in_degree=model_utils.get_constant_in_degree(
+            receivers, self._num_grid_nodes))
     nodes = {"grid_nodes": grid_node_set, "mesh_nodes": mesh_node_set}
     edges = {
         typed_graph.EdgeSetKey("mesh2grid", ("mesh_nodes", "grid_nodes")):
@@ -628,26 +731,26 @@ class GraphCast(predictor_base.Predictor):
 
     # To make sure capacity of the embedded is identical for the grid nodes and
     # the mesh nodes, we also append some dummy zero input features for the
-    # mesh nodes.
+    # mesh nodes. These are the same for the whole batch, so like the edge
+    # structural features below they only get a size 1 batch axis, and are
+    # embedded once and then broadcast to the batch size by the GNN.
     dummy_mesh_node_features = jnp.zeros(
-        (self._num_mesh_nodes,) + grid_node_features.shape[1:],
+        (self._num_mesh_nodes, 1) + grid_node_features.shape[2:],
         dtype=grid_node_features.dtype)
     new_mesh_nodes = mesh_nodes._replace(
         features=jnp.concatenate([
             dummy_mesh_node_features,
             _add_batch_second_axis(
-                mesh_nodes.features.astype(dummy_mesh_node_features.dtype),
-                batch_size)
+                mesh_nodes.features.astype(dummy_mesh_node_features.dtype), 1)
         ],
                                  axis=-1))
 
-    # Broadcast edge structural features to the required batch size.
     grid2mesh_edges_key = grid2mesh_graph.edge_key_by_name("grid2mesh")
     edges = grid2mesh_graph.edges[grid2mesh_edges_key]
 
     new_edges = edges._replace(
         features=_add_batch_second_axis(
-            edges.features.astype(dummy_mesh_node_features.dtype), batch_size))
+            edges.features.astype(dummy_mesh_node_features.dtype), 1))
 
     input_graph = self._grid2mesh_graph_structure._replace(
         edges={grid2mesh_edges_key: new_edges},
@@ -657,7 +760,10 @@ class GraphCast(predictor_base.Predictor):
         })
 
     # Run the GNN.
-    grid2mesh_out = self._grid2mesh_gnn(input_graph)
+    grid2mesh_out = self._grid2mesh_gnn(
+        input_graph,
+        edge_embeddings=self._get_static_edge_embeddings(
+            "grid2mesh", dummy_mesh_node_features.dtype))
     latent_mesh_nodes = grid2mesh_out.nodes["mesh_nodes"].features
     latent_grid_nodes = grid2mesh_out.nodes["grid_nodes"].features
     return latent_mesh_nodes, latent_grid_nodes
@@ -670,7 +776,6 @@ class GraphCast(predictor_base.Predictor):
     # the latent state, via the original Grid2Mesh gnn, however, we need
     # the edge ones, because it is the first time we are seeing this particular
     # set of edges.
-    batch_size = latent_mesh_nodes.shape[1]
 
     mesh_graph = self._mesh_graph_structure
     assert mesh_graph is not None
@@ -684,9 +789,10 @@ class GraphCast(predictor_base.Predictor):
            " mesh GNN.")
     assert len(mesh_graph.edges) == 1, msg
 
+    # Shared across the batch, the GNN broadcasts them after embedding them.
     new_edges = edges._replace(
         features=_add_batch_second_axis(
-            edges.features.astype(latent_mesh_nodes.dtype), batch_size))
+            edges.features.astype(latent_mesh_nodes.dtype), 1))
 
     nodes = mesh_graph.nodes["mesh_nodes"]
     nodes = nodes._replace(features=latent_mesh_nodes)
@@ -695,7 +801,10 @@ class GraphCast(predictor_base.Predictor):
         edges={mesh_edges_key: new_edges}, nodes={"mesh_nodes": nodes})
 
     # Run the GNN.
-    return self._mesh_gnn(input_graph).nodes["mesh_nodes"].features
+    return self._mesh_gnn(
+        input_graph,
+        edge_embeddings=self._get_static_edge_embeddings(
+            "mesh", latent_mesh_nodes.dtype)).nodes["mesh_nodes"].features
 
   def _run_mesh2grid_gnn(self,
                          updated_latent_mesh_nodes: chex.Array,
@@ -708,7 +817,6 @@ class GraphCast(predictor_base.Predictor):
     # the latent state, via the original Grid2Mesh gnn, however, we need
     # the edge ones, because it is the first time we are seeing this particular
     # set of edges.
-    batch_size = updated_latent_mesh_nodes.shape[1]
 
     mesh2grid_graph = self._mesh2grid_graph_structure
     assert mesh2grid_graph is not None
@@ -719,9 +827,10 @@ class GraphCast(predictor_base.Predictor):
     mesh2grid_key = mesh2grid_graph.edge_key_by_name("mesh2grid")
     edges = mesh2grid_graph.edges[mesh2grid_key]
 
+    # Shared across the batch, the GNN broadcasts them after embedding them.
     new_edges = edges._replace(
         features=_add_batch_second_axis(
-            edges.features.astype(latent_grid_nodes.dtype), batch_size))
+            edges.features.astype(latent_grid_nodes.dtype), 1))
 
     input_graph = mesh2grid_graph._replace(
         edges={mesh2grid_key: new_edges},
@@ -731,11 +840,24 @@ class GraphCast(predictor_base.Predictor):
         })
 
     # Run the GNN.
-    output_graph = self._mesh2grid_gnn(input_graph)
+    output_graph = self._mesh2grid_gnn(
+        input_graph,
+        edge_embeddings=self._get_static_edge_embeddings(
+            "mesh2grid", latent_grid_nodes.dtype))
     output_grid_nodes = output_graph.nodes["grid_nodes"].features
 
     return output_grid_nodes
 
+  def _get_static_edge_embeddings(
+      self, edge_set_name: str, dtype: np.dtype,
+      ) -> Optional[Mapping[str, chex.Array]]:
+    """Returns the precomputed embeddings of an edge set, if any."""
+    if self._static_edge_embeddings is None:
+      return None
+    embeddings = self._static_edge_embeddings[edge_set_name]
+    # With a size 1 batch axis, like the structural features they replace.
+    return {edge_set_name: _add_batch_second_axis(embeddings.astype(dtype), 1)}
+
   def _inputs_to_grid_node_features(
       self,
       inputs: xarray.Dataset,
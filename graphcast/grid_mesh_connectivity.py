@@ -13,6 +13,10 @@
 # limitations under the License.
 """Tools for converting from regular grids on a sphere, to triangular meshes."""
 
+from concurrent import futures
+import os
+from typing import Sequence
+
 from graphcast import icosahedral_mesh
 import numpy as np
 import scipy
@@ -42,7 +46,8 @@ def radius_query_indices(
     grid_latitude: np.ndarray,
     grid_longitude: np.ndarray,
     mesh: icosahedral_mesh.TriangularMesh,
-    radius: float) -> tuple[np.ndarray, np.ndarray]:
+    radius: float,
+    workers: int = 1) -> tuple[np.ndarray, np.ndarray]:
   """Returns mesh-grid edge indices for radius query.
 
   Args:
@@ -50,11 +55,15 @@ def radius_query_indices(
     grid_longitude: Longitude values for the grid [num_lon_points]
     mesh: Mesh object.
     radius: Radius of connectivity in R3. for a sphere of unit radius.
+    workers: Number of threads used to run the query, following the
+      `scipy.spatial.cKDTree` convention: -1 means using all the available
+      CPUs. The result does not depend on this value.
 
   Returns:
     tuple with `grid_indices` and `mesh_indices` indicating edges between the
     grid and the mesh such that the distances in a straight line (not geodesic)
-    are smaller than or equal to `radius`.
+    are smaller than or equal to `radius`. Edges are sorted by grid index, and
+    then by mesh index.
     * grid_indices: Indices of shape [num_edges], that index into a
       [num_lat_points, num_lon_points] grid, after flattening the leading axes.
     * mesh_indices: Indices of shape [num_edges], that index into mesh.vertices.
@@ -66,18 +75,29 @@ def radius_query_indices(
 
   # [num_mesh_points, 3]
   mesh_positions = mesh.vertices
-  kd_tree = scipy.spatial.cKDTree(mesh_positions)
-
-  # [num_grid_points, num_mesh_points_per_grid_point]
-  # Note `num_mesh_points_per_grid_point` is not constant, so this is a list
-  # of arrays, rather than a 2d array.
-  query_indices = kd_tree.query_ball_point(x=grid_positions, r=radius)
-
-  grid_edge_indices = []
-  mesh_edge_indices = []
-  for grid_index, mesh_neighbors in enumerate(query_indices):
-    grid_edge_indices.append(np.repeat(grid_index, len(mesh_neighbors)))
-    mesh_edge_indices.append(mesh_neighbors)
+  mesh_kd_tree = scipy.spatial.cKDTree(mesh_positions)
+
+  def query_chunk(chunk_start, chunk_end):
+    # All the (mesh, grid) pairs within `radius` are returned at once as flat
+    # arrays, so there is no per-grid-point Python work. cKDTree releases the
+    # GIL while doing this, so chunks can run in parallel threads.
+    grid_kd_tree = scipy.spatial.cKDTree(
+        grid_positions[chunk_start:chunk_end])
+    pairs = mesh_kd_tree.sparse_distance_matrix(
+        grid_kd_tree, max_distance=radius, output_type="ndarray")
+    order = np.lexsort((pairs["i"], pairs["j"]))
+    return pairs["j"][order] + chunk_start, pairs["i"][order]
+
+  num_workers = os.cpu_count() if workers == -1 else workers
+  if num_workers < 1:
+    raise ValueError(f"Invalid number of workers: {workers}")
+  chunk_bounds = np.linspace(
+      0, grid_positions.shape[0], num_workers + 1).astype(int)
+  with futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+    chunks = list(executor.map(query_chunk, chunk_bounds[:-1],
+                               chunk_bounds[1:]))
+
+  grid_edge_indices, mesh_edge_indices = zip(*chunks)
 
   # [num_edges]
   grid_edge_indices = np.concatenate(grid_edge_indices, axis=0).astype(int)
@@ -131,3 +151,93 @@ def in_mesh_triangle_indices(
   grid_edge_indices = grid_edge_indices.reshape([-1])
 
   return grid_edge_indices, mesh_edge_indices
+
+
+def in_mesh_triangle_indices_hierarchical(
+    *,
+    grid_latitude: np.ndarray,
+    grid_longitude: np.ndarray,
+    meshes: Sequence[icosahedral_mesh.TriangularMesh],
+    chunk_size: int = 2**16) -> tuple[np.ndarray, np.ndarray]:
+  """Like `in_mesh_triangle_indices`, locating grid points hierarchically.
+
+  Rather than running a generic closest point query on the finest mesh, each
+  grid point is located in one of the 20 faces of the icosahedron, and then in
+  one of the 4 children of that face at each of the following refinement
+  levels. Because the child vertices are projected onto the sphere, the
+  children of a spherical triangle tile it exactly, so each level only needs
+  to test on which side of the three edges of the central child the point is.
+
+  Faces are selected by the signed distances (on the unit sphere) between the
+  point and the great circles through their edges. The result agrees with
+  `in_mesh_triangle_indices`, except for grid points very close to the boundary
+  between faces, where the closest flat triangle may not be the spherical
+  triangle containing the point.
+
+  Args:
+    grid_latitude: Latitude values for the grid [num_lat_points]
+    grid_longitude: Longitude values for the grid [num_lon_points]
+    meshes: Hierarchy of meshes, as returned by
+      `icosahedral_mesh.get_hierarchy_of_triangular_meshes_for_sphere`, where
+      the children of face `i` are faces `4*i` to `4*i+3` of the next mesh.
+      The edges are built for the last, finest mesh.
+    chunk_size: Number of grid points processed at once, to bound memory use.
+
+  Returns:
+    tuple with `grid_indices` and `mesh_indices` as `in_mesh_triangle_indices`.
+  """
+
+  # [num_grid_points=num_lat_points * num_lon_points, 3]
+  grid_positions = _grid_lat_lon_to_coordinates(
+      grid_latitude, grid_longitude).reshape([-1, 3])
+
+  def get_edge_normals(vertices, faces):
+    # [num_faces, 3 edges, 3] unit normals of the planes containing the great
+    # circles through the edges of each face. Faces are counter-clockwise when
+    # seen from outside, so points inside the face have a positive dot product
+    # with all three normals.
+    face_vertices = vertices.astype(np.float64)[faces]
+    normals = np.cross(face_vertices, np.roll(face_vertices, -1, axis=1))
+    return normals / np.linalg.norm(normals, axis=-1, keepdims=True)
+
+  # Child faces #1, #2 and #3 share their corner with the parent face, and are
+  # separated from child face #4 by its edges ind31->ind12, ind12->ind23 and
+  # ind23->ind31 respectively (see
+  # `icosahedral_mesh._two_split_unit_sphere_triangle_faces`). So a point
+  # outside edge `e` of the central child is in child `child_outside_edge[e]`.
+  base_normals = get_edge_normals(meshes[0].vertices, meshes[0].faces)
+  central_child_normals = [
+      get_edge_normals(mesh.vertices, mesh.faces[3::4]) for mesh in meshes[1:]]
+  child_outside_edge = np.array([1, 2, 0])
+
+  # [num_grid_points] with mesh face indices for each grid point.
+  query_face_indices = np.empty([grid_positions.shape[0]], dtype=np.int64)
+  for start in range(0, grid_positions.shape[0], chunk_size):
+    positions = grid_positions[start:start + chunk_size]
+    # [num_points, 20 faces, 3 edges]
+    distances = np.einsum("pk,fek->pfe", positions, base_normals)
+    face_indices = distances.min(-1).argmax(-1)
+    for normals in central_child_normals:
+      # [num_points, 3 edges] for the central child of the current face.
+      distances = np.einsum("pk,pek->pe", positions, normals[face_indices])
+      closest_edge = distances.argmin(-1)
+      child = np.where(
+          np.take_along_axis(distances, closest_edge[:, None], axis=-1)[:, 0]
+          >= 0, 3, child_outside_edge[closest_edge])
+      face_indices = 4 * face_indices + child
+    query_face_indices[start:start + chunk_size] = face_indices
+
+  # [num_grid_points, 3] with mesh node indices for each grid point.
+  mesh_edge_indices = meshes[-1].faces[query_face_indices]
+
+  # [num_grid_points, 3] with grid node indices, where every row simply contains
+  # the row (grid_point) index.
+  grid_indices = np.arange(grid_positions.shape[0])
+  grid_edge_indices = np.tile(grid_indices.reshape([-1, 1]), [1, 3])
+
+  # Flatten to get a regular list.
+  # [num_edges=num_grid_points*3]
+  mesh_edge_indices = mesh_edge_indices.reshape([-1])
+  grid_edge_indices = grid_edge_indices.reshape([-1])
+
+  return grid_edge_indices, mesh_edge_indices
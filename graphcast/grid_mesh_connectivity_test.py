@@ -14,12 +14,13 @@
 """Tests for graphcast.grid_mesh_connectivity."""
 
 from absl.testing import absltest
+from absl.testing import parameterized
 from graphcast import grid_mesh_connectivity
 from graphcast import icosahedral_mesh
 import numpy as np
 
 
-class GridMeshConnectivityTest(absltest.TestCase):
+class GridMeshConnectivityTest(parameterized.TestCase):
 
   def test_grid_lat_lon_to_coordinates(self):
 
@@ -58,6 +59,29 @@ class GridMeshConnectivityTest(absltest.TestCase):
         grid_longitude=grid_longitude,
         mesh=mesh, radius=0.2)
 
+  @parameterized.parameters(1, 3, -1)
+  def test_radius_query_indices_matches_brute_force(self, workers):
+    grid_latitude = np.linspace(-90, 90, 19)
+    grid_longitude = np.arange(36) * 10.
+    mesh = icosahedral_mesh.get_hierarchy_of_triangular_meshes_for_sphere(
+        splits=3)[-1]
+    radius = 0.2
+    grid_indices, mesh_indices = grid_mesh_connectivity.radius_query_indices(
+        grid_latitude=grid_latitude,
+        grid_longitude=grid_longitude,
+        mesh=mesh, radius=radius, workers=workers)
+
+    grid_positions = grid_mesh_connectivity._grid_lat_lon_to_coordinates(
+        grid_latitude, grid_longitude).reshape([-1, 3])
+    distances = np.linalg.norm(
+        grid_positions[:, None] - mesh.vertices[None], axis=-1)
+    # Row-major order of the nonzero elements is sorted by grid index, and then
+    # by mesh index.
+    expected_grid_indices, expected_mesh_indices = np.nonzero(
+        distances <= radius)
+    np.testing.assert_array_equal(grid_indices, expected_grid_indices)
+    np.testing.assert_array_equal(mesh_indices, expected_mesh_indices)
+
   def test_in_mesh_triangle_indices_smoke(self):
     # TODO(alvarosg): Add non-smoke test?
     grid_latitude = np.linspace(-75, 75, 6)
@@ -69,6 +93,48 @@ class GridMeshConnectivityTest(absltest.TestCase):
         grid_longitude=grid_longitude,
         mesh=mesh)
 
+  @parameterized.parameters(0, 2, 4, 6)
+  def test_in_mesh_triangle_indices_hierarchical_matches_trimesh(self, splits):
+    grid_latitude = np.linspace(-90, 90, 91)
+    grid_longitude = np.arange(180) * 2.
+    meshes = icosahedral_mesh.get_hierarchy_of_triangular_meshes_for_sphere(
+        splits=splits)
+    grid_indices, mesh_indices = (
+        grid_mesh_connectivity.in_mesh_triangle_indices_hierarchical(
+            grid_latitude=grid_latitude,
+            grid_longitude=grid_longitude,
+            meshes=meshes,
+            chunk_size=1000))
+    expected_grid_indices, expected_mesh_indices = (
+        grid_mesh_connectivity.in_mesh_triangle_indices(
+            grid_latitude=grid_latitude,
+            grid_longitude=grid_longitude,
+            mesh=meshes[-1]))
+    np.testing.assert_array_equal(grid_indices, expected_grid_indices)
+
+    # Both methods may only disagree for points very close to the boundary
+    # between faces (where the closest flat triangle and the containing
+    # spherical triangle may differ), in which case both faces contain the
+    # point up to a small tolerance.
+    grid_positions = grid_mesh_connectivity._grid_lat_lon_to_coordinates(
+        grid_latitude, grid_longitude).reshape([-1, 3])
+    faces = mesh_indices.reshape([-1, 3])
+    expected_faces = expected_mesh_indices.reshape([-1, 3])
+    mismatch = np.any(faces != expected_faces, axis=-1)
+    self.assertLess(mismatch.mean(), 0.01)
+    for face_vertices in (faces[mismatch], expected_faces[mismatch]):
+      distances = _signed_distances_to_face_edges(
+          grid_positions[mismatch], meshes[-1].vertices[face_vertices])
+      self.assertGreater(distances.min(), -1e-5)
+
+
+def _signed_distances_to_face_edges(positions, face_vertices):
+  """Distances from points to the great circles through the face edges."""
+  face_vertices = face_vertices.astype(np.float64)
+  normals = np.cross(face_vertices, np.roll(face_vertices, -1, axis=1))
+  normals /= np.linalg.norm(normals, axis=-1, keepdims=True)
+  return np.einsum("pk,pek->pe", positions, normals)
+
 
 if __name__ == "__main__":
   absltest.main()
@@ -78,7 +78,8 @@ def get_hierarchy_of_triangular_meshes_for_sphere(
        faces: [num_faces, 3] with triangular faces joining sets of 3 vertices.
            Each row contains three indices into the vertices array, indicating
            the vertices adjacent to the face. Always with positive orientation
-           (counterclock-wise when looking from the outside).
+           (counterclock-wise when looking from the outside). The 4 children
+           of face `i` of a mesh are faces `4*i` to `4*i+3` of the next one.
   """
   current_mesh = get_icosahedron()
   output_meshes = [current_mesh]
@@ -176,84 +177,88 @@ def _two_split_unit_sphere_triangle_faces(
 
   # Every time we split a triangle into 4 we will be adding 3 extra vertices,
   # located at the edge centres.
-  # This class handles the positioning of the new vertices, and avoids creating
-  # duplicates.
-  new_vertices_builder = _ChildVerticesBuilder(triangular_mesh.vertices)
-
-  new_faces = []
-  for ind1, ind2, ind3 in triangular_mesh.faces:
-    # Transform each triangular face into 4 triangles,
-    # preserving the orientation.
-    #                    ind3
-    #                   /    \
-    #                /          \
-    #              /      #3       \
-    #            /                  \
-    #         ind31 -------------- ind23
-    #         /   \                /   \
-    #       /       \     #4     /      \
-    #     /    #1     \        /    #2    \
-    #   /               \    /              \
-    # ind1 ------------ ind12 ------------ ind2
-    ind12 = new_vertices_builder.get_new_child_vertex_index((ind1, ind2))
-    ind23 = new_vertices_builder.get_new_child_vertex_index((ind2, ind3))
-    ind31 = new_vertices_builder.get_new_child_vertex_index((ind3, ind1))
-    # Note how each of the 4 triangular new faces specifies the order of the
-    # vertices to preserve the orientation of the original face. As the input
-    # face should always be counter-clockwise as specified in the diagram,
-    # this means child faces should also be counter-clockwise.
-    new_faces.extend([[ind1, ind12, ind31],  # 1
-                      [ind12, ind2, ind23],  # 2
-                      [ind31, ind23, ind3],  # 3
-                      [ind12, ind23, ind31],  # 4
-                      ])
-  return TriangularMesh(vertices=new_vertices_builder.get_all_vertices(),
-                        faces=np.array(new_faces, dtype=np.int32))
-
-
-class _ChildVerticesBuilder(object):
-  """Bookkeeping of new child vertices added to an existing set of vertices."""
-
-  def __init__(self, parent_vertices):
-
-    # Because the same new vertex will be required when splitting adjacent
-    # triangles (which share an edge) we keep them in a hash table indexed by
-    # sorted indices of the vertices adjacent to the edge, to avoid creating
-    # duplicated child vertices.
-    self._child_vertices_index_mapping = {}
-    self._parent_vertices = parent_vertices
-    # We start with all previous vertices.
-    self._all_vertices_list = list(parent_vertices)
-
-  def _get_child_vertex_key(self, parent_vertex_indices):
-    return tuple(sorted(parent_vertex_indices))
-
-  def _create_child_vertex(self, parent_vertex_indices):
-    """Creates a new vertex."""
-    # Position for new vertex is the middle point, between the parent points,
-    # projected to unit sphere.
-    child_vertex_position = self._parent_vertices[
-        list(parent_vertex_indices)].mean(0)
-    child_vertex_position /= np.linalg.norm(child_vertex_position)
-
-    # Add the vertex to the output list. The index for this new vertex will
-    # match the length of the list before adding it.
-    child_vertex_key = self._get_child_vertex_key(parent_vertex_indices)
-    self._child_vertices_index_mapping[child_vertex_key] = len(
-        self._all_vertices_list)
-    self._all_vertices_list.append(child_vertex_position)
-
-  def get_new_child_vertex_index(self, parent_vertex_indices):
-    """Returns index for a child vertex, creating it if necessary."""
-    # Get the key to see if we already have a new vertex in the middle.
-    child_vertex_key = self._get_child_vertex_key(parent_vertex_indices)
-    if child_vertex_key not in self._child_vertices_index_mapping:
-      self._create_child_vertex(parent_vertex_indices)
-    return self._child_vertices_index_mapping[child_vertex_key]
-
-  def get_all_vertices(self):
-    """Returns an array with old vertices."""
-    return np.array(self._all_vertices_list)
+  # Transform each triangular face into 4 triangles,
+  # preserving the orientation.
+  #                    ind3
+  #                   /    \
+  #                /          \
+  #              /      #3       \
+  #            /                  \
+  #         ind31 -------------- ind23
+  #         /   \                /   \
+  #       /       \     #4     /      \
+  #     /    #1     \        /    #2    \
+  #   /               \    /              \
+  # ind1 ------------ ind12 ------------ ind2
+  all_vertices, child_vertex_indices = _get_child_vertices(triangular_mesh)
+  ind1, ind2, ind3 = triangular_mesh.faces.T
+  ind12, ind23, ind31 = child_vertex_indices.T
+
+  # Note how each of the 4 triangular new faces specifies the order of the
+  # vertices to preserve the orientation of the original face. As the input
+  # face should always be counter-clockwise as specified in the diagram,
+  # this means child faces should also be counter-clockwise.
+  # The 4 children of face `i` are stored at rows `4*i` to `4*i+3`.
+  new_faces = np.stack([ind1, ind12, ind31,  # 1
+                        ind12, ind2, ind23,  # 2
+                        ind31, ind23, ind3,  # 3
+                        ind12, ind23, ind31,  # 4
+                        ], axis=-1).reshape([-1, 3]).astype(np.int32)
+  return TriangularMesh(vertices=all_vertices, faces=new_faces)
+
+
+def _get_child_vertices(
+    triangular_mesh: TriangularMesh) -> Tuple[np.ndarray, np.ndarray]:
+  """Adds a child vertex at the centre of every edge of the mesh.
+
+  Because the same new vertex will be required when splitting adjacent
+  triangles (which share an edge), child vertices are deduplicated on the
+  sorted indices of the two parent vertices adjacent to the edge. New vertices
+  are appended after the parent vertices, in the order in which their edges are
+  first visited when iterating over the faces and, within each face, over the
+  edges (ind1, ind2), (ind2, ind3), (ind3, ind1).
+
+  Args:
+    triangular_mesh: Mesh to split.
+
+  Returns:
+    Tuple with:
+    * all_vertices: [num_vertices + num_unique_edges, 3] parent vertices
+      followed by the child vertices.
+    * child_vertex_indices: [num_faces, 3] indices of the child vertices at the
+      centre of the edges (ind1, ind2), (ind2, ind3), (ind3, ind1) of each face.
+  """
+  parent_vertices = triangular_mesh.vertices
+  faces = triangular_mesh.faces
+  num_parent_vertices = parent_vertices.shape[0]
+
+  # [num_faces * 3, 2] edges in visiting order.
+  edges = np.stack([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]],
+                   axis=1).reshape([-1, 2])
+  sorted_edges = np.sort(edges, axis=-1).astype(np.int64)
+  edge_keys = sorted_edges[:, 0] * num_parent_vertices + sorted_edges[:, 1]
+  _, first_visit, unique_edge_index = np.unique(
+      edge_keys, return_index=True, return_inverse=True)
+
+  # Number the unique edges by their first visit, rather than by key.
+  visiting_order = np.argsort(first_visit)
+  child_vertex_offset = np.empty_like(visiting_order)
+  child_vertex_offset[visiting_order] = np.arange(visiting_order.shape[0])
+  child_vertex_indices = (
+      num_parent_vertices + child_vertex_offset[unique_edge_index.reshape(-1)])
+
+  # Position for new vertex is the middle point, between the parent points,
+  # projected to unit sphere.
+  child_vertices = parent_vertices[edges[first_visit[visiting_order]]].mean(1)
+  # Squared norms as a batch of vector dot products, which rounds the same way
+  # as `np.linalg.norm` of a single vector, so the vertices don't depend on
+  # whether they were built one at a time or all at once.
+  squared_norms = np.matmul(child_vertices[:, None, :],
+                            child_vertices[:, :, None])[:, 0, 0]
+  child_vertices /= np.sqrt(squared_norms)[:, None]
+
+  all_vertices = np.concatenate([parent_vertices, child_vertices], axis=0)
+  return all_vertices, child_vertex_indices.reshape([-1, 3])
 
 
 def faces_to_edges(faces: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
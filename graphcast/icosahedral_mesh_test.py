@@ -59,6 +59,21 @@ class IcosahedralMeshTest(parameterized.TestCase):
       if mesh_i < len(meshes) - 1:
         prev_vertices = mesh.vertices
 
+  @parameterized.parameters(list(range(6)))
+  def test_split_matches_reference_implementation(self, splits):
+    mesh = icosahedral_mesh.get_icosahedron()
+    expected_mesh = mesh
+    for _ in range(splits):
+      mesh = icosahedral_mesh._two_split_unit_sphere_triangle_faces(mesh)  # pylint: disable=protected-access
+      expected_mesh = _reference_two_split_unit_sphere_triangle_faces(
+          expected_mesh)
+    # Vertex ordering, positions and face orientation must be bit-identical,
+    # since the mesh nodes are matched to the weights of trained models.
+    self.assertEqual(mesh.vertices.dtype, expected_mesh.vertices.dtype)
+    self.assertEqual(mesh.faces.dtype, expected_mesh.faces.dtype)
+    np.testing.assert_array_equal(mesh.vertices, expected_mesh.vertices)
+    np.testing.assert_array_equal(mesh.faces, expected_mesh.faces)
+
   @parameterized.parameters(list(range(4)))
   def test_merge_meshes(self, splits):
     mesh_hierarchy = (
@@ -92,6 +107,34 @@ class IcosahedralMeshTest(parameterized.TestCase):
     np.testing.assert_array_equal(receivers, expected_receivers)
 
 
+def _reference_two_split_unit_sphere_triangle_faces(triangular_mesh):
+  """Face-by-face implementation of the mesh split, used as a reference."""
+  parent_vertices = triangular_mesh.vertices
+  all_vertices = list(parent_vertices)
+  child_vertex_index_mapping = {}
+
+  def get_child_vertex_index(parent_vertex_indices):
+    key = tuple(sorted(parent_vertex_indices))
+    if key not in child_vertex_index_mapping:
+      position = parent_vertices[list(parent_vertex_indices)].mean(0)
+      position /= np.linalg.norm(position)
+      child_vertex_index_mapping[key] = len(all_vertices)
+      all_vertices.append(position)
+    return child_vertex_index_mapping[key]
+
+  new_faces = []
+  for ind1, ind2, ind3 in triangular_mesh.faces:
+    ind12 = get_child_vertex_index((ind1, ind2))
+    ind23 = get_child_vertex_index((ind2, ind3))
+    ind31 = get_child_vertex_index((ind3, ind1))
+    new_faces.extend([[ind1, ind12, ind31],
+                      [ind12, ind2, ind23],
+                      [ind31, ind23, ind3],
+                      [ind12, ind23, ind31]])
+  return icosahedral_mesh.TriangularMesh(
+      vertices=np.array(all_vertices), faces=np.array(new_faces, np.int32))
+
+
 def _assert_valid_mesh(mesh, num_expected_vertices, num_expected_faces):
   vertices = mesh.vertices
   faces = mesh.faces
@@ -13,13 +13,18 @@
 # limitations under the License.
 """Utilities for building models."""
 
-from typing import Mapping, Optional, Tuple
+from typing import Callable, Iterator, Mapping, Optional, Tuple
 
 import jax.numpy as jnp
 import numpy as np
 from scipy.spatial import transform
 import xarray
 
+# Default number of edges for which the bipartite graph edge features are
+# computed at once (see `edge_chunk_size`), to cap the host memory used when
+# building the graphs.
+DEFAULT_EDGE_CHUNK_SIZE = 2**16
+
 
 def get_graph_spatial_features(
     *, node_lat: np.ndarray, node_lon: np.ndarray,
@@ -376,6 +381,7 @@ def get_bipartite_graph_spatial_features(
     edge_normalization_factor: Optional[float] = None,
     relative_longitude_local_coordinates: bool,
     relative_latitude_local_coordinates: bool,
+    edge_chunk_size: Optional[int] = None,
 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
   """Computes spatial features for the nodes.
 
@@ -415,6 +421,11 @@ def get_bipartite_graph_spatial_features(
       computed in a local space where the receiver is at 0 longitude.
     relative_latitude_local_coordinates: If True, relative positions are
       computed in a local space where the receiver is at 0 latitude.
+    edge_chunk_size: If set, edge features are computed in blocks of this many
+      edges and written into a preallocated float32 array, rather than
+      materializing float64 rotation matrices and positions for all the edges
+      at once. The features are the same as without chunking, rounded to
+      float32.
 
   Returns:
     Arrays of shape: [num_nodes, num_features] and [num_edges, num_features].
@@ -466,6 +477,20 @@ def get_bipartite_graph_spatial_features(
   # Computing some edge features.
   edge_features = []
 
+  if add_relative_positions and edge_chunk_size is not None:
+    edge_features = _get_bipartite_relative_position_features_in_chunks(
+        senders_node_phi=senders_node_phi,
+        senders_node_theta=senders_node_theta,
+        receivers_node_phi=receivers_node_phi,
+        receivers_node_theta=receivers_node_theta,
+        senders=senders,
+        receivers=receivers,
+        latitude_local_coordinates=relative_latitude_local_coordinates,
+        longitude_local_coordinates=relative_longitude_local_coordinates,
+        edge_normalization_factor=edge_normalization_factor,
+        edge_chunk_size=edge_chunk_size)
+    return senders_node_features, receivers_node_features, edge_features
+
   if add_relative_positions:
 
     relative_position = get_bipartite_relative_position_in_receiver_local_coordinates(  # pylint: disable=line-too-long
@@ -510,7 +535,8 @@ def get_bipartite_relative_position_in_receiver_local_coordinates(
     receivers_node_theta: np.ndarray,
     receivers: np.ndarray,
     latitude_local_coordinates: bool,
-    longitude_local_coordinates: bool) -> np.ndarray:
+    longitude_local_coordinates: bool,
+    edge_chunk_size: Optional[int] = None) -> np.ndarray:
   """Returns relative position features for the edges.
 
   This function is equivalent to
@@ -533,10 +559,58 @@ def get_bipartite_relative_position_in_receiver_local_coordinates(
       positions are computed such that the receiver is always at latitude 0.
     longitude_local_coordinates: Whether to rotate edges such that in the
       positions are computed such that the receiver is always at longitude 0.
+    edge_chunk_size: If set, the relative positions are computed in blocks of
+      this many edges, and written into a preallocated float32 array.
 
   Returns:
     Array of relative positions in R3 [num_edges, 3]
   """
+  relative_positions_fn = _get_bipartite_relative_positions_fn(
+      senders_node_phi=senders_node_phi,
+      senders_node_theta=senders_node_theta,
+      receivers_node_phi=receivers_node_phi,
+      receivers_node_theta=receivers_node_theta,
+      latitude_local_coordinates=latitude_local_coordinates,
+      longitude_local_coordinates=longitude_local_coordinates)
+
+  if edge_chunk_size is None:
+    return relative_positions_fn(senders, receivers)
+
+  relative_positions = np.empty([senders.shape[0], 3], dtype=np.float32)
+  for edge_slice in _edge_chunks(senders.shape[0], edge_chunk_size):
+    relative_positions[edge_slice] = relative_positions_fn(
+        senders[edge_slice], receivers[edge_slice])
+  return relative_positions
+
+
+def _get_bipartite_relative_positions_fn(
+    senders_node_phi: np.ndarray,
+    senders_node_theta: np.ndarray,
+    receivers_node_phi: np.ndarray,
+    receivers_node_theta: np.ndarray,
+    latitude_local_coordinates: bool,
+    longitude_local_coordinates: bool,
+    ) -> Callable[[np.ndarray, np.ndarray], np.ndarray]:
+  """Returns a function computing relative positions for a subset of edges.
+
+  See `get_bipartite_relative_position_in_receiver_local_coordinates`. Node
+  positions and per-receiver rotation matrices are computed once, so that the
+  returned function only does per-edge work.
+
+  Args:
+    senders_node_phi: [num_sender_nodes] with polar angles.
+    senders_node_theta: [num_sender_nodes] with azimuthal angles.
+    receivers_node_phi: [num_sender_nodes] with polar angles.
+    receivers_node_theta: [num_sender_nodes] with azimuthal angles.
+    latitude_local_coordinates: See
+      `get_bipartite_relative_position_in_receiver_local_coordinates`.
+    longitude_local_coordinates: See
+      `get_bipartite_relative_position_in_receiver_local_coordinates`.
+
+  Returns:
+    Function mapping sender and receiver indices of shape [num_edges] to
+    relative positions in R3 [num_edges, 3].
+  """
 
   senders_node_pos = np.stack(
       spherical_to_cartesian(senders_node_phi, senders_node_theta), axis=-1)
@@ -546,7 +620,8 @@ def get_bipartite_relative_position_in_receiver_local_coordinates(
 
   # No rotation in this case.
   if not (latitude_local_coordinates or longitude_local_coordinates):
-    return senders_node_pos[senders] - receivers_node_pos[receivers]
+    return lambda senders, receivers: (  # pylint: disable=g-long-lambda
+        senders_node_pos[senders] - receivers_node_pos[receivers])
 
   # Get rotation matrices for the local space space for every receiver node.
   receiver_rotation_matrices = get_rotation_matrices_to_local_coordinates(
@@ -555,40 +630,164 @@ def get_bipartite_relative_position_in_receiver_local_coordinates(
       rotate_latitude=latitude_local_coordinates,
       rotate_longitude=longitude_local_coordinates)
 
-  # Each edge will be rotated according to the rotation matrix of its receiver
-  # node.
-  edge_rotation_matrices = receiver_rotation_matrices[receivers]
+  def relative_positions_fn(senders, receivers):
+    # Each edge will be rotated according to the rotation matrix of its
+    # receiver node.
+    edge_rotation_matrices = receiver_rotation_matrices[receivers]
+
+    # Rotate all nodes to the rotated space of the corresponding edge.
+    # Note for receivers we can also do the matmul first and the gather second:
+    # ```
+    # receiver_pos_in_rotated_space = rotate_with_matrices(
+    #    rotation_matrices, node_pos)[receivers]
+    # ```
+    # which is more efficient, however, we do gather first to keep it more
+    # symmetric with the sender computation.
+    receiver_pos_in_rotated_space = rotate_with_matrices(
+        edge_rotation_matrices, receivers_node_pos[receivers])
+    sender_pos_in_in_rotated_space = rotate_with_matrices(
+        edge_rotation_matrices, senders_node_pos[senders])
+    # Note, here, that because the rotated space is chosen according to the
+    # receiver, if:
+    # * latitude_local_coordinates = True: latitude for the receivers will be
+    #   0, that is the z coordinate will always be 0.
+    # * longitude_local_coordinates = True: longitude for the receivers will be
+    #   0, that is the y coordinate will be 0.
+
+    # Now we can just subtract.
+    # Note we are rotating to a local coordinate system, where the y-z axes are
+    # parallel to a tangent plane to the sphere, but still remain in a 3d
+    # space. Note that if both `latitude_local_coordinates` and
+    # `longitude_local_coordinates` are True, and edges are short,
+    # then the difference in x coordinate between sender and receiver
+    # should be small, so we could consider dropping the new x coordinate if
+    # we wanted to the tangent plane, however in doing so
+    # we would lose information about the curvature of the mesh, which may be
+    # important for very coarse meshes.
+    return sender_pos_in_in_rotated_space - receiver_pos_in_rotated_space
+
+  return relative_positions_fn
+
+
+def _get_bipartite_relative_position_features_in_chunks(
+    *,
+    senders_node_phi: np.ndarray,
+    senders_node_theta: np.ndarray,
+    senders: np.ndarray,
+    receivers_node_phi: np.ndarray,
+    receivers_node_theta: np.ndarray,
+    receivers: np.ndarray,
+    latitude_local_coordinates: bool,
+    longitude_local_coordinates: bool,
+    edge_normalization_factor: Optional[float],
+    edge_chunk_size: int,
+    ) -> np.ndarray:
+  """Chunked version of the relative position edge features.
 
-  # Rotate all nodes to the rotated space of the corresponding edge.
-  # Note for receivers we can also do the matmul first and the gather second:
-  # ```
-  # receiver_pos_in_rotated_space = rotate_with_matrices(
-  #    rotation_matrices, node_pos)[receivers]
-  # ```
-  # which is more efficient, however, we do gather first to keep it more
-  # symmetric with the sender computation.
-  receiver_pos_in_rotated_space = rotate_with_matrices(
-      edge_rotation_matrices, receivers_node_pos[receivers])
-  sender_pos_in_in_rotated_space = rotate_with_matrices(
-      edge_rotation_matrices, senders_node_pos[senders])
-  # Note, here, that because the rotated space is chosen according to the
-  # receiver, if:
-  # * latitude_local_coordinates = True: latitude for the receivers will be
-  #   0, that is the z coordinate will always be 0.
-  # * longitude_local_coordinates = True: longitude for the receivers will be
-  #   0, that is the y coordinate will be 0.
+  Returns the same [num_edges, 4] features (normalized distances, followed by
+  normalized relative positions) as `get_bipartite_graph_spatial_features`
+  with `add_relative_positions=True`, rounded to float32. Each block of edges
+  is computed and normalized in float64, as without chunking, and only then
+  written to the float32 output, so peak memory is the output plus one block.
 
-  # Now we can just subtract.
-  # Note we are rotating to a local coordinate system, where the y-z axes are
-  # parallel to a tangent plane to the sphere, but still remain in a 3d space.
-  # Note that if both `latitude_local_coordinates` and
-  # `longitude_local_coordinates` are True, and edges are short,
-  # then the difference in x coordinate between sender and receiver
-  # should be small, so we could consider dropping the new x coordinate if
-  # we wanted to the tangent plane, however in doing so
-  # we would lose information about the curvature of the mesh, which may be
-  # important for very coarse meshes.
-  return sender_pos_in_in_rotated_space - receiver_pos_in_rotated_space
+  Args:
+    senders_node_phi: [num_sender_nodes] with polar angles.
+    senders_node_theta: [num_sender_nodes] with azimuthal angles.
+    senders: [num_edges] with indices into sender nodes.
+    receivers_node_phi: [num_sender_nodes] with polar angles.
+    receivers_node_theta: [num_sender_nodes] with azimuthal angles.
+    receivers: [num_edges] with indices into receiver nodes.
+    latitude_local_coordinates: See `get_bipartite_graph_spatial_features`.
+    longitude_local_coordinates: See `get_bipartite_graph_spatial_features`.
+    edge_normalization_factor: See `get_bipartite_graph_spatial_features`.
+    edge_chunk_size: Number of edges per block.
+
+  Returns:
+    Array of edge features [num_edges, 4].
+  """
+  num_edges = senders.shape[0]
+  relative_positions_fn = _get_bipartite_relative_positions_fn(
+      senders_node_phi=senders_node_phi,
+      senders_node_theta=senders_node_theta,
+      receivers_node_phi=receivers_node_phi,
+      receivers_node_theta=receivers_node_theta,
+      latitude_local_coordinates=latitude_local_coordinates,
+      longitude_local_coordinates=longitude_local_coordinates)
+
+  def chunked_relative_positions():
+    for edge_slice in _edge_chunks(num_edges, edge_chunk_size):
+      relative_position = relative_positions_fn(
+          senders[edge_slice], receivers[edge_slice])
+      # Note this is L2 distance in 3d space, rather than geodesic distance.
+      relative_edge_distances = np.linalg.norm(
+          relative_position, axis=-1, keepdims=True)
+      yield edge_slice, relative_position, relative_edge_distances
+
+  if edge_normalization_factor is None:
+    # Normalize to the maximum edge distance, as in the unchunked case. This
+    # requires an extra pass over the edges, since the features can only be
+    # normalized once all the distances are known.
+    edge_normalization_factor = max(
+        (distances.max() for _, _, distances in chunked_relative_positions()),
+        default=np.float64(0.))
+
+  edge_features = np.empty([num_edges, 4], dtype=np.float32)
+  for edge_slice, relative_position, relative_edge_distances in (
+      chunked_relative_positions()):
+    edge_features[edge_slice, :1] = (
+        relative_edge_distances / edge_normalization_factor)
+    edge_features[edge_slice, 1:] = (
+        relative_position / edge_normalization_factor)
+  return edge_features
+
+
+def _edge_chunks(num_edges: int, edge_chunk_size: int) -> Iterator[slice]:
+  if edge_chunk_size <= 0:
+    raise ValueError(f"edge_chunk_size must be positive, got {edge_chunk_size}")
+  for start in range(0, num_edges, edge_chunk_size):
+    yield slice(start, min(start + edge_chunk_size, num_edges))
+
+
+def sort_edges_by_receiver(
+    senders: np.ndarray,
+    receivers: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+  """Sorts edges by receiver, keeping the order of edges with the same one.
+
+  Aggregating the messages for the receivers of sorted edges can use the
+  faster, sorted segment operations (see `typed_graph.EdgeSet`).
+
+  Args:
+    senders: Sender indices, [num_edges].
+    receivers: Receiver indices, [num_edges].
+
+  Returns:
+    Tuple with the sorted senders and receivers.
+  """
+  order = np.argsort(receivers, kind="stable")
+  return senders[order], receivers[order]
+
+
+def get_constant_in_degree(receivers: np.ndarray,
+                           num_receivers: int) -> Optional[int]:
+  """Returns the in-degree shared by all the receivers, if there is one.
+
+  Args:
+    receivers: Receiver indices, [num_edges].
+    num_receivers: Number of receiver nodes.
+
+  Returns:
+    The degree `d` if the receivers are `repeat(arange(num_receivers), d)`,
+    i.e. edges grouped by receiver with exactly `d` edges per receiver node, or
+    None otherwise (see `typed_graph.EdgeSet`).
+  """
+  num_edges = receivers.shape[0]
+  if num_receivers == 0 or num_edges == 0 or num_edges % num_receivers:
+    return None
+  degree = num_edges // num_receivers
+  if not np.array_equal(
+      receivers, np.repeat(np.arange(num_receivers), degree)):
+    return None
+  return int(degree)
 
 
 def variable_to_stacked(
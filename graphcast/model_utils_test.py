@@ -0,0 +1,98 @@
+# Copyright 2024 DeepMind Technologies Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for model_utils.py."""
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from graphcast import model_utils
+import numpy as np
+
+
+class BipartiteGraphSpatialFeaturesTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    rng = np.random.default_rng(0)
+    num_senders, num_receivers, num_edges = 50, 30, 1000
+    self._kwargs = dict(
+        senders_node_lat=rng.uniform(-90, 90, num_senders).astype(np.float32),
+        senders_node_lon=rng.uniform(0, 360, num_senders).astype(np.float32),
+        receivers_node_lat=rng.uniform(
+            -90, 90, num_receivers).astype(np.float32),
+        receivers_node_lon=rng.uniform(
+            0, 360, num_receivers).astype(np.float32),
+        senders=rng.integers(0, num_senders, num_edges),
+        receivers=rng.integers(0, num_receivers, num_edges),
+        add_node_positions=False,
+        add_node_latitude=True,
+        add_node_longitude=True,
+        add_relative_positions=True,
+    )
+
+  @parameterized.product(
+      edge_normalization_factor=(None, 0.5),
+      edge_chunk_size=(1, 64, 1000, 4096),
+      local_coordinates=((True, True), (True, False), (False, False)),
+  )
+  def test_chunked_features_match_unchunked(
+      self, edge_normalization_factor, edge_chunk_size, local_coordinates):
+    kwargs = dict(
+        self._kwargs,
+        edge_normalization_factor=edge_normalization_factor,
+        relative_latitude_local_coordinates=local_coordinates[0],
+        relative_longitude_local_coordinates=local_coordinates[1])
+    expected = model_utils.get_bipartite_graph_spatial_features(**kwargs)
+    actual = model_utils.get_bipartite_graph_spatial_features(
+        edge_chunk_size=edge_chunk_size, **kwargs)
+
+    np.testing.assert_array_equal(actual[0], expected[0])
+    np.testing.assert_array_equal(actual[1], expected[1])
+    self.assertEqual(actual[2].dtype, np.float32)
+    np.testing.assert_array_equal(actual[2], expected[2].astype(np.float32))
+
+
+class EdgeIndicesTest(parameterized.TestCase):
+
+  def test_sort_edges_by_receiver(self):
+    senders = np.array([0, 1, 2, 3, 4])
+    receivers = np.array([2, 0, 2, 1, 0])
+    sorted_senders, sorted_receivers = model_utils.sort_edges_by_receiver(
+        senders, receivers)
+    np.testing.assert_array_equal(sorted_receivers, [0, 0, 1, 2, 2])
+    # Edges with the same receiver keep their relative order.
+    np.testing.assert_array_equal(sorted_senders, [1, 4, 3, 0, 2])
+
+  @parameterized.named_parameters(
+      dict(testcase_name="constant", receivers=[0, 0, 1, 1, 2, 2],
+           num_receivers=3, expected=2),
+      dict(testcase_name="one_edge_each", receivers=[0, 1, 2],
+           num_receivers=3, expected=1),
+      dict(testcase_name="not_grouped", receivers=[0, 1, 0, 1],
+           num_receivers=2, expected=None),
+      dict(testcase_name="varying_degree", receivers=[0, 0, 0, 1, 2, 2],
+           num_receivers=3, expected=None),
+      dict(testcase_name="isolated_receiver", receivers=[0, 0, 1, 1],
+           num_receivers=4, expected=None),
+      dict(testcase_name="no_edges", receivers=[], num_receivers=3,
+           expected=None),
+  )
+  def test_get_constant_in_degree(self, receivers, num_receivers, expected):
+    self.assertEqual(
+        model_utils.get_constant_in_degree(
+            np.array(receivers, dtype=np.int32), num_receivers),
+        expected)
+
+
+if __name__ == "__main__":
+  absltest.main()
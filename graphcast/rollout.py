@@ -13,7 +13,15 @@
 # limitations under the License.
 """Utils for rolling out models."""
 
-from typing import Iterator, Optional, Sequence
+import functools
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from typing import (Any, Callable, Iterable, Iterator, Mapping, NamedTuple,
+                    Optional, Sequence, Tuple, Union)
 
 from absl import logging
 import chex
@@ -21,6 +29,7 @@ import dask.array
 from graphcast import xarray_jax
 from graphcast import xarray_tree
 import jax
+import jax.numpy as jnp
 import numpy as np
 import typing_extensions
 import xarray
@@ -38,6 +47,22 @@ class PredictorFn(typing_extensions.Protocol):
     ...
 
 
+# Computes the forcings of a chunk from its targets template, see the
+# `forcings_fn` argument of `chunked_prediction_generator`.
+ForcingsFn = Callable[[xarray.Dataset], xarray.Dataset]
+
+
+class CheckpointedChunk(NamedTuple):
+  """A chunk of predictions, and the function checkpointing the rollout after.
+
+  Yielded by `chunked_prediction_generator` with `defer_checkpoints=True`, so
+  that the consumer only saves the checkpoint once the chunk is written (which
+  `write_chunks_async` does).
+  """
+  predictions: xarray.Dataset
+  save_checkpoint: Callable[[], None]
+
+
 def _replicate_dataset(
     data: xarray.Dataset, replica_dim: str,
     replicate_to_device: bool,
@@ -53,9 +78,11 @@ def _replicate_dataset(
       data = len(devices) * [variable.data]
       if replicate_to_device:
         assert devices is not None
-        # TODO(pricei): Refactor code to use "device_put_replicated" instead of
-        # device_put_sharded.
-        data = jax.device_put_sharded(data, devices)
+        # Equivalent to the deprecated `jax.device_put_sharded`.
+        sharding = jax.sharding.NamedSharding(
+            jax.sharding.Mesh(np.array(devices), (replica_dim,)),
+            jax.sharding.PartitionSpec(replica_dim))
+        data = jax.device_put(np.stack(data, axis=0), sharding)
       else:
         data = np.stack(data, axis=0)
       return xarray_jax.Variable(
@@ -75,6 +102,45 @@ def _replicate_dataset(
   return replicate_dataset(data)
 
 
+def _shard_dataset(
+    data: Optional[xarray.Dataset], sample_dim: str, num_samples: int,
+    mesh: jax.sharding.Mesh, broadcast: bool) -> Optional[xarray.Dataset]:
+  """Puts a dataset on the devices of `mesh`, sharded over `sample_dim`.
+
+  Args:
+    data: Dataset to put on the devices.
+    sample_dim: Dimension to shard over all the axes of `mesh`.
+    num_samples: Size of `sample_dim`.
+    mesh: Mesh of the devices.
+    broadcast: Whether to broadcast the variables with a time dimension to
+      `sample_dim` if they don't have it yet. They are then sharded like the
+      others, rather than replicated on all the devices.
+
+  Returns:
+    The dataset, backed by sharded jax arrays.
+  """
+  if data is None:
+    return None
+
+  def shard_variable(variable: xarray.Variable) -> xarray.Variable:
+    if (broadcast and "time" in variable.dims
+        and sample_dim not in variable.dims):
+      variable = variable.set_dims(
+          dict({sample_dim: num_samples}, **variable.sizes))
+    spec = jax.sharding.PartitionSpec(
+        *[mesh.axis_names if d == sample_dim else None for d in variable.dims])
+    return xarray_jax.Variable(
+        variable.dims,
+        jax.device_put(np.asarray(variable.data),
+                       jax.sharding.NamedSharding(mesh, spec)),
+        attrs=variable.attrs)
+
+  data_variables = {name: shard_variable(var)
+                    for name, var in data.data_vars.variables.items()}
+  coords = {name: coord.variable for name, coord in data.coords.items()}
+  return xarray.Dataset(data_variables, coords=coords, attrs=data.attrs)
+
+
 def chunked_prediction_generator_multiple_runs(
     predictor_fn: PredictorFn,
     rngs: chex.PRNGKey,
@@ -83,10 +149,25 @@ def chunked_prediction_generator_multiple_runs(
     forcings: Optional[xarray.Dataset],
     num_samples: Optional[int],
     pmap_devices: Optional[Sequence[jax.Device]] = None,
+    checkpoint_dir: Optional[str] = None,
+    mesh: Optional[jax.sharding.Mesh] = None,
     **chunked_prediction_kwargs,
 ) -> Iterator[xarray.Dataset]:
   """Outputs a trajectory of multiple samples by yielding chunked predictions.
 
+  Samples can be rolled out in parallel on several devices in two ways:
+  * with `pmap_devices`, `predictor_fn` must be pmapped over "sample", and the
+    inputs and forcings are replicated on the host for every device.
+  * with a `mesh`, `predictor_fn` is a plain function of a single sample. It
+    is vmapped over "sample" and jitted, and groups of as many samples as there
+    are devices in the mesh are rolled out together, with every array that has
+    a "sample" dimension sharded over all the axes of the mesh. The
+    time-dependent inputs and the forcings are broadcast to all the samples of
+    a group before being sharded, so each device only holds one copy of them,
+    and the device resident rollout (see `chunked_prediction_generator`)
+    updates the inputs of each chunk in place on the devices. The predictions
+    are the same as when rolling out one sample at a time.
+
   Args:
     predictor_fn: Function to use to make predictions for each chunk.
     rngs: RNG sequence to be used for each ensemble member.
@@ -97,6 +178,11 @@ def chunked_prediction_generator_multiple_runs(
     num_samples: The number of runs / samples to rollout.
     pmap_devices: List of devices over which predictor_fn is pmapped, or None if
       it is not pmapped.
+    checkpoint_dir: Optional directory to checkpoint the rollout of each group
+      of samples in, see `chunked_prediction_generator`. Samples whose rollout
+      was completed before a restart are skipped.
+    mesh: Mesh of the devices to shard the samples over, or None. Not supported
+      together with `pmap_devices`.
     **chunked_prediction_kwargs:
       See chunked_prediction, some of these are required arguments.
 
@@ -167,6 +253,7 @@ def chunked_prediction_generator_multiple_runs(
           targets_template=targets_template,
           forcings=sample_forcings,
           pmap_devices=pmap_devices,
+          checkpoint_dir=_get_sample_checkpoint_dir(checkpoint_dir, sample_idx),
           **chunked_prediction_kwargs,
       ):
         prediction_chunk.coords["sample"] = np.arange(
@@ -174,6 +261,51 @@ def chunked_prediction_generator_multiple_runs(
         )
         yield prediction_chunk
         del prediction_chunk
+  elif mesh is not None:
+    num_devices = mesh.devices.size
+    if num_samples % num_devices != 0:
+      raise ValueError(
+          f"num_samples {num_samples} must be a multiple of the number of "
+          f"devices in the mesh {num_devices}.")
+    sample_sharding = jax.sharding.NamedSharding(
+        mesh, jax.sharding.PartitionSpec(mesh.axis_names))
+    vmapped_predictor_fn = xarray_jax.vmap(predictor_fn, dim="sample")
+
+    @jax.jit
+    def sharded_predictor_fn(rng, inputs, targets_template, forcings):
+      predictions = vmapped_predictor_fn(
+          rng, inputs, targets_template, forcings)
+      # Keeps each sample's predictions on the device which predicted them.
+      return jax.tree_util.tree_map(
+          lambda x: jax.lax.with_sharding_constraint(x, sample_sharding),
+          predictions)
+
+    chunked_prediction_kwargs = dict(
+        chunked_prediction_kwargs, device_resident=True)
+    for i in range(0, num_samples, num_devices):
+      sample_idx = slice(i, i + num_devices)
+      logging.info("Samples %s out of %s", sample_idx, num_samples)
+      logging.flush()
+
+      def select_samples(data):
+        if data is None or "sample" not in data.dims:
+          return data
+        return data.isel(sample=sample_idx)
+
+      for prediction_chunk in chunked_prediction_generator(
+          predictor_fn=sharded_predictor_fn,
+          rng=jax.device_put(rngs[sample_idx], sample_sharding),
+          inputs=_shard_dataset(select_samples(inputs), "sample", num_devices,
+                                mesh, broadcast=True),
+          targets_template=targets_template,
+          forcings=_shard_dataset(select_samples(forcings), "sample",
+                                  num_devices, mesh, broadcast=True),
+          checkpoint_dir=_get_sample_checkpoint_dir(checkpoint_dir, sample_idx),
+          **chunked_prediction_kwargs):
+        prediction_chunk.coords["sample"] = np.arange(
+            sample_idx.start, sample_idx.stop)
+        yield prediction_chunk
+        del prediction_chunk
   else:
     for i in range(num_samples):
       logging.info("Sample %d/%d", i, num_samples)
@@ -196,20 +328,32 @@ def chunked_prediction_generator_multiple_runs(
           inputs=sample_inputs,
           targets_template=targets_template,
           forcings=sample_forcings,
+          checkpoint_dir=_get_sample_checkpoint_dir(
+              checkpoint_dir, slice(i, i + 1)),
           **chunked_prediction_kwargs):
         prediction_chunk.coords["sample"] = i
         yield prediction_chunk
         del prediction_chunk
 
 
+def _get_sample_checkpoint_dir(
+    checkpoint_dir: Optional[str], sample_idx: slice) -> Optional[str]:
+  if checkpoint_dir is None:
+    return None
+  return os.path.join(
+      checkpoint_dir, f"samples_{sample_idx.start}-{sample_idx.stop}")
+
+
 def chunked_prediction(
     predictor_fn: PredictorFn,
     rng: chex.PRNGKey,
     inputs: xarray.Dataset,
     targets_template: xarray.Dataset,
-    forcings: xarray.Dataset,
+    forcings: Optional[xarray.Dataset],
     num_steps_per_chunk: int = 1,
     verbose: bool = False,
+    device_resident: bool = False,
+    forcings_fn: Optional[ForcingsFn] = None,
 ) -> xarray.Dataset:
   """Outputs a long trajectory by iteratively concatenating chunked predictions.
 
@@ -224,20 +368,31 @@ def chunked_prediction(
         at each call of `predictor_fn`. It must evenly divide the number of
         steps in `targets_template`.
     verbose: Whether to log the current chunk being predicted.
+    device_resident: Whether to use the device resident rollout, see
+        `chunked_prediction_generator`. The chunks are then also copied into
+        preallocated host arrays, rather than concatenated at the end.
+    forcings_fn: Optional function computing the forcings of each chunk, instead
+        of `forcings`, see `chunked_prediction_generator`.
 
   Returns:
     Predictions for the targets template.
 
   """
-  chunks_list = []
-  for prediction_chunk in chunked_prediction_generator(
+  chunks = chunked_prediction_generator(
       predictor_fn=predictor_fn,
       rng=rng,
       inputs=inputs,
       targets_template=targets_template,
       forcings=forcings,
       num_steps_per_chunk=num_steps_per_chunk,
-      verbose=verbose):
+      verbose=verbose,
+      device_resident=device_resident,
+      forcings_fn=forcings_fn)
+  if device_resident:
+    num_chunks = targets_template.sizes["time"] // num_steps_per_chunk
+    return _concat_chunks_on_host(chunks, num_chunks=num_chunks)
+  chunks_list = []
+  for prediction_chunk in chunks:
     chunks_list.append(jax.device_get(prediction_chunk))
   return xarray.concat(chunks_list, dim="time")
 
@@ -247,19 +402,65 @@ def chunked_prediction_generator(
     rng: chex.PRNGKey,
     inputs: xarray.Dataset,
     targets_template: xarray.Dataset,
-    forcings: xarray.Dataset,
+    forcings: Optional[xarray.Dataset],
     num_steps_per_chunk: int = 1,
     verbose: bool = False,
-    pmap_devices: Optional[Sequence[jax.Device]] = None
-) -> Iterator[xarray.Dataset]:
+    pmap_devices: Optional[Sequence[jax.Device]] = None,
+    device_resident: bool = False,
+    checkpoint_dir: Optional[str] = None,
+    forcings_fn: Optional[ForcingsFn] = None,
+    defer_checkpoints: bool = False,
+) -> Iterator[Union[xarray.Dataset, CheckpointedChunk]]:
   """Outputs a long trajectory by yielding chunked predictions.
 
+  By default, the inputs of every chunk are rebuilt on the host from the
+  previous inputs, predictions and forcings with xarray operations. With
+  `device_resident=True` the rollout instead:
+  * keeps the time-dependent inputs on the device, as a window of plain arrays
+    which is shifted by a jitted function after every chunk,
+  * copies the forcings to the device once, and slices each chunk from them
+    on the device,
+  * copies the targets template for a single chunk to the device once, and
+    reuses it for every chunk (only its structure matters to the predictor),
+  * dispatches each chunk before yielding the previous one, so the consumer
+    can copy the previous predictions to the host while the device works.
+  xarray objects are only built around the device arrays when calling
+  `predictor_fn` and when yielding the predictions. The predictions are the
+  same as in the default rollout.
+
+  With a `checkpoint_dir`, the state of the rollout (the time-dependent inputs
+  of the next chunk, the random key and the number of completed chunks) is
+  saved there whenever the consumer asks for the next chunk, i.e. once it is
+  done with the previous one. If the directory already holds such a
+  checkpoint, e.g. because the process was pre-empted, the rollout restarts
+  from it, memory-mapping the saved inputs, and only yields the remaining
+  chunks, which are identical to those of an uninterrupted rollout. The other
+  arguments must be the same as for the interrupted rollout.
+
+  A consumer which asks for the next chunk before it is done with the previous
+  one, such as `write_chunks_async`, must checkpoint the rollout itself, or a
+  resumed rollout may skip chunks which were never written. With
+  `defer_checkpoints=True`, each chunk is yielded as a `CheckpointedChunk`,
+  whose `save_checkpoint` is to be called once its predictions are written, in
+  the order of the chunks. `write_chunks_async` does so after `write_fn`
+  returns.
+
+  Rather than `forcings` for all the target steps, a `forcings_fn` can be given
+  to compute the forcings of each chunk when it is predicted, e.g.
+  `functools.partial(data_utils.get_forcings, forcing_variables=...)`. It is
+  called with the targets template of the chunk, with its actual time and
+  `datetime` coordinates but possibly without its data variables, and returns
+  the forcings for the same times.
+
   Args:
     predictor_fn: Function to use to make predictions for each chunk.
     rng: Random key.
     inputs: Inputs for the model.
     targets_template: Template for the target prediction, requires targets
-        equispaced in time.
+        equispaced in time. Only its structure is used, and at most one chunk
+        of it is ever copied, so its data can be lazy (e.g. dask arrays, see
+        `extend_targets_template`) or zero-strided (e.g. `np.broadcast_to`) to
+        avoid allocating it for all the target steps.
     forcings: Optional forcing for the model.
     num_steps_per_chunk: How many of the steps in `targets_template` to predict
         at each call of `predictor_fn`. It must evenly divide the number of
@@ -267,18 +468,38 @@ def chunked_prediction_generator(
     verbose: Whether to log the current chunk being predicted.
     pmap_devices: List of devices over which predictor_fn is pmapped, or None if
       it is not pmapped.
+    device_resident: Whether to use the device resident rollout described
+      above. Not supported together with `pmap_devices`.
+    checkpoint_dir: Optional directory to checkpoint the rollout in, and to
+      resume it from, as described above.
+    forcings_fn: Optional function computing the forcings of each chunk, as
+      described above. Requires a `datetime` coordinate in `targets_template`,
+      and `forcings` to be None.
+    defer_checkpoints: Whether to leave the checkpoints to the consumer, as
+      described above. Requires a `checkpoint_dir`.
 
   Yields:
     The predictions for each chunked step of the chunked rollout, such as
     if all predictions are concatenated in time this would match the targets
-    template in structure.
+    template in structure. They are wrapped in a `CheckpointedChunk` with
+    `defer_checkpoints=True`.
 
   """
+  if device_resident and pmap_devices is not None:
+    raise ValueError(
+        "The device resident rollout does not support `pmap_devices`.")
+  if (forcings is None) == (forcings_fn is None):
+    raise ValueError("Exactly one of `forcings` and `forcings_fn` is needed.")
+  if defer_checkpoints and checkpoint_dir is None:
+    raise ValueError("`defer_checkpoints` requires a `checkpoint_dir`.")
 
   # Create copies to avoid mutating inputs.
-  inputs = xarray.Dataset(inputs)
-  targets_template = xarray.Dataset(targets_template)
-  forcings = xarray.Dataset(forcings)
+  inputs = inputs.copy()
+  targets_template = targets_template.copy()
+  if forcings is not None:
+    forcings = forcings.copy()
+    if "datetime" in forcings.coords:
+      del forcings.coords["datetime"]
 
   if "datetime" in inputs.coords:
     del inputs.coords["datetime"]
@@ -288,11 +509,12 @@ def chunked_prediction_generator(
     del targets_template.coords["datetime"]
   else:
     output_datetime = None
+    if forcings_fn is not None:
+      raise ValueError(
+          "`forcings_fn` requires a `datetime` coordinate in the targets "
+          "template.")
 
-  if "datetime" in forcings.coords:
-    del forcings.coords["datetime"]
-
-  num_target_steps = targets_template.dims["time"]
+  num_target_steps = targets_template.sizes["time"]
   num_chunks, remainder = divmod(num_target_steps, num_steps_per_chunk)
   if remainder != 0:
     raise ValueError(
@@ -307,7 +529,47 @@ def chunked_prediction_generator(
   targets_chunk_time = targets_template.time.isel(
       time=slice(0, num_steps_per_chunk))
 
+  def get_chunk_forcings(target_slice):
+    """Returns the forcings of a chunk, with the time of the first chunk."""
+    if forcings_fn is None:
+      chunk_forcings = forcings.isel(time=target_slice)
+    else:
+      # Only the coordinates of the chunk are needed to compute its forcings.
+      chunk_template = xarray.Dataset(
+          coords=targets_template.coords).isel(time=target_slice)
+      chunk_template.coords["datetime"] = output_datetime.isel(
+          time=target_slice)
+      chunk_forcings = forcings_fn(chunk_template)
+      if "datetime" in chunk_forcings.coords:
+        chunk_forcings = chunk_forcings.drop_vars("datetime")
+    return chunk_forcings.assign_coords(time=targets_chunk_time).compute()
+
+  if device_resident:
+    chunks = _device_resident_chunked_prediction_generator(
+        predictor_fn=predictor_fn,
+        rng=rng,
+        inputs=inputs,
+        targets_template=targets_template,
+        forcings=forcings,
+        forcings_fn=None if forcings_fn is None else get_chunk_forcings,
+        num_steps_per_chunk=num_steps_per_chunk,
+        output_datetime=output_datetime,
+        verbose=verbose,
+        checkpoint_dir=checkpoint_dir,
+        defer_checkpoints=defer_checkpoints)
+    # Only `chunks` holds on to the inputs from now on, so it can free them.
+    del inputs, forcings
+    yield from chunks
+    return
+
   current_inputs = inputs
+  window_keys = sorted(k for k, v in inputs.data_vars.items()
+                       if "time" in v.dims)
+  first_chunk_index = 0
+  checkpoint = _load_checkpoint(checkpoint_dir, num_chunks)
+  if checkpoint is not None:
+    first_chunk_index, rng, window = checkpoint
+    current_inputs = current_inputs.assign(window)
 
   def split_rng_fn(rng):
     # Note, this is *not* equivalent to `return jax.random.split(rng)`, because
@@ -315,13 +577,19 @@ def chunked_prediction_generator(
     # `jax.random.split` actually gets split into two arrays, so when calling
     # the function with pmap the output is Tuple[Array, Array], where the
     # leading axis of each array is `num devices`.
-    rng1, rng2 = jax.random.split(rng)
-    return rng1, rng2
+    return _split_rng(rng)
 
   if pmap_devices is not None:
     split_rng_fn = jax.pmap(split_rng_fn, devices=pmap_devices)
 
-  for chunk_index in range(num_chunks):
+  def get_checkpoint_saver(num_completed_chunks, rng, inputs):
+    if checkpoint_dir is None:
+      return None
+    window = {k: inputs[k].variable for k in window_keys}
+    return lambda: _save_checkpoint(
+        checkpoint_dir, num_completed_chunks, num_chunks, rng, window)
+
+  for chunk_index in range(first_chunk_index, num_chunks):
     if verbose:
       logging.info("Chunk %d/%d", chunk_index, num_chunks)
       logging.flush()
@@ -337,9 +605,7 @@ def chunked_prediction_generator(
     current_targets_template = current_targets_template.assign_coords(
         time=targets_chunk_time).compute()
 
-    current_forcings = forcings.isel(time=target_slice)
-    current_forcings = current_forcings.assign_coords(time=targets_chunk_time)
-    current_forcings = current_forcings.compute()
+    current_forcings = get_chunk_forcings(target_slice)
     # Make predictions for the chunk.
     rng, this_rng = split_rng_fn(rng)
     predictions = predictor_fn(
@@ -372,10 +638,628 @@ def chunked_prediction_generator(
     if output_datetime is not None:
       predictions.coords["datetime"] = output_datetime.isel(
           time=target_slice)
-    yield predictions
+    yield from _hand_over_chunk(
+        predictions,
+        get_checkpoint_saver(chunk_index + 1, rng, current_inputs),
+        defer_checkpoints)
     del predictions
 
 
+def _device_resident_chunked_prediction_generator(
+    predictor_fn: PredictorFn,
+    rng: chex.PRNGKey,
+    inputs: xarray.Dataset,
+    targets_template: xarray.Dataset,
+    forcings: Optional[xarray.Dataset],
+    forcings_fn: Optional[Callable[[slice], xarray.Dataset]],
+    num_steps_per_chunk: int,
+    output_datetime: Optional[xarray.DataArray],
+    verbose: bool,
+    checkpoint_dir: Optional[str],
+    defer_checkpoints: bool,
+) -> Iterator[Union[xarray.Dataset, CheckpointedChunk]]:
+  """Device resident version of the loop of `chunked_prediction_generator`.
+
+  Here `forcings_fn` returns the forcings of the chunk with the given target
+  slice, if the forcings are not given up front.
+  """
+
+  num_chunks = targets_template.sizes["time"] // num_steps_per_chunk
+  targets_chunk_time = targets_template.time.isel(
+      time=slice(0, num_steps_per_chunk))
+
+  # The time-dependent inputs are kept on the device as plain arrays (the
+  # window), and replaced by the trailing frames of the inputs, predictions
+  # and forcings after every chunk, exactly like `_get_next_inputs` does.
+  inputs = inputs.compute()
+  window_keys = sorted(k for k, v in inputs.data_vars.items()
+                       if "time" in v.dims)
+  forced_keys = (
+      forcings_fn(slice(0, num_steps_per_chunk)).keys()
+      if forcings is None else forcings.keys())
+  if set(window_keys) - set(targets_template.keys()) - set(forced_keys):
+    raise ValueError(
+        "Found an input with a time index that is not predicted or forced.")
+  window_dims = {k: inputs[k].dims for k in window_keys}
+  window = {k: jax.device_put(xarray_jax.unwrap_data(inputs[k]))
+            for k in window_keys}
+  window_time_axes = _get_time_axes(window_dims)
+  first_chunk_index = 0
+  checkpoint = _load_checkpoint(checkpoint_dir, num_chunks)
+  if checkpoint is not None:
+    first_chunk_index, rng, saved_window = checkpoint
+    for k in window_keys:
+      if saved_window[k].dims != window_dims[k]:
+        raise ValueError(
+            f"The checkpointed input {k} has dims {saved_window[k].dims}, "
+            f"expected {window_dims[k]}.")
+      window[k] = jax.device_put(
+          np.asarray(saved_window[k].data), window[k].sharding)
+  constant_inputs = {
+      k: jax.device_put(inputs[k].variable)
+      for k in inputs.data_vars.keys() if k not in window}
+  inputs_coords = {k: v.variable for k, v in inputs.coords.items()}
+  # The inputs are now held by the window, which is shifted out after each
+  # chunk, so they are not kept around for the whole rollout.
+  del inputs
+
+  if forcings is not None:
+    # All the forcings are copied to the device once, and sliced there.
+    forcings = forcings.compute()
+    forcings_dims = {k: v.dims for k, v in forcings.data_vars.items()}
+    all_forcings = {k: jax.device_put(xarray_jax.unwrap_data(v))
+                    for k, v in forcings.data_vars.items()}
+    forcings_time_axes = _get_time_axes(forcings_dims)
+    forcings_coords = {
+        k: v.variable for k, v in forcings.isel(
+            time=slice(0, num_steps_per_chunk)).assign_coords(
+                time=targets_chunk_time).coords.items()}
+    del forcings
+
+  targets_chunk_template = jax.device_put(
+      targets_template.isel(time=slice(0, num_steps_per_chunk))
+      .assign_coords(time=targets_chunk_time).compute())
+
+  def get_checkpoint_saver(num_completed_chunks, rng, window):
+    if checkpoint_dir is None:
+      return None
+    return lambda: _save_checkpoint(
+        checkpoint_dir, num_completed_chunks, num_chunks, rng,
+        {k: xarray_jax.Variable(window_dims[k], v) for k, v in window.items()})
+
+  pending_predictions = None
+  for chunk_index in range(first_chunk_index, num_chunks):
+    if verbose:
+      logging.info("Chunk %d/%d", chunk_index, num_chunks)
+      logging.flush()
+
+    target_offset = num_steps_per_chunk * chunk_index
+    target_slice = slice(target_offset, target_offset + num_steps_per_chunk)
+
+    if forcings_fn is None:
+      current_forcings = xarray_jax.Dataset(
+          {k: (forcings_dims[k], v) for k, v in _slice_time(
+              forcings_time_axes, num_steps_per_chunk, all_forcings,
+              target_offset).items()},
+          coords=forcings_coords)
+    else:
+      # Computed on the host for this chunk only, while the device is still
+      # busy with the previous one.
+      current_forcings = jax.device_put(forcings_fn(target_slice))
+    current_inputs = xarray_jax.Dataset(
+        dict(constant_inputs, **{k: (window_dims[k], v)
+                                 for k, v in window.items()}),
+        coords=inputs_coords)
+
+    # The state before this chunk, to checkpoint once the previous chunk has
+    # been handed over. Not kept otherwise, so its inputs can be freed early.
+    state = (chunk_index, rng, window) if checkpoint_dir is not None else None
+
+    # Make predictions for the chunk.
+    rng, this_rng = _split_rng(rng)
+    predictions = predictor_fn(
+        rng=this_rng,
+        inputs=current_inputs,
+        targets_template=targets_chunk_template,
+        forcings=current_forcings)
+
+    # Predicted values take precedence over forced ones.
+    next_frame = {
+        k: xarray_jax.unwrap_data(
+            (predictions if k in predictions else current_forcings)[k]
+            .transpose(*window_dims[k]))
+        for k in window_keys}
+    window = _shift_time_window(window_time_axes, window, next_frame)
+
+    # At this point we can assign the actual targets time coordinates.
+    predictions = predictions.assign_coords(
+        time=targets_template.coords["time"].isel(time=target_slice))
+    if output_datetime is not None:
+      predictions.coords["datetime"] = output_datetime.isel(
+          time=target_slice)
+
+    # The next chunk has been dispatched before the previous predictions are
+    # handed over, so the device can compute it in the meantime.
+    if pending_predictions is not None:
+      yield from _hand_over_chunk(
+          pending_predictions,
+          None if state is None else get_checkpoint_saver(*state),
+          defer_checkpoints)
+    pending_predictions = predictions
+    del predictions, state
+
+  if pending_predictions is not None:
+    yield from _hand_over_chunk(
+        pending_predictions, get_checkpoint_saver(num_chunks, rng, window),
+        defer_checkpoints)
+
+
+def _hand_over_chunk(
+    predictions: xarray.Dataset,
+    save_checkpoint: Optional[Callable[[], None]],
+    defer_checkpoints: bool,
+) -> Iterator[Union[xarray.Dataset, CheckpointedChunk]]:
+  """Yields a chunk, and checkpoints the rollout after it (if checkpointed).
+
+  The checkpoint is saved once the consumer asks for the next chunk, or is left
+  to the consumer with `defer_checkpoints`.
+  """
+  if save_checkpoint is not None and defer_checkpoints:
+    yield CheckpointedChunk(predictions, save_checkpoint)
+    return
+  yield predictions
+  del predictions
+  if save_checkpoint is not None:
+    save_checkpoint()
+
+
+# Tells the writer threads of `write_chunks_async` that there is no more work.
+_NO_MORE_CHUNKS = object()
+
+
+def write_chunks_async(
+    chunks: Iterable[Any],
+    write_fn: Callable[[Any], None],
+    num_writers: int = 1,
+    max_queue_size: int = 2,
+) -> None:
+  """Writes chunks of predictions in background threads as they are yielded.
+
+  This pipelines a rollout with the writing of its outputs: the calling thread
+  only iterates over `chunks` (e.g. from `chunked_prediction_generator`, which
+  dispatches the computation of the next chunk asynchronously), and hands each
+  chunk over to `num_writers` writer threads through a bounded queue. The
+  writer threads copy the chunk to host with `jax.device_get` and call
+  `write_fn` on it, so the copy, any unit conversion and the serialization of a
+  chunk overlap with the computation of the next ones.
+
+  The queue holds at most `max_queue_size` chunks, so iterating over `chunks`
+  blocks when the writers fall behind, which bounds the number of chunks held
+  in memory at any time to `max_queue_size + num_writers`.
+
+  Since `chunks` is iterated over before the previous chunks are written, a
+  checkpointed rollout must be given with `defer_checkpoints=True` (see
+  `chunked_prediction_generator`). `write_fn` is then called with the
+  predictions of each `CheckpointedChunk`, and its checkpoint is saved once it
+  and all the previous chunks are written, so that a resumed rollout never
+  skips a chunk which was not written.
+
+  Args:
+    chunks: Chunks to write, any pytree that `jax.device_get` accepts, such as
+      the xarray.Datasets yielded by `chunked_prediction_generator`.
+    write_fn: Function writing a single chunk, once it is on the host. With
+      more than one writer, it is called concurrently from several threads and
+      the chunks may be written out of order.
+    num_writers: Number of writer threads.
+    max_queue_size: Maximum number of chunks waiting for a writer.
+
+  Raises:
+    The first exception raised by `write_fn` (or by saving a checkpoint), once
+    all the writers have stopped. No more chunks are written, checkpointed or
+    computed after a failed write.
+  """
+  if num_writers < 1:
+    raise ValueError(f"num_writers must be at least 1, got {num_writers}.")
+  if max_queue_size < 1:
+    raise ValueError(
+        f"max_queue_size must be at least 1, got {max_queue_size}.")
+
+  chunk_queue = queue.Queue(maxsize=max_queue_size)
+  errors = []
+  # The checkpoints of the written chunks, by chunk index, until all the
+  # previous chunks are written too.
+  written_checkpoints = {}
+  num_checkpointed_chunks = 0
+  checkpoint_lock = threading.Lock()
+
+  def save_checkpoints(chunk_index, save_checkpoint):
+    nonlocal num_checkpointed_chunks
+    with checkpoint_lock:
+      written_checkpoints[chunk_index] = save_checkpoint
+      while num_checkpointed_chunks in written_checkpoints:
+        written_checkpoints.pop(num_checkpointed_chunks)()
+        num_checkpointed_chunks += 1
+
+  def writer():
+    while True:
+      item = chunk_queue.get()
+      if item is _NO_MORE_CHUNKS:
+        return
+      chunk_index, chunk = item
+      del item
+      # After a failure, keep draining the queue so the producer never blocks.
+      if not errors:
+        try:
+          chunk = jax.device_get(chunk)
+          if isinstance(chunk, CheckpointedChunk):
+            write_fn(chunk.predictions)
+            save_checkpoints(chunk_index, chunk.save_checkpoint)
+          else:
+            write_fn(chunk)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+          errors.append(e)
+      del chunk
+
+  threads = [threading.Thread(target=writer, name=f"chunk_writer_{i}",
+                              daemon=True)
+             for i in range(num_writers)]
+  for thread in threads:
+    thread.start()
+  try:
+    for chunk_index, chunk in enumerate(chunks):
+      if errors:
+        break
+      chunk_queue.put((chunk_index, chunk))
+      del chunk
+  finally:
+    for _ in threads:
+      chunk_queue.put(_NO_MORE_CHUNKS)
+    for thread in threads:
+      thread.join()
+  if errors:
+    raise errors[0]
+
+
+# Attributes of the Zarr stores written by `chunked_prediction_to_zarr`.
+_ZARR_NUM_STEPS_PER_CHUNK_ATTR = "rollout_num_steps_per_chunk"
+_ZARR_NUM_COMPLETED_CHUNKS_ATTR = "rollout_num_completed_chunks"
+
+
+def chunked_prediction_to_zarr(
+    store: Any,
+    predictor_fn: PredictorFn,
+    rng: chex.PRNGKey,
+    inputs: xarray.Dataset,
+    targets_template: xarray.Dataset,
+    forcings: Optional[xarray.Dataset],
+    num_steps_per_chunk: int = 1,
+    verbose: bool = False,
+    device_resident: bool = False,
+    forcings_fn: Optional[ForcingsFn] = None,
+) -> xarray.Dataset:
+  """Streams a long trajectory into a Zarr store, resuming an interrupted one.
+
+  On the first call, the store is created from `extend_targets_template`
+  (lazy arrays, one Zarr chunk per rollout chunk) without writing any data.
+  The chunks of `chunked_prediction_generator` are then written into their
+  time slices as they are yielded, in a background thread (see
+  `write_chunks_async`), and the number of completed chunks is recorded in the
+  attributes of the store after each of them. So only a few chunks are ever
+  held in memory, whatever the length of the trajectory.
+
+  If the store already exists (e.g. the job writing it was pre-empted), the
+  rollout is restarted after the last completed chunk: the inputs of the next
+  chunk are rebuilt from `inputs`, the written predictions and the forcings,
+  and `rng` is split as many times as it was for the completed chunks, so the
+  resumed trajectory is identical to an uninterrupted one. The arguments must
+  be the same as for the call that created the store.
+
+  Args:
+    store: Zarr store, or path to it, as accepted by `xarray.Dataset.to_zarr`.
+    predictor_fn: Function to use to make predictions for each chunk.
+    rng: Random key.
+    inputs: Inputs for the model.
+    targets_template: Template for the target prediction, requires targets
+        equispaced in time.
+    forcings: Optional forcing for the model.
+    num_steps_per_chunk: How many of the steps in `targets_template` to predict
+        at each call of `predictor_fn`. It must evenly divide the number of
+        steps in `targets_template`.
+    verbose: Whether to log the current chunk being predicted.
+    device_resident: Whether to use the device resident rollout, see
+        `chunked_prediction_generator`.
+    forcings_fn: Optional function computing the forcings of each chunk, see
+        `chunked_prediction_generator`. Requires `forcings` to be None. It is
+        called with the actual times of the chunks, also when resuming.
+
+  Returns:
+    The complete predictions, lazily opened from the store.
+  """
+  if (forcings is None) == (forcings_fn is None):
+    raise ValueError("Exactly one of `forcings` and `forcings_fn` is needed.")
+  num_target_steps = targets_template.sizes["time"]
+  num_chunks, remainder = divmod(num_target_steps, num_steps_per_chunk)
+  if remainder != 0:
+    raise ValueError(
+        f"The number of steps per chunk {num_steps_per_chunk} must "
+        f"evenly divide the number of target steps {num_target_steps} ")
+
+  try:
+    written = _open_zarr(store)
+  except FileNotFoundError:
+    template = extend_targets_template(targets_template, num_target_steps)
+    # Only the data is chunked, so the coordinates are written right away.
+    template = template.chunk({"time": num_steps_per_chunk}).assign_coords(
+        template.coords)
+    template.attrs = dict(targets_template.attrs, **{
+        _ZARR_NUM_STEPS_PER_CHUNK_ATTR: num_steps_per_chunk,
+        _ZARR_NUM_COMPLETED_CHUNKS_ATTR: 0})
+    template.to_zarr(store, mode="w-", compute=False, consolidated=False)
+    written = _open_zarr(store)
+
+  if (written.attrs.get(_ZARR_NUM_STEPS_PER_CHUNK_ATTR) != num_steps_per_chunk
+      or written.sizes.get("time") != num_target_steps
+      or set(written.data_vars) != set(targets_template.data_vars)):
+    raise ValueError(
+        f"The Zarr store {store} was not written by a rollout of the same "
+        f"targets with {num_steps_per_chunk} steps per chunk.")
+  attrs = dict(written.attrs)
+  num_completed_chunks = attrs[_ZARR_NUM_COMPLETED_CHUNKS_ATTR]
+  if num_completed_chunks == num_chunks:
+    return written
+
+  num_completed_steps = num_completed_chunks * num_steps_per_chunk
+  if num_completed_chunks:
+    logging.info("Resuming the rollout in %s after %d/%d chunks.",
+                 store, num_completed_chunks, num_chunks)
+    for _ in range(num_completed_chunks):
+      rng = jax.random.split(rng)[0]
+    completed_steps = slice(0, num_completed_steps)
+    if forcings is None:
+      completed_forcings = forcings_fn(
+          xarray.Dataset(coords=targets_template.coords).isel(
+              time=completed_steps))
+    else:
+      completed_forcings = forcings.isel(time=completed_steps)
+    next_frame = xarray.merge([
+        written.isel(time=completed_steps).drop_vars(
+            "datetime", errors="ignore"),
+        completed_forcings.drop_vars("datetime", errors="ignore"),
+    ])
+    inputs = _get_next_inputs(inputs, next_frame).assign_coords(
+        time=inputs.coords["time"]).compute()
+
+  # The remaining steps get the time coordinates of the first ones, which is
+  # what `chunked_prediction_generator` passes to `predictor_fn` anyway.
+  remaining_steps = slice(num_completed_steps, None)
+  target_time = targets_template.coords["time"].data
+  remaining_time = target_time[:num_target_steps - num_completed_steps]
+  if forcings is not None:
+    remaining_forcings = forcings.isel(time=remaining_steps).assign_coords(
+        time=remaining_time)
+    remaining_forcings_fn = None
+  else:
+    # `forcings_fn` is still called with the actual times of the chunks.
+    time_offset = target_time[num_completed_steps] - target_time[0]
+    remaining_forcings = None
+    remaining_forcings_fn = lambda chunk_template: forcings_fn(
+        chunk_template.assign_coords(
+            time=chunk_template.coords["time"] + time_offset))
+  chunks = chunked_prediction_generator(
+      predictor_fn=predictor_fn,
+      rng=rng,
+      inputs=inputs,
+      targets_template=targets_template.isel(time=remaining_steps)
+      .assign_coords(time=remaining_time),
+      forcings=remaining_forcings,
+      num_steps_per_chunk=num_steps_per_chunk,
+      verbose=verbose,
+      device_resident=device_resident,
+      forcings_fn=remaining_forcings_fn)
+
+  def write_chunk(indexed_chunk):
+    chunk_index, chunk = indexed_chunk
+    region = {"time": slice(chunk_index * num_steps_per_chunk,
+                            (chunk_index + 1) * num_steps_per_chunk)}
+    # Only the data is written, the coordinates are already in the store.
+    chunk = xarray.Dataset(
+        {k: v.transpose(*written[k].dims).variable
+         for k, v in chunk.data_vars.items()})
+    chunk.to_zarr(store, region=region, consolidated=False)
+    attrs[_ZARR_NUM_COMPLETED_CHUNKS_ATTR] = chunk_index + 1
+    xarray.Dataset(attrs=attrs).to_zarr(store, mode="a", consolidated=False)
+
+  # A single writer, so that the chunks are completed in order.
+  write_chunks_async(
+      enumerate(chunks, start=num_completed_chunks), write_chunk)
+  return _open_zarr(store)
+
+
+def _open_zarr(store: Any) -> xarray.Dataset:
+  return xarray.open_zarr(store, consolidated=False, decode_timedelta=True)
+
+
+def _split_rng(rng: chex.PRNGKey) -> Tuple[chex.PRNGKey, chex.PRNGKey]:
+  """Splits a random key, or each key of a batch of keys independently."""
+  if jax.dtypes.issubdtype(rng.dtype, jax.dtypes.prng_key):
+    single_key_ndim = 0
+  else:
+    single_key_ndim = 1
+  if rng.ndim > single_key_ndim:
+    return jax.vmap(_split_rng)(rng)
+  rng1, rng2 = jax.random.split(rng)
+  return rng1, rng2
+
+
+def _get_time_axes(
+    dims: Mapping[str, Tuple[str, ...]]) -> Tuple[Tuple[str, int], ...]:
+  """Returns the (hashable) position of the time axis of each variable."""
+  return tuple(sorted((k, d.index("time")) for k, d in dims.items()
+                      if "time" in d))
+
+
+@functools.partial(jax.jit, static_argnums=(0, 1))
+def _slice_time(
+    time_axes: Tuple[Tuple[str, int], ...],
+    size: int,
+    arrays: Mapping[str, jax.Array],
+    start: int,
+    ) -> Mapping[str, jax.Array]:
+  """Slices `size` time steps from `start` (which is not static)."""
+  time_axes = dict(time_axes)
+  return {k: jax.lax.dynamic_slice_in_dim(v, start, size, axis=time_axes[k])
+             if k in time_axes else v
+          for k, v in arrays.items()}
+
+
+@functools.partial(jax.jit, static_argnums=(0,))
+def _shift_time_window(
+    time_axes: Tuple[Tuple[str, int], ...],
+    window: Mapping[str, jax.Array],
+    next_frames: Mapping[str, jax.Array],
+    ) -> Mapping[str, jax.Array]:
+  """Appends `next_frames` to `window`, keeping its length in time."""
+  shifted = {}
+  for k, axis in time_axes:
+    num_frames = window[k].shape[axis]
+    frames = jnp.concatenate(
+        [window[k], next_frames[k].astype(window[k].dtype)], axis=axis)
+    shifted[k] = jax.lax.slice_in_dim(
+        frames, frames.shape[axis] - num_frames, frames.shape[axis], axis=axis)
+  return shifted
+
+
+def _concat_chunks_on_host(
+    chunks: Iterator[xarray.Dataset], num_chunks: int) -> xarray.Dataset:
+  """Like `xarray.concat` of the chunks in time, after copying them to host.
+
+  The chunks are copied straight into arrays preallocated for the whole
+  trajectory, rather than being kept around and concatenated at the end.
+
+  Args:
+    chunks: Chunks of predictions, with the same number of time steps each.
+    num_chunks: Number of chunks.
+
+  Returns:
+    The concatenated predictions, backed by numpy arrays.
+  """
+  data = None
+  times = []
+  for chunk_index, chunk in enumerate(chunks):
+    chunk = jax.device_get(chunk)
+    chunk_size = chunk.sizes["time"]
+    if data is None:
+      first_chunk = chunk
+      data = {}
+      for k, v in chunk.data_vars.items():
+        shape = list(v.shape)
+        shape[v.dims.index("time")] *= num_chunks
+        data[k] = np.empty(shape, dtype=v.dtype)
+    time_slice = slice(chunk_index * chunk_size, (chunk_index + 1) * chunk_size)
+    for k, v in chunk.data_vars.items():
+      index = tuple(time_slice if d == "time" else slice(None) for d in v.dims)
+      data[k][index] = np.asarray(v.data)
+    times.append(chunk.coords.to_dataset()[[
+        k for k, v in chunk.coords.items() if "time" in v.dims]])
+    del chunk
+
+  if data is None:
+    raise ValueError("No chunks to concatenate.")
+  coords = {k: v.variable for k, v in first_chunk.coords.items()
+            if "time" not in v.dims}
+  coords.update(xarray.concat(times, dim="time").coords)
+  return xarray.Dataset(
+      {k: (v.dims, data[k], v.attrs) for k, v in first_chunk.data_vars.items()},
+      coords=coords,
+      attrs=first_chunk.attrs)
+
+
+# Describes the checkpoints of `chunked_prediction_generator`.
+_CHECKPOINT_STATE = "state.json"
+
+
+def _save_checkpoint(
+    checkpoint_dir: str,
+    num_completed_chunks: int,
+    num_chunks: int,
+    rng: chex.PRNGKey,
+    window: Mapping[str, xarray.Variable]) -> None:
+  """Atomically saves the state of a rollout, replacing older checkpoints.
+
+  Each checkpoint is a directory named after the number of completed chunks,
+  holding one `.npy` file per array, so they can be memory-mapped back in. It
+  is written to a temporary directory first and renamed into place, so an
+  interrupted save never leaves a partially written checkpoint.
+
+  Args:
+    checkpoint_dir: Directory holding the checkpoints of the rollout.
+    num_completed_chunks: Number of chunks handed over to the consumer.
+    num_chunks: Total number of chunks of the rollout.
+    rng: Random key for the remaining chunks.
+    window: Time-dependent inputs of the next chunk.
+  """
+  os.makedirs(checkpoint_dir, exist_ok=True)
+  tmp_dir = tempfile.mkdtemp(dir=checkpoint_dir, prefix=".tmp_checkpoint_")
+  try:
+    np.save(os.path.join(tmp_dir, "rng.npy"), np.asarray(jax.device_get(rng)))
+    for k, v in window.items():
+      np.save(os.path.join(tmp_dir, f"inputs.{k}.npy"),
+              np.asarray(jax.device_get(xarray_jax.unwrap_data(v))))
+    with open(os.path.join(tmp_dir, _CHECKPOINT_STATE), "w") as f:
+      json.dump(dict(num_completed_chunks=num_completed_chunks,
+                     num_chunks=num_chunks,
+                     dims={k: list(v.dims) for k, v in window.items()}), f)
+    os.rename(tmp_dir, os.path.join(
+        checkpoint_dir, f"chunk_{num_completed_chunks:06d}"))
+  finally:
+    if os.path.exists(tmp_dir):
+      shutil.rmtree(tmp_dir)
+
+  for name in os.listdir(checkpoint_dir):
+    if (name.startswith("chunk_")
+        and name < f"chunk_{num_completed_chunks:06d}"):
+      shutil.rmtree(os.path.join(checkpoint_dir, name))
+
+
+def _load_checkpoint(
+    checkpoint_dir: Optional[str], num_chunks: int,
+) -> Optional[Tuple[int, np.ndarray, Mapping[str, xarray.Variable]]]:
+  """Loads the latest checkpoint written by `_save_checkpoint`, if any.
+
+  Args:
+    checkpoint_dir: Directory holding the checkpoints of the rollout, or None.
+    num_chunks: Total number of chunks of the rollout.
+
+  Returns:
+    None if there is no checkpoint, otherwise the number of completed chunks,
+    the random key and the time-dependent inputs of the next chunk, as
+    read-only memory maps.
+  """
+  if checkpoint_dir is None or not os.path.isdir(checkpoint_dir):
+    return None
+  names = sorted(name for name in os.listdir(checkpoint_dir)
+                 if name.startswith("chunk_") and os.path.exists(
+                     os.path.join(checkpoint_dir, name, _CHECKPOINT_STATE)))
+  if not names:
+    return None
+  entry_dir = os.path.join(checkpoint_dir, names[-1])
+  with open(os.path.join(entry_dir, _CHECKPOINT_STATE)) as f:
+    state = json.load(f)
+  if state["num_chunks"] != num_chunks:
+    raise ValueError(
+        f"The checkpoint {entry_dir} is for a rollout of {state['num_chunks']} "
+        f"chunks, expected {num_chunks}.")
+  logging.info("Resuming the rollout from %s after %d/%d chunks.", entry_dir,
+               state["num_completed_chunks"], num_chunks)
+
+  def load_array(filename):
+    return np.load(os.path.join(entry_dir, filename), mmap_mode="r")
+
+  window = {k: xarray.Variable(tuple(dims), load_array(f"inputs.{k}.npy"))
+            for k, dims in state["dims"].items()}
+  return state["num_completed_chunks"], load_array("rng.npy"), window
+
+
 def _get_next_inputs(
     prev_inputs: xarray.Dataset, next_frame: xarray.Dataset,
     ) -> xarray.Dataset:
@@ -425,7 +1309,7 @@ def extend_targets_template(
   # Assert the first target time corresponds to the timestep.
   timestep = time[0].data
   if time.shape[0] > 1:
-    assert np.all(timestep == time[1:] - time[:-1])
+    assert np.all(timestep == np.diff(time.data))
 
   extended_time = (np.arange(required_num_steps) + 1) * timestep
 
@@ -0,0 +1,482 @@
+# Copyright 2024 DeepMind Technologies Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for rollout.py."""
+
+import os
+import tempfile
+import threading
+
+from absl.testing import absltest
+from absl.testing import parameterized
+from graphcast import rollout
+from graphcast import xarray_jax
+import jax
+import numpy as np
+import xarray
+
+
+def _get_data(num_target_steps):
+  rng = np.random.default_rng(0)
+  lat = np.linspace(-90., 90., 5)
+  lon = np.linspace(0., 300., 6)
+  input_time = np.array([-6, 0], dtype="timedelta64[h]")
+  target_time = np.arange(1, num_target_steps + 1) * np.timedelta64(6, "h")
+
+  def variable(time, dims=("batch", "time", "lat", "lon")):
+    shape = {"batch": 2, "time": len(time), "lat": 5, "lon": 6}
+    return (dims, rng.normal(size=[shape[d] for d in dims]).astype(np.float32))
+
+  inputs = xarray.Dataset(
+      dict(temperature=variable(input_time),
+           # Forced, with a different axis order than the forcings.
+           radiation=variable(input_time, ("time", "batch", "lat", "lon")),
+           land_sea_mask=(("lat", "lon"), rng.normal(size=[5, 6]))),
+      coords=dict(time=input_time, lat=lat, lon=lon))
+  targets_template = xarray.Dataset(
+      dict(temperature=variable(target_time)),
+      coords=dict(
+          time=target_time, lat=lat, lon=lon,
+          datetime=("time", np.datetime64("2024-01-01T00") + target_time)))
+  forcings = xarray.Dataset(
+      dict(radiation=variable(target_time)),
+      coords=dict(time=target_time, lat=lat, lon=lon))
+  return inputs, targets_template, forcings
+
+
+@jax.jit
+def _predictor_fn(rng, inputs, targets_template, forcings):
+  """Predicts all the target steps from the last input and the forcings."""
+  noise = xarray_jax.DataArray(jax.random.normal(rng, ()), dims=())
+  last_inputs = inputs.isel(time=-1, drop=True)
+  temperature = (
+      0.5 * last_inputs.temperature
+      + last_inputs.radiation * last_inputs.land_sea_mask
+      + forcings.radiation + noise)
+  return xarray.Dataset(dict(
+      temperature=temperature.transpose(
+          *targets_template.temperature.dims)))
+
+
+class _PreemptedError(Exception):
+  pass
+
+
+class RolloutTest(parameterized.TestCase):
+
+  @parameterized.parameters(1, 2)
+  def test_device_resident_matches_default(self, num_steps_per_chunk):
+    inputs, targets_template, forcings = _get_data(num_target_steps=4)
+
+    def predict(device_resident):
+      return rollout.chunked_prediction(
+          _predictor_fn,
+          rng=jax.random.PRNGKey(0),
+          inputs=inputs,
+          targets_template=targets_template,
+          forcings=forcings,
+          num_steps_per_chunk=num_steps_per_chunk,
+          device_resident=device_resident)
+
+    expected = predict(device_resident=False)
+    actual = predict(device_resident=True)
+    self.assertIsInstance(actual.temperature.data, np.ndarray)
+    xarray.testing.assert_allclose(expected, actual)
+    np.testing.assert_array_equal(
+        actual.datetime.data, targets_template.datetime.data)
+
+  @parameterized.parameters(False, True)
+  def test_forcings_fn_matches_forcings(self, device_resident):
+    inputs, targets_template, forcings = _get_data(num_target_steps=4)
+    chunk_datetimes = []
+
+    def forcings_fn(chunk_template):
+      chunk_datetimes.append(chunk_template.datetime.data)
+      return forcings.sel(time=chunk_template.time)
+
+    def predict(**kwargs):
+      return rollout.chunked_prediction(
+          _predictor_fn,
+          rng=jax.random.PRNGKey(0),
+          inputs=inputs,
+          targets_template=targets_template,
+          num_steps_per_chunk=2,
+          device_resident=device_resident,
+          **kwargs)
+
+    expected = predict(forcings=forcings)
+    actual = predict(forcings=None, forcings_fn=forcings_fn)
+    xarray.testing.assert_allclose(expected, actual)
+    np.testing.assert_array_equal(
+        chunk_datetimes[-2:],
+        targets_template.datetime.data.reshape([2, 2]))
+
+  @parameterized.parameters(False, True)
+  def test_lazy_targets_templates_match_template(self, device_resident):
+    inputs, targets_template, forcings = _get_data(num_target_steps=4)
+    zero_strided_template = targets_template.copy(data=dict(
+        temperature=np.broadcast_to(
+            np.float32(np.nan), targets_template.temperature.shape)))
+    dask_template = targets_template.chunk()
+
+    def predict(targets_template):
+      return rollout.chunked_prediction(
+          _predictor_fn,
+          rng=jax.random.PRNGKey(0),
+          inputs=inputs,
+          targets_template=targets_template,
+          forcings=forcings,
+          num_steps_per_chunk=2,
+          device_resident=device_resident)
+
+    expected = predict(targets_template)
+    xarray.testing.assert_allclose(expected, predict(zero_strided_template))
+    xarray.testing.assert_allclose(expected, predict(dask_template))
+
+  def test_device_resident_requires_predicted_or_forced_inputs(self):
+    inputs, targets_template, forcings = _get_data(num_target_steps=2)
+    with self.assertRaisesRegex(ValueError, "not predicted or forced"):
+      next(rollout.chunked_prediction_generator(
+          _predictor_fn,
+          rng=jax.random.PRNGKey(0),
+          inputs=inputs,
+          targets_template=targets_template,
+          forcings=forcings.drop_vars("radiation"),
+          device_resident=True))
+
+  @parameterized.parameters(1, 3)
+  def test_write_chunks_async_writes_all_chunks(self, num_writers):
+    inputs, targets_template, forcings = _get_data(num_target_steps=4)
+    kwargs = dict(
+        rng=jax.random.PRNGKey(0),
+        inputs=inputs,
+        targets_template=targets_template,
+        forcings=forcings,
+        device_resident=True)
+    expected = rollout.chunked_prediction(_predictor_fn, **kwargs)
+
+    written = []
+    lock = threading.Lock()
+
+    def write_fn(chunk):
+      self.assertIsInstance(chunk.temperature.data, np.ndarray)
+      with lock:
+        written.append(chunk)
+
+    rollout.write_chunks_async(
+        rollout.chunked_prediction_generator(_predictor_fn, **kwargs),
+        write_fn,
+        num_writers=num_writers,
+        max_queue_size=1)
+    self.assertLen(written, 4)
+    actual = xarray.concat(written, dim="time").sortby("time")
+    xarray.testing.assert_allclose(expected, actual)
+
+  def test_write_chunks_async_raises_write_errors(self):
+    num_chunks_consumed = 0
+
+    def chunks():
+      nonlocal num_chunks_consumed
+      for i in range(100):
+        num_chunks_consumed += 1
+        yield np.full([2], i)
+
+    def write_fn(chunk):
+      if chunk[0] == 1:
+        raise OSError("disk full")
+
+    with self.assertRaisesRegex(OSError, "disk full"):
+      rollout.write_chunks_async(
+          chunks(), write_fn, num_writers=2, max_queue_size=1)
+    # The rollout stops soon after the failed write.
+    self.assertLess(num_chunks_consumed, 100)
+
+  @parameterized.parameters(
+      (1, False, False), (2, True, False), (1, False, True), (2, True, True))
+  def test_chunked_prediction_to_zarr_resumes(
+      self, num_steps_per_chunk, device_resident, use_forcings_fn):
+    inputs, targets_template, forcings = _get_data(num_target_steps=6)
+    store = os.path.join(
+        self.enter_context(tempfile.TemporaryDirectory()), "predictions.zarr")
+    kwargs = dict(
+        rng=jax.random.PRNGKey(0),
+        inputs=inputs,
+        targets_template=targets_template,
+        forcings=forcings,
+        num_steps_per_chunk=num_steps_per_chunk,
+        device_resident=device_resident)
+    expected = rollout.chunked_prediction(_predictor_fn, **kwargs)
+    if use_forcings_fn:
+      kwargs.update(
+          forcings=None,
+          forcings_fn=lambda chunk: forcings.sel(time=chunk.time))
+
+    num_calls = 0
+    max_calls = 2
+
+    def preempted_predictor_fn(*args, **predictor_kwargs):
+      nonlocal num_calls
+      num_calls += 1
+      if num_calls > max_calls:
+        raise _PreemptedError()
+      return _predictor_fn(*args, **predictor_kwargs)
+
+    with self.assertRaises(_PreemptedError):
+      rollout.chunked_prediction_to_zarr(
+          store, preempted_predictor_fn, **kwargs)
+    num_completed_chunks = xarray.open_zarr(store, consolidated=False).attrs[
+        "rollout_num_completed_chunks"]
+    self.assertBetween(num_completed_chunks, 1, 2)
+
+    # Only the remaining chunks are predicted when resuming.
+    num_calls = 0
+    max_calls = 6
+    actual = rollout.chunked_prediction_to_zarr(
+        store, preempted_predictor_fn, **kwargs)
+    self.assertEqual(
+        num_calls, 6 // num_steps_per_chunk - num_completed_chunks)
+    np.testing.assert_array_equal(
+        expected.temperature.data,
+        actual.temperature.transpose(*expected.temperature.dims).data)
+    np.testing.assert_array_equal(
+        expected.datetime.data, actual.datetime.data)
+
+    # A complete store is simply opened.
+    num_calls = 0
+    rollout.chunked_prediction_to_zarr(store, preempted_predictor_fn, **kwargs)
+    self.assertEqual(num_calls, 0)
+
+  def test_chunked_prediction_to_zarr_rejects_other_stores(self):
+    inputs, targets_template, forcings = _get_data(num_target_steps=2)
+    store = os.path.join(
+        self.enter_context(tempfile.TemporaryDirectory()), "predictions.zarr")
+    kwargs = dict(
+        rng=jax.random.PRNGKey(0),
+        inputs=inputs,
+        targets_template=targets_template,
+        forcings=forcings)
+    rollout.chunked_prediction_to_zarr(store, _predictor_fn, **kwargs)
+    with self.assertRaisesRegex(ValueError, "was not written by a rollout"):
+      rollout.chunked_prediction_to_zarr(
+          store, _predictor_fn, num_steps_per_chunk=2, **kwargs)
+
+  def test_chunked_prediction_to_zarr_requires_forcings_or_forcings_fn(self):
+    inputs, targets_template, _ = _get_data(num_target_steps=2)
+    store = os.path.join(
+        self.enter_context(tempfile.TemporaryDirectory()), "predictions.zarr")
+    with self.assertRaisesRegex(ValueError, "Exactly one of `forcings`"):
+      rollout.chunked_prediction_to_zarr(
+          store, _predictor_fn, rng=jax.random.PRNGKey(0), inputs=inputs,
+          targets_template=targets_template, forcings=None)
+    self.assertFalse(os.path.exists(store))
+
+  @parameterized.parameters(False, True)
+  def test_checkpointed_rollout_resumes(self, device_resident):
+    inputs, targets_template, forcings = _get_data(num_target_steps=5)
+    checkpoint_dir = self.enter_context(tempfile.TemporaryDirectory())
+    kwargs = dict(
+        rng=jax.random.PRNGKey(0),
+        inputs=inputs,
+        targets_template=targets_template,
+        forcings=forcings,
+        device_resident=device_resident)
+    expected = list(rollout.chunked_prediction_generator(
+        _predictor_fn, **kwargs))
+
+    # Pre-empted while the third chunk is being consumed: only the first two
+    # ones are completed.
+    chunks = rollout.chunked_prediction_generator(
+        _predictor_fn, checkpoint_dir=checkpoint_dir, **kwargs)
+    for _ in range(3):
+      next(chunks)
+    del chunks
+    self.assertEqual(os.listdir(checkpoint_dir), ["chunk_000002"])
+
+    resumed = list(rollout.chunked_prediction_generator(
+        _predictor_fn, checkpoint_dir=checkpoint_dir, **kwargs))
+    self.assertLen(resumed, 3)
+    for expected_chunk, resumed_chunk in zip(expected[2:], resumed):
+      xarray.testing.assert_identical(
+          jax.device_get(expected_chunk), jax.device_get(resumed_chunk))
+
+    # Once completed, there is nothing left to predict.
+    self.assertEqual(os.listdir(checkpoint_dir), ["chunk_000005"])
+    self.assertEmpty(list(rollout.chunked_prediction_generator(
+        _predictor_fn, checkpoint_dir=checkpoint_dir, **kwargs)))
+
+  @parameterized.parameters((False, 1), (True, 1), (True, 2))
+  def test_write_chunks_async_checkpoints_written_chunks(
+      self, device_resident, num_writers):
+    inputs, targets_template, forcings = _get_data(num_target_steps=5)
+    checkpoint_dir = self.enter_context(tempfile.TemporaryDirectory())
+    kwargs = dict(
+        rng=jax.random.PRNGKey(0),
+        inputs=inputs,
+        targets_template=targets_template,
+        forcings=forcings,
+        device_resident=device_resident,
+        checkpoint_dir=checkpoint_dir)
+    expected = list(rollout.chunked_prediction_generator(
+        _predictor_fn, **dict(kwargs, checkpoint_dir=None)))
+    with self.assertRaisesRegex(ValueError, "requires a `checkpoint_dir`"):
+      next(rollout.chunked_prediction_generator(
+          _predictor_fn, defer_checkpoints=True,
+          **dict(kwargs, checkpoint_dir=None)))
+
+    # Pre-empted while writing the third chunk, with the next ones already
+    # computed: the checkpoint is at most after the first two chunks.
+    written = []
+    lock = threading.Lock()
+
+    def preempted_write_fn(chunk):
+      if chunk.time.data[0] == targets_template.time.data[2]:
+        raise _PreemptedError()
+      with lock:
+        written.append(chunk)
+
+    with self.assertRaises(_PreemptedError):
+      rollout.write_chunks_async(
+          rollout.chunked_prediction_generator(
+              _predictor_fn, defer_checkpoints=True, **kwargs),
+          preempted_write_fn,
+          num_writers=num_writers,
+          max_queue_size=2)
+    (checkpoint,) = os.listdir(checkpoint_dir)
+    num_completed_chunks = int(checkpoint[len("chunk_"):])
+    self.assertBetween(num_completed_chunks, 1, 2)
+    written_times = {chunk.time.data[0] for chunk in written}
+    for chunk in expected[:num_completed_chunks]:
+      self.assertIn(chunk.time.data[0], written_times)
+
+    # The rollout resumes from the first chunk which may not be written.
+    written = []
+    rollout.write_chunks_async(
+        rollout.chunked_prediction_generator(
+            _predictor_fn, defer_checkpoints=True, **kwargs),
+        written.append)
+    self.assertLen(written, 5 - num_completed_chunks)
+    for expected_chunk, resumed_chunk in zip(
+        expected[num_completed_chunks:], written):
+      xarray.testing.assert_identical(
+          jax.device_get(expected_chunk), resumed_chunk)
+    self.assertEqual(os.listdir(checkpoint_dir), ["chunk_000005"])
+
+  def test_checkpointed_pmap_rollout_resumes(self):
+    inputs, targets_template, forcings = _get_data(num_target_steps=3)
+    devices = jax.local_devices()[:1]
+    inputs, targets_template, forcings = (
+        x.expand_dims("sample").transpose("sample", ...)
+        for x in (inputs, targets_template, forcings))
+    pmapped_predictor_fn = xarray_jax.pmap(
+        _predictor_fn, dim="sample", devices=devices)
+
+    def predictor_fn(rng, inputs, targets_template, forcings):
+      return pmapped_predictor_fn(rng, inputs, targets_template, forcings)
+
+    checkpoint_dir = self.enter_context(tempfile.TemporaryDirectory())
+    kwargs = dict(
+        predictor_fn=predictor_fn,
+        rng=jax.random.split(jax.random.PRNGKey(0), len(devices)),
+        inputs=inputs,
+        targets_template=targets_template,
+        forcings=forcings,
+        pmap_devices=devices)
+    expected = list(rollout.chunked_prediction_generator(**kwargs))
+
+    chunks = rollout.chunked_prediction_generator(
+        checkpoint_dir=checkpoint_dir, **kwargs)
+    for _ in range(2):
+      next(chunks)
+    del chunks
+
+    resumed = list(rollout.chunked_prediction_generator(
+        checkpoint_dir=checkpoint_dir, **kwargs))
+    self.assertLen(resumed, 2)
+    for expected_chunk, resumed_chunk in zip(expected[1:], resumed):
+      xarray.testing.assert_identical(
+          jax.device_get(expected_chunk), jax.device_get(resumed_chunk))
+
+  def test_checkpointed_multiple_runs_skip_completed_samples(self):
+    inputs, targets_template, forcings = _get_data(num_target_steps=3)
+    checkpoint_dir = self.enter_context(tempfile.TemporaryDirectory())
+    kwargs = dict(
+        predictor_fn=_predictor_fn,
+        rngs=jax.random.split(jax.random.PRNGKey(0), 2),
+        inputs=inputs,
+        targets_template=targets_template,
+        forcings=forcings,
+        num_samples=2)
+    expected = list(
+        rollout.chunked_prediction_generator_multiple_runs(**kwargs))
+
+    # Pre-empted while consuming the second chunk of the second sample.
+    chunks = rollout.chunked_prediction_generator_multiple_runs(
+        checkpoint_dir=checkpoint_dir, **kwargs)
+    for _ in range(5):
+      next(chunks)
+    del chunks
+
+    # The first sample is skipped, and the second one resumed.
+    resumed = list(rollout.chunked_prediction_generator_multiple_runs(
+        checkpoint_dir=checkpoint_dir, **kwargs))
+    self.assertLen(resumed, 2)
+    for expected_chunk, resumed_chunk in zip(expected[4:], resumed):
+      xarray.testing.assert_identical(
+          jax.device_get(expected_chunk), jax.device_get(resumed_chunk))
+  @parameterized.parameters(1, 2)
+  def test_sharded_multiple_runs_match_sequential(self, num_steps_per_chunk):
+    inputs, targets_template, forcings = _get_data(num_target_steps=4)
+    mesh = jax.sharding.Mesh(np.array(jax.devices()), ("sample",))
+    num_samples = 2 * len(jax.devices())
+    kwargs = dict(
+        predictor_fn=_predictor_fn,
+        rngs=jax.random.split(jax.random.PRNGKey(0), num_samples),
+        inputs=inputs,
+        targets_template=targets_template,
+        forcings=forcings,
+        num_samples=num_samples,
+        num_steps_per_chunk=num_steps_per_chunk)
+
+    def predict(**mesh_kwargs):
+      chunks = [jax.device_get(chunk) for chunk in
+                rollout.chunked_prediction_generator_multiple_runs(
+                    **kwargs, **mesh_kwargs)]
+      return xarray.combine_by_coords(
+          [chunk.expand_dims("sample") if "sample" not in chunk.dims
+           else chunk for chunk in chunks])
+
+    expected = predict()
+    actual = predict(mesh=mesh)
+    xarray.testing.assert_allclose(
+        expected, actual.transpose(*expected.temperature.dims))
+
+  def test_sharded_multiple_runs_shard_predictions(self):
+    inputs, targets_template, forcings = _get_data(num_target_steps=2)
+    mesh = jax.sharding.Mesh(np.array(jax.devices()), ("sample",))
+    chunk = next(rollout.chunked_prediction_generator_multiple_runs(
+        _predictor_fn,
+        rngs=jax.random.split(jax.random.PRNGKey(0), len(jax.devices())),
+        inputs=inputs,
+        targets_template=targets_template,
+        forcings=forcings,
+        num_samples=len(jax.devices()),
+        mesh=mesh))
+    self.assertEqual(chunk.temperature.dims[0], "sample")
+    predictions = xarray_jax.unwrap_data(chunk.temperature)
+    self.assertTrue(predictions.sharding.is_equivalent_to(
+        jax.sharding.NamedSharding(mesh, jax.sharding.PartitionSpec("sample")),
+        predictions.ndim))
+
+
+if __name__ == "__main__":
+  absltest.main()
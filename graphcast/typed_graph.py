@@ -13,7 +13,7 @@
 # limitations under the License.
 """Data-structure for storing graphs with typed edges and nodes."""
 
-from typing import NamedTuple, Any, Union, Tuple, Mapping, TypeVar
+from typing import NamedTuple, Any, Optional, Union, Tuple, Mapping, TypeVar
 
 ArrayLike = Union[Any]  # np.ndarray, jnp.ndarray, tf.tensor
 ArrayLikeTree = Union[Any, ArrayLike]  # Nest of ArrayLike
@@ -59,6 +59,16 @@ class EdgeSet(NamedTuple):
   n_edge: ArrayLike  # [num_flat_graphs]
   indices: EdgesIndices
   features: ArrayLikeTree  # Prev. `edges`: [num_flat_edges] + feature_shape
+  # Static properties of `indices.receivers`, passed on to the segment
+  # operations aggregating the edges for the receiver nodes (see
+  # `jax.ops.segment_sum`). They must only be set when they are known to hold.
+  indices_are_sorted: bool = False  # Receivers are in non-decreasing order.
+  unique_indices: bool = False  # No two edges share a receiver.
+  # If set, every receiver node has exactly this many edges and the edges are
+  # grouped by receiver, i.e. `receivers` is
+  # `repeat(arange(num_receiver_nodes), constant_in_degree)`. This allows a
+  # dense gather/reduce in place of the generic indexed ones.
+  constant_in_degree: Optional[int] = None
 
 
 class Context(NamedTuple):
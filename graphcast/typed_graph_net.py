@@ -13,6 +13,7 @@
 # limitations under the License.
 """A library of typed Graph Neural Networks."""
 
+import functools
 from typing import Callable, Mapping, Optional, Union
 
 from graphcast import typed_graph
@@ -33,6 +34,10 @@ GNUpdateNodeFn = Callable[
      Globals],
     NodeFeatures]
 
+# Signature:
+# ([num_nodes, degree] + feature_shape messages) -> aggregated node messages
+DenseAggregateFn = Callable[[jnp.ndarray], jnp.ndarray]
+
 GNUpdateGlobalFn = Callable[
     [Mapping[str, NodeFeatures], Mapping[str, EdgeFeatures], Globals],
     Globals]
@@ -48,6 +53,7 @@ def GraphNetwork(  # pylint: disable=invalid-name
     .segment_sum,
     aggregate_edges_for_globals_fn: jraph.AggregateEdgesToGlobalsFn = jraph
     .segment_sum,
+    aggregate_edges_for_nodes_dense_fn: Optional[DenseAggregateFn] = None,
     ):
   """Returns a method that applies a configured GraphNetwork.
 
@@ -72,11 +78,16 @@ def GraphNetwork(  # pylint: disable=invalid-name
     update_global_fn: function used to update the globals or None to deactivate
       globals updates.
     aggregate_edges_for_nodes_fn: function used to aggregate messages to each
-      node.
+      node. Like the `jraph` segment operations, it must accept
+      `indices_are_sorted` and `unique_indices` keyword arguments.
     aggregate_nodes_for_globals_fn: function used to aggregate the nodes for the
       globals.
     aggregate_edges_for_globals_fn: function used to aggregate the edges for the
       globals.
+    aggregate_edges_for_nodes_dense_fn: optional function equivalent to
+      `aggregate_edges_for_nodes_fn` for edge sets with a `constant_in_degree`,
+      reducing messages of shape [num_nodes, degree, ...] along axis 1. If
+      None, `aggregate_edges_for_nodes_fn` is used for all edge sets.
 
   Returns:
     A method that applies the configured GraphNetwork.
@@ -111,7 +122,8 @@ def GraphNetwork(  # pylint: disable=invalid-name
     updated_nodes = dict(updated_graph.nodes)
     for node_set_key, node_fn in update_node_fn.items():
       updated_nodes[node_set_key] = _node_update(
-          updated_graph, node_fn, node_set_key, aggregate_edges_for_nodes_fn)
+          updated_graph, node_fn, node_set_key, aggregate_edges_for_nodes_fn,
+          aggregate_edges_for_nodes_dense_fn)
     updated_graph = updated_graph._replace(nodes=updated_nodes)
 
     # Global update.
@@ -138,8 +150,14 @@ def _edge_update(graph, edge_fn, edge_set_key):  # pylint: disable=invalid-name
 
   sent_attributes = tree.tree_map(
       lambda n: n[senders], sender_nodes.features)
-  received_attributes = tree.tree_map(
-      lambda n: n[receivers], receiver_nodes.features)
+  if edge_set.constant_in_degree is not None:
+    # Each receiver node is simply repeated for its edges.
+    received_attributes = tree.tree_map(
+        lambda n: _repeat_nodes_for_edges(n, edge_set.constant_in_degree),
+        receiver_nodes.features)
+  else:
+    received_attributes = tree.tree_map(
+        lambda n: n[receivers], receiver_nodes.features)
 
   n_edge = edge_set.n_edge
   sum_n_edge = senders.shape[0]
@@ -152,7 +170,8 @@ def _edge_update(graph, edge_fn, edge_set_key):  # pylint: disable=invalid-name
   return edge_set._replace(features=new_features)
 
 
-def _node_update(graph, node_fn, node_set_key, aggregation_fn):  # pylint: disable=invalid-name
+def _node_update(  # pylint: disable=invalid-name
+    graph, node_fn, node_set_key, aggregation_fn, dense_aggregation_fn=None):
   """Updates an edge set of a given key."""
   node_set = graph.nodes[node_set_key]
   sum_n_node = tree.tree_leaves(node_set.features)[0].shape[0]
@@ -172,8 +191,24 @@ def _node_update(graph, node_fn, node_set_key, aggregation_fn):  # pylint: disab
     if receiver_node_set_key == node_set_key:
       assert isinstance(edge_set.indices, typed_graph.EdgesIndices)
       receivers = edge_set.indices.receivers
+      if (edge_set.constant_in_degree is not None and
+          dense_aggregation_fn is not None):
+        # Reduce the messages of each receiver without any scatter.
+        aggregate_fn = functools.partial(
+            _dense_aggregation,
+            dense_aggregation_fn=dense_aggregation_fn,
+            degree=edge_set.constant_in_degree)
+      else:
+        # The edge set may know that its receivers are sorted or unique, which
+        # allows for a faster aggregation.
+        aggregate_fn = functools.partial(
+            aggregation_fn,
+            segment_ids=receivers,
+            num_segments=sum_n_node,
+            indices_are_sorted=edge_set.indices_are_sorted,
+            unique_indices=edge_set.unique_indices)
       received_features[edge_set_key.name] = tree.tree_map(
-          lambda e: aggregation_fn(e, receivers, sum_n_node), edge_set.features)  # pylint: disable=cell-var-from-loop
+          aggregate_fn, edge_set.features)
 
   n_node = node_set.n_node
   global_features = tree.tree_map(
@@ -184,6 +219,22 @@ def _node_update(graph, node_fn, node_set_key, aggregation_fn):  # pylint: disab
   return node_set._replace(features=new_features)
 
 
+def _repeat_nodes_for_edges(node_features, degree):
+  """Gathers the receiver features for a constant in-degree edge set."""
+  num_nodes = node_features.shape[0]
+  repeated = jnp.broadcast_to(
+      node_features[:, None],
+      (num_nodes, degree) + node_features.shape[1:])
+  return repeated.reshape((num_nodes * degree,) + node_features.shape[1:])
+
+
+def _dense_aggregation(edge_features, dense_aggregation_fn, degree):
+  """Aggregates the messages of a constant in-degree edge set."""
+  num_nodes = edge_features.shape[0] // degree
+  return dense_aggregation_fn(
+      edge_features.reshape((num_nodes, degree) + edge_features.shape[1:]))
+
+
 def _global_update(graph, global_fn, edge_aggregation_fn, node_aggregation_fn):  # pylint: disable=invalid-name
   """Updates an edge set of a given key."""
   n_graph = graph.context.n_graph.shape[0]
@@ -231,7 +282,8 @@ def InteractionNetwork(  # pylint: disable=invalid-name
                                        InteractionUpdateNodeFnNoSentEdges]],
     aggregate_edges_for_nodes_fn: jraph.AggregateEdgesToNodesFn = jraph
     .segment_sum,
-    include_sent_messages_in_node_update: bool = False):
+    include_sent_messages_in_node_update: bool = False,
+    aggregate_edges_for_nodes_dense_fn: Optional[DenseAggregateFn] = None):
   """Returns a method that applies a configured InteractionNetwork.
 
   An interaction network computes interactions on the edges based on the
@@ -249,9 +301,13 @@ def InteractionNetwork(  # pylint: disable=invalid-name
     update_node_fn: mapping of functions used to update a subset of the node
       types, indexed by node type name.
     aggregate_edges_for_nodes_fn: function used to aggregate messages to each
-      node.
+      node. Like the `jraph` segment operations, it must accept
+      `indices_are_sorted` and `unique_indices` keyword arguments.
     include_sent_messages_in_node_update: pass edge features for which a node is
       a sender to the node update function.
+    aggregate_edges_for_nodes_dense_fn: optional dense equivalent of
+      `aggregate_edges_for_nodes_fn` for edge sets with a `constant_in_degree`,
+      see `GraphNetwork`.
   """
   # An InteractionNetwork is a GraphNetwork without globals features,
   # so we implement the InteractionNetwork as a configured GraphNetwork.
@@ -272,7 +328,8 @@ def InteractionNetwork(  # pylint: disable=invalid-name
   return GraphNetwork(
       update_edge_fn=wrapped_update_edge_fn,
       update_node_fn=wrapped_update_node_fn,
-      aggregate_edges_for_nodes_fn=aggregate_edges_for_nodes_fn)
+      aggregate_edges_for_nodes_fn=aggregate_edges_for_nodes_fn,
+      aggregate_edges_for_nodes_dense_fn=aggregate_edges_for_nodes_dense_fn)
 
 
 def GraphMapFeatures(  # pylint: disable=invalid-name
@@ -605,6 +605,65 @@ def pmap(fn: Callable[..., Any],
   return result_fn
 
 
+def vmap(fn: Callable[..., Any], dim: str) -> Callable[..., Any]:
+  """Wraps jax.vmap to map over an xarray dimension of its inputs.
+
+  Unlike `pmap`, `dim` can be at any position, and the inputs which don't have
+  it are not mapped over but shared by all the elements (in_axes=None). This
+  makes it possible to e.g. batch a model over samples while sharing its
+  static inputs.
+
+  Constraints:
+    * Plain jax arrays (not wrapped in xarray) are mapped over their first
+      axis.
+    * All return values are mapped over, and get `dim` as their first
+      dimension (out_axes=0).
+
+  Args:
+    fn: Function to be vmap'd which takes and returns trees which may contain
+      xarray Dataset/DataArray.
+    dim: The xarray dimension name to map over.
+
+  Returns:
+    A vmap'd version of `fn`, which takes Dataset/DataArray with (or without)
+    `dim`, and returns Dataset/DataArray with an extra leading dimension `dim`
+    relative to what the original `fn` sees.
+  """
+  input_treedef = None
+  output_treedef = None
+
+  def fn_passed_to_vmap(*flat_args):
+    assert input_treedef is not None
+    with dims_change_on_unflatten(
+        lambda dims: tuple(d for d in dims if d != dim)):
+      args = jax.tree_util.tree_unflatten(input_treedef, flat_args)
+    result = fn(*args)
+    nonlocal output_treedef
+    flat_result, output_treedef = jax.tree_util.tree_flatten(result)
+    return flat_result
+
+  def result_fn(*args):
+    nonlocal input_treedef
+    flat_args, input_treedef = jax.tree_util.tree_flatten(args)
+    # Variables have a single leaf each, so they line up with `flat_args`.
+    in_axes = []
+    for leaf in jax.tree_util.tree_leaves(
+        args, is_leaf=lambda x: isinstance(x, xarray.Variable)):
+      if not isinstance(leaf, xarray.Variable):
+        in_axes.append(0)
+      elif dim in leaf.dims:
+        in_axes.append(leaf.dims.index(dim))
+      else:
+        in_axes.append(None)
+    flat_result = jax.vmap(
+        fn_passed_to_vmap, in_axes=tuple(in_axes), out_axes=0)(*flat_args)
+    assert output_treedef is not None
+    with dims_change_on_unflatten(lambda dims: (dim,) + dims):
+      return jax.tree_util.tree_unflatten(output_treedef, flat_result)
+
+  return result_fn
+
+
 # Register xarray datatypes with jax.tree_util.
 
 
@@ -468,6 +468,26 @@ class XarrayJaxTest(absltest.TestCase):
         jax.device_get(inputs['bar'] + 1),
         jax.device_get(result_bar))
 
+  def test_vmap(self):
+    foo = jnp.arange(2 * 3 * 4, dtype=np.float32).reshape((3, 2, 4))
+    bar = jnp.ones((3, 4), dtype=np.float32)
+    dataset = xarray_jax.Dataset(
+        {'foo': (('lat', 'sample', 'lon'), foo),
+         'bar': (('lat', 'lon'), bar)},
+        coords={'lat': np.arange(3), 'lon': np.arange(4)})
+    rngs = jax.random.split(jax.random.PRNGKey(0), 2)
+
+    def func(rng, d):
+      self.assertNotIn('sample', d.dims)
+      self.assertEqual(rng.shape, (2,))
+      return d.foo * d.bar + 1
+
+    result = jax.jit(xarray_jax.vmap(func, dim='sample'))(rngs, dataset)
+    self.assertEqual(('sample', 'lat', 'lon'), result.dims)
+    expected = (dataset.foo * dataset.bar + 1).transpose('sample', ...)
+    xarray.testing.assert_identical(
+        jax.device_get(expected), jax.device_get(result))
+
   def test_pmap_complains_when_dim_not_first(self):
     devices = jax.local_device_count()
     data_array = xarray_jax.DataArray(
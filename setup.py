@@ -47,7 +47,8 @@ setup(
         "trimesh",
         "typing_extensions",
         "xarray",
-        "xarray_tensorstore"
+        "xarray_tensorstore",
+        "zarr",
     ],
     classifiers=[
         "Development Status :: 3 - Alpha",